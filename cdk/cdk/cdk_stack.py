@@ -387,6 +387,8 @@ class ChatbotWebsiteStack(Stack):
                 name="session_id", type=dynamodb.AttributeType.STRING
             ),
             billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            # removes the tombstones left by deleted conversations
+            time_to_live_attribute="expires_at",
             removal_policy=RemovalPolicy.DESTROY,
         )
         dynamodb_conversations_table.add_global_secondary_index(
@@ -399,6 +401,96 @@ class ChatbotWebsiteStack(Stack):
             ),
             projection_type=dynamodb.ProjectionType.ALL,
         )
+        # conversation list queries only need these fields, so history writes are never
+        # replicated into the index. DynamoDB adds or removes one index per update, so
+        # user_id-index is removed in a later deployment once no reader uses it.
+        dynamodb_conversations_table.add_global_secondary_index(
+            index_name="user_id-list-index",
+            partition_key=dynamodb.Attribute(
+                name="user_id", type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="last_modified_date", type=dynamodb.AttributeType.NUMBER
+            ),
+            projection_type=dynamodb.ProjectionType.INCLUDE,
+            non_key_attributes=[
+                "title",
+                "selected_model_id",
+                "selected_model_name",
+                "category",
+                "kb_session_id",
+                "selected_knowledgebase_id",
+                "flow_id",
+                "flow_alias_id",
+                "selected_agent_id",
+                "selected_agent_alias_id",
+                "conversation_history_in_s3",
+                "last_message_id",
+            ],
+        )
+        # one item per conversation message, appended on every turn
+        dynamodb_conversation_messages_table = dynamodb.Table(
+            self,
+            "conversation_messages_table",
+            partition_key=dynamodb.Attribute(
+                name="session_id", type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="seq", type=dynamodb.AttributeType.NUMBER
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+        # full-text search postings, one item per (user_id#term, session_id)
+        dynamodb_conversation_search_index_table = dynamodb.Table(
+            self,
+            "conversation_search_index_table",
+            partition_key=dynamodb.Attribute(
+                name="term_key", type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="session_id", type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+        # read when a session is deleted, to delete its postings
+        dynamodb_conversation_search_index_table.add_global_secondary_index(
+            index_name="session_id-index",
+            partition_key=dynamodb.Attribute(
+                name="session_id", type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="term_key", type=dynamodb.AttributeType.STRING
+            ),
+            projection_type=dynamodb.ProjectionType.KEYS_ONLY,
+        )
+        # embeddings of stored answers for semantic search, sorted by write time per user
+        dynamodb_conversation_embeddings_table = dynamodb.Table(
+            self,
+            "conversation_embeddings_table",
+            partition_key=dynamodb.Attribute(
+                name="user_id", type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="embedding_key", type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            # removes the tombstones left by deleted conversations
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+        # read when a session is deleted, to delete its embeddings
+        dynamodb_conversation_embeddings_table.add_global_secondary_index(
+            index_name="session_id-index",
+            partition_key=dynamodb.Attribute(
+                name="session_id", type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="embedding_key", type=dynamodb.AttributeType.STRING
+            ),
+            projection_type=dynamodb.ProjectionType.KEYS_ONLY,
+        )
         dynamodb_incidents_table_name = "NONE"
         if deploy_example_incidents_agent:
             dynamodb_incidents_table = dynamodb.Table(
@@ -489,6 +581,17 @@ class ChatbotWebsiteStack(Stack):
             user_pool.add_trigger(
                 cognito.UserPoolOperation.PRE_SIGN_UP, cognito_pre_signup_function
             )
+        # stored turns are queued for search and semantic search and indexed in batches
+        turn_index_dead_letter_queue = sqs.Queue(self, "TurnIndexDeadLetterQueue")
+        turn_index_queue = sqs.Queue(
+            self,
+            "TurnIndexQueue",
+            visibility_timeout=Duration.seconds(900),
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=3, queue=turn_index_dead_letter_queue
+            ),
+        )
+
         # Create the Lambda function for image generation
         image_generation_function = _lambda.Function(
             self,
@@ -513,6 +616,10 @@ class ChatbotWebsiteStack(Stack):
                 "CLOUDFRONT_DOMAIN": cloudfront_distribution.distribution_domain_name,
                 "COGNITO_PUBLIC_KEY_URL": cognito_public_key_url,
                 "CONVERSATIONS_DYNAMODB_TABLE": dynamodb_conversations_table.table_name,
+                "CONVERSATION_MESSAGES_DYNAMODB_TABLE": dynamodb_conversation_messages_table.table_name,
+                "CONVERSATION_SEARCH_INDEX_DYNAMODB_TABLE": dynamodb_conversation_search_index_table.table_name,
+                "CONVERSATION_EMBEDDINGS_DYNAMODB_TABLE": dynamodb_conversation_embeddings_table.table_name,
+                "TURN_INDEX_QUEUE_URL": turn_index_queue.queue_url,
                 "CONVERSATION_HISTORY_BUCKET": conversation_history_bucket.bucket_name,
                 "POWERTOOLS_SERVICE_NAME": "IMAGE_GENERATION_SERVICE",
             },
@@ -520,6 +627,7 @@ class ChatbotWebsiteStack(Stack):
         image_generation_function.apply_removal_policy(RemovalPolicy.DESTROY)
         websocket_api.grant_manage_connections(image_generation_function)
         image_bucket.grant_read_write(image_generation_function)
+        conversation_history_bucket.grant_read_write(image_generation_function)
         image_generation_function.role.add_managed_policy(
             iam.ManagedPolicy.from_aws_managed_policy_name("AmazonBedrockFullAccess")
         )
@@ -529,6 +637,10 @@ class ChatbotWebsiteStack(Stack):
             )
         )
         dynamodb_conversations_table.grant_full_access(image_generation_function)
+        dynamodb_conversation_messages_table.grant_full_access(image_generation_function)
+        dynamodb_conversation_search_index_table.grant_read_write_data(image_generation_function)
+        dynamodb_conversation_embeddings_table.grant_read_write_data(image_generation_function)
+        turn_index_queue.grant_send_messages(image_generation_function)
 
         # Create the Lambda function for video generation
         video_generation_function = _lambda.Function(
@@ -555,6 +667,10 @@ class ChatbotWebsiteStack(Stack):
                 "CLOUDFRONT_DOMAIN": cloudfront_distribution.distribution_domain_name,
                 "COGNITO_PUBLIC_KEY_URL": cognito_public_key_url,
                 "CONVERSATIONS_DYNAMODB_TABLE": dynamodb_conversations_table.table_name,
+                "CONVERSATION_MESSAGES_DYNAMODB_TABLE": dynamodb_conversation_messages_table.table_name,
+                "CONVERSATION_SEARCH_INDEX_DYNAMODB_TABLE": dynamodb_conversation_search_index_table.table_name,
+                "CONVERSATION_EMBEDDINGS_DYNAMODB_TABLE": dynamodb_conversation_embeddings_table.table_name,
+                "TURN_INDEX_QUEUE_URL": turn_index_queue.queue_url,
                 "CONVERSATION_HISTORY_BUCKET": conversation_history_bucket.bucket_name,
                 "AWS_ACCOUNT_ID": self.account,
                 "POWERTOOLS_SERVICE_NAME": "VIDEO_GENERATION_SERVICE",
@@ -565,6 +681,7 @@ class ChatbotWebsiteStack(Stack):
         video_generation_function.apply_removal_policy(RemovalPolicy.DESTROY)
         websocket_api.grant_manage_connections(video_generation_function)
         image_bucket.grant_read_write(video_generation_function)
+        conversation_history_bucket.grant_read_write(video_generation_function)
         attachment_bucket.grant_read_write(video_generation_function)
         video_generation_function.role.add_managed_policy(
             iam.ManagedPolicy.from_aws_managed_policy_name("AmazonBedrockFullAccess")
@@ -575,6 +692,10 @@ class ChatbotWebsiteStack(Stack):
             )
         )
         dynamodb_conversations_table.grant_full_access(video_generation_function)
+        dynamodb_conversation_messages_table.grant_full_access(video_generation_function)
+        dynamodb_conversation_search_index_table.grant_read_write_data(video_generation_function)
+        dynamodb_conversation_embeddings_table.grant_read_write_data(video_generation_function)
+        turn_index_queue.grant_send_messages(video_generation_function)
 
         config_function = _lambda.Function(
             self,
@@ -635,6 +756,10 @@ class ChatbotWebsiteStack(Stack):
                 "WEBSOCKET_API_ENDPOINT": websocket_api_endpoint,
                 "COGNITO_PUBLIC_KEY_URL": cognito_public_key_url,
                 "CONVERSATIONS_DYNAMODB_TABLE": dynamodb_conversations_table.table_name,
+                "CONVERSATION_MESSAGES_DYNAMODB_TABLE": dynamodb_conversation_messages_table.table_name,
+                "CONVERSATION_SEARCH_INDEX_DYNAMODB_TABLE": dynamodb_conversation_search_index_table.table_name,
+                "CONVERSATION_EMBEDDINGS_DYNAMODB_TABLE": dynamodb_conversation_embeddings_table.table_name,
+                "TURN_INDEX_QUEUE_URL": turn_index_queue.queue_url,
                 "CONVERSATION_HISTORY_BUCKET": conversation_history_bucket.bucket_name,
                 "DYNAMODB_TABLE_USAGE": dynamodb_bedrock_usage_table.table_name,
                 "POWERTOOLS_SERVICE_NAME": "AGENTS_CLIENT_SERVICE",
@@ -654,6 +779,10 @@ class ChatbotWebsiteStack(Stack):
             iam.ManagedPolicy.from_aws_managed_policy_name("AmazonSQSFullAccess")
         )
         dynamodb_conversations_table.grant_full_access(agents_client_function)
+        dynamodb_conversation_messages_table.grant_full_access(agents_client_function)
+        dynamodb_conversation_search_index_table.grant_read_write_data(agents_client_function)
+        dynamodb_conversation_embeddings_table.grant_read_write_data(agents_client_function)
+        turn_index_queue.grant_send_messages(agents_client_function)
         conversation_history_bucket.grant_read_write(agents_client_function)
         dynamodb_configurations_table.grant_read_data(agents_client_function)
 
@@ -703,6 +832,8 @@ class ChatbotWebsiteStack(Stack):
             architecture=_lambda.Architecture.ARM_64,
             environment={
                 "CONVERSATIONS_DYNAMODB_TABLE": dynamodb_conversations_table.table_name,
+                "CONVERSATION_MESSAGES_DYNAMODB_TABLE": dynamodb_conversation_messages_table.table_name,
+                "CONVERSATION_SEARCH_INDEX_DYNAMODB_TABLE": dynamodb_conversation_search_index_table.table_name,
                 "CONVERSATION_HISTORY_BUCKET": conversation_history_bucket.bucket_name,
                 "WEBSOCKET_API_ENDPOINT": websocket_api_endpoint,
                 "DYNAMODB_TABLE_CONFIG": dynamodb_configurations_table.table_name,
@@ -711,6 +842,15 @@ class ChatbotWebsiteStack(Stack):
                 "ATTACHMENT_BUCKET_NAME": attachment_bucket.bucket_name,
                 "S3_IMAGE_BUCKET_NAME": image_bucket.bucket_name,
                 "COGNITO_PUBLIC_KEY_URL": cognito_public_key_url,
+                "CONTEXT_BUDGET_RATIO": "0.75",
+                "CONTEXT_TOKEN_BUDGET": "0",
+                # comma separated, any of text, image, document and video
+                "HISTORY_CONTENT_TYPES": "text",
+                "SYSTEM_PROMPT_CACHE_TTL_SECONDS": "300",
+                "CONVERSATION_EMBEDDINGS_DYNAMODB_TABLE": dynamodb_conversation_embeddings_table.table_name,
+                "EMBEDDING_MODEL_ID": "amazon.titan-embed-text-v2:0",
+                "EMBEDDING_DIMENSIONS": "256",
+                "TURN_INDEX_QUEUE_URL": turn_index_queue.queue_url,
                 "POWERTOOLS_SERVICE_NAME": "BEDROCK_ASYNC_SERVICE",
             },
         )
@@ -729,12 +869,57 @@ class ChatbotWebsiteStack(Stack):
             iam.ManagedPolicy.from_aws_managed_policy_name("AmazonSQSFullAccess")
         )
         dynamodb_conversations_table.grant_full_access(lambda_async_function)
+        dynamodb_conversation_messages_table.grant_full_access(lambda_async_function)
+        dynamodb_conversation_search_index_table.grant_read_write_data(lambda_async_function)
+        dynamodb_conversation_embeddings_table.grant_read_write_data(lambda_async_function)
         dynamodb_configurations_table.grant_full_access(lambda_async_function)
         conversation_history_bucket.grant_read_write(lambda_async_function)
         custom_model_import_bucket.grant_read_write(lambda_async_function)
         dynamodb_bedrock_usage_table.grant_full_access(lambda_async_function)
         attachment_bucket.grant_read_write(lambda_async_function)
         image_bucket.grant_read_write(lambda_async_function)
+        turn_index_queue.grant_send_messages(lambda_async_function)
+        lambda_async_function.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                turn_index_queue,
+                batch_size=100,
+                max_batching_window=Duration.seconds(30),
+                report_batch_item_failures=True,
+            )
+        )
+
+        # archives the history of idle conversations to S3, run by a daily schedule
+        conversation_archive_function = _lambda.Function(
+            self,
+            "ConversationArchiveFunction" + FUNCTION_NAME_SUFFIX,
+            runtime=_lambda.Runtime.PYTHON_3_13,
+            handler="genai_bedrock_archive_fn.lambda_handler",
+            code=_lambda.Code.from_asset("lambda_functions/genai_bedrock_archive_fn/"),
+            timeout=Duration.seconds(900),
+            architecture=_lambda.Architecture.ARM_64,
+            tracing=_lambda.Tracing.ACTIVE,
+            memory_size=1024,
+            layers=[
+                boto3_layer,
+                commons_layer,
+                conversations_layer,
+                lambda_insights_layer_arm64,
+            ],
+            log_retention=logs.RetentionDays.FIVE_DAYS,
+            environment={
+                "CONVERSATIONS_DYNAMODB_TABLE": dynamodb_conversations_table.table_name,
+                "CONVERSATION_MESSAGES_DYNAMODB_TABLE": dynamodb_conversation_messages_table.table_name,
+                "CONVERSATION_HISTORY_BUCKET": conversation_history_bucket.bucket_name,
+                "ARCHIVE_IDLE_DAYS": "90",
+                "POWERTOOLS_SERVICE_NAME": "CONVERSATION_ARCHIVE_SERVICE",
+            },
+        )
+        conversation_archive_function.apply_removal_policy(RemovalPolicy.DESTROY)
+        dynamodb_conversations_table.grant_read_write_data(conversation_archive_function)
+        dynamodb_conversation_messages_table.grant_read_write_data(
+            conversation_archive_function
+        )
+        conversation_history_bucket.grant_read_write(conversation_archive_function)
 
         # Create the "genai_bedrock_fn_conversations" Lambda function
         lambda_conversations_function = _lambda.Function(
@@ -1131,6 +1316,17 @@ class ChatbotWebsiteStack(Stack):
             enabled=False,
             schedule_group=scheduler_group,
         )
+        scheduler.Schedule(
+            self,
+            "ConversationArchiveSchedule",
+            schedule=scheduler.ScheduleExpression.rate(Duration.hours(24)),
+            target=scheduler_targets.LambdaInvoke(
+                conversation_archive_function,
+                retry_attempts=0,
+            ),
+            description="Schedule to archive the history of idle conversations",
+            schedule_group=scheduler_group,
+        )
         # add env variable to lambda function model_scan_function
         config_function.add_environment(
             "SCHEDULE_NAME", module_scan_schedule.schedule_name
@@ -5,6 +5,9 @@ import time
 import io
 import random
 import string
+import queue
+import threading
+import concurrent.futures
 from datetime import datetime, timezone, timedelta
 from aws_lambda_powertools import Tracer
 from botocore.exceptions import ClientError
@@ -18,6 +21,18 @@ except ImportError:
 
 GREEN_SCREEN_COLOR = (4, 244, 4)
 BLACK_COLOR = (0, 0, 0)
+# default number of attachments fetched from S3 and processed at the same time
+ATTACHMENT_MAX_WORKERS = 8
+# frames that may be waiting for delivery before the producer is slowed down
+WEBSOCKET_SENDER_QUEUE_SIZE = 256
+# streamed text deltas are coalesced until they are this old, this large, or the frame rate allows another frame
+DELTA_MAX_LATENCY_SECONDS = 0.1
+DELTA_MAX_BYTES = 16 * 1024
+DELTA_MAX_FRAMES_PER_SECOND = 12
+# consecutive frames that may hit a gone connection before the stream is cancelled
+WEBSOCKET_MAX_GONE_FRAMES = 3
+# seconds between checks for a client stop request while an answer is streamed
+STOP_POLL_INTERVAL_SECONDS = 1.0
 tracer = Tracer()
 
 
@@ -43,7 +58,7 @@ def send_websocket_message(logger, apigateway_management_api, connection_id, mes
         message (dict): The message to be sent to the client. This will be JSON-encoded before sending.
 
     Returns:
-        None
+        bool: False if the connection is gone or not open, True otherwise.
 
     Raises:
         No exceptions are raised directly by this function. All exceptions are caught and logged.
@@ -61,7 +76,7 @@ def send_websocket_message(logger, apigateway_management_api, connection_id, mes
         >>> send_websocket_message(logger, api_client, 'abc123', {'type': 'message', 'content': 'Hello, WebSocket!'})
     """
     if not connection_id:
-        return
+        return True
     try:
         # Check if the WebSocket connection is open
         connection = apigateway_management_api.get_connection(
@@ -70,7 +85,7 @@ def send_websocket_message(logger, apigateway_management_api, connection_id, mes
         connection_state = connection.get("ConnectionStatus", "OPEN")
         if connection_state != "OPEN":
             logger.warn(f"WebSocket connection is not open (state: {connection_state})")
-            return
+            return False
 
         apigateway_management_api.post_to_connection(
             ConnectionId=connection_id,
@@ -80,18 +95,288 @@ def send_websocket_message(logger, apigateway_management_api, connection_id, mes
         logger.info(
             f"Connection {connection_id} is no longer available. User must have closed browser"
         )
+        return False
     except ClientError as e:
         if e.response["Error"]["Code"] == "PayloadTooLargeException":
             logger.error(f"WebSocket message too large (9012): {str(e)}")
             logger.error(f"Message: {message}")
-            return
+            return True
         else:
             raise
     except apigateway_management_api.exceptions.GoneException:
         logger.warn(f"WebSocket connection is closed (connectionId: {connection_id})")
+        return False
     except Exception as e:
         logger.exception(e)
         logger.error(f"Error sending WebSocket message (9012): {str(e)}")
+    return True
+
+
+class StreamCancellation:
+    """
+    Tracks whether a streamed answer should stop before the model finishes.
+
+    A stream is cancelled when the client asked to stop, which is checked with
+    check_stop_requested at most once per poll interval, or when cancel() is called,
+    for example by a WebSocketSender whose connection is gone.
+
+    Example:
+        >>> cancellation = StreamCancellation(logger, lambda: stop_requested(session_id))
+        >>> for event in stream:
+        ...     if cancellation.is_cancelled():
+        ...         break
+    """
+
+    def __init__(
+        self,
+        logger,
+        check_stop_requested=None,
+        poll_interval=STOP_POLL_INTERVAL_SECONDS,
+    ):
+        self.logger = logger
+        self.check_stop_requested = check_stop_requested
+        self.poll_interval = poll_interval
+        self.reason = None
+        self._cancelled = threading.Event()
+        self._next_poll = time.monotonic() + poll_interval
+
+    def cancel(self, reason):
+        """Cancel the stream, the first reason given is kept"""
+        if not self._cancelled.is_set():
+            self.reason = reason
+            self._cancelled.set()
+            self.logger.info(f"Stream cancelled: {reason}")
+
+    def is_cancelled(self):
+        """Returns True once the stream was cancelled, polling for a stop request when one is due"""
+        if self._cancelled.is_set():
+            return True
+        now = time.monotonic()
+        if self.check_stop_requested and now >= self._next_poll:
+            self._next_poll = now + self.poll_interval
+            try:
+                if self.check_stop_requested():
+                    self.cancel("stop_requested")
+            except Exception as e:
+                self.logger.warn(f"Error checking for a stop request (9014): {str(e)}")
+        return self._cancelled.is_set()
+
+
+class DeltaCoalescer:
+    """
+    Coalesce streamed text deltas into fewer websocket frames.
+
+    Each content type (for example answer text and reasoning text) has its own
+    buffer. A buffer is emitted once its oldest delta has waited max_latency seconds
+    and the frame rate cap allows another frame, or right away once it holds
+    max_bytes of text. The coalescer holds no threads or clocks of its own: callers
+    pass the current time, which keeps it deterministic.
+    """
+
+    def __init__(
+        self,
+        max_latency=DELTA_MAX_LATENCY_SECONDS,
+        max_bytes=DELTA_MAX_BYTES,
+        max_frames_per_second=DELTA_MAX_FRAMES_PER_SECOND,
+    ):
+        self.max_latency = max_latency
+        self.max_bytes = max_bytes
+        self.min_frame_interval = (
+            1.0 / max_frames_per_second if max_frames_per_second else 0
+        )
+        self._buffers = {}
+        self._last_frame_at = None
+        self.frames_in = 0
+        self.frames_out = 0
+
+    def add(self, content_type, message, now):
+        """
+        Buffer a delta frame and return the frames that are ready to be sent.
+
+        Args:
+            content_type (str): The buffer the delta belongs to.
+            message (dict): The delta frame, with its text in message['delta']['text'].
+            now (float): The current time.
+
+        Returns:
+            list: Frames that are ready to be sent, oldest first.
+        """
+        self.frames_in += 1
+        text = message.get("delta", {}).get("text", "")
+        buffer = self._buffers.get(content_type)
+        if buffer is None:
+            buffer = {"parts": [], "size": 0, "since": now}
+            self._buffers[content_type] = buffer
+        buffer["message"] = message
+        buffer["parts"].append(text)
+        buffer["size"] += len(text.encode("utf-8"))
+        return self.due(now)
+
+    def due(self, now):
+        """Return the buffered frames whose deadline has passed"""
+        ready = []
+        for content_type in sorted(
+            self._buffers, key=lambda key: self._buffers[key]["since"]
+        ):
+            buffer = self._buffers[content_type]
+            if buffer["size"] >= self.max_bytes or (
+                now - buffer["since"] >= self.max_latency and self._frame_allowed(now)
+            ):
+                ready.append(self._emit(content_type, now))
+        return ready
+
+    def next_deadline(self):
+        """Return the time at which the next buffered frame becomes due, or None"""
+        if not self._buffers:
+            return None
+        deadline = min(buffer["since"] for buffer in self._buffers.values())
+        deadline += self.max_latency
+        if self._last_frame_at is not None:
+            deadline = max(deadline, self._last_frame_at + self.min_frame_interval)
+        return deadline
+
+    def drain(self, now):
+        """Return every buffered frame, oldest first"""
+        ready = sorted(self._buffers, key=lambda key: self._buffers[key]["since"])
+        return [self._emit(content_type, now) for content_type in ready]
+
+    def _frame_allowed(self, now):
+        return (
+            self._last_frame_at is None
+            or now - self._last_frame_at >= self.min_frame_interval
+        )
+
+    def _emit(self, content_type, now):
+        buffer = self._buffers.pop(content_type)
+        message = dict(buffer["message"])
+        message["delta"] = {**message.get("delta", {}), "text": "".join(buffer["parts"])}
+        self._last_frame_at = now
+        self.frames_out += 1
+        return message
+
+
+class WebSocketSender:
+    """
+    Deliver websocket frames for one connection from a background thread.
+
+    Frames are posted in the order they were queued, so the caller (for example the
+    loop reading a Bedrock stream) never waits on a post_to_connection round trip.
+    Text deltas queued with send_delta() are coalesced by a DeltaCoalescer on the
+    worker thread, which also enforces its latency deadline while the stream is
+    quiet. The queue is bounded: when the client falls too far behind, the
+    producer blocks until there is room again. When several frames in a row hit a
+    gone connection, the optional StreamCancellation is cancelled.
+
+    Example:
+        >>> with WebSocketSender(logger, api_client, 'abc123') as sender:
+        ...     sender.send({'type': 'message_start', 'delta': {'text': 'Hi'}})
+        ...     sender.send_delta({'type': 'content_block_delta', 'delta': {'text': ' there'}})
+        ...     sender.flush()
+    """
+
+    _STOP = object()
+    _FLUSH = object()
+
+    def __init__(
+        self,
+        logger,
+        apigateway_management_api,
+        connection_id,
+        max_queue_size=WEBSOCKET_SENDER_QUEUE_SIZE,
+        coalescer=None,
+        cancellation=None,
+        max_gone_frames=WEBSOCKET_MAX_GONE_FRAMES,
+    ):
+        self.logger = logger
+        self.apigateway_management_api = apigateway_management_api
+        self.connection_id = connection_id
+        self.coalescer = coalescer if coalescer else DeltaCoalescer()
+        self.cancellation = cancellation
+        self.max_gone_frames = max_gone_frames
+        self.gone_frames = 0
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def send(self, message):
+        """Queue a message for delivery, after any buffered deltas"""
+        self._queue.put(message)
+
+    def send_delta(self, message, content_type="text"):
+        """Queue a text delta frame that may be merged with its neighbours"""
+        self._queue.put((content_type, message))
+
+    def flush(self):
+        """Block until every queued message and buffered delta has been delivered"""
+        self._queue.put(self._FLUSH)
+        self._queue.join()
+
+    def close(self):
+        """Deliver the remaining messages and stop the worker thread"""
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+            self.logger.debug(
+                f"WebSocket deltas coalesced: {self.coalescer.frames_in} -> {self.coalescer.frames_out} frames"
+            )
+
+    def _run(self):
+        while True:
+            deadline = self.coalescer.next_deadline()
+            try:
+                item = self._queue.get(
+                    timeout=(
+                        max(0.0, deadline - time.monotonic())
+                        if deadline is not None
+                        else None
+                    )
+                )
+            except queue.Empty:
+                self._post_all(self.coalescer.due(time.monotonic()))
+                continue
+            try:
+                if isinstance(item, tuple):
+                    content_type, message = item
+                    self._post_all(
+                        self.coalescer.add(content_type, message, time.monotonic())
+                    )
+                    continue
+                self._post_all(self.coalescer.drain(time.monotonic()))
+                if item is self._STOP:
+                    return
+                if item is not self._FLUSH:
+                    self._post(item)
+            finally:
+                self._queue.task_done()
+
+    def _post_all(self, messages):
+        for message in messages:
+            self._post(message)
+
+    def _post(self, message):
+        if self.gone_frames >= self.max_gone_frames:
+            # the client is gone, remaining frames are dropped
+            return
+        try:
+            delivered = send_websocket_message(
+                self.logger,
+                self.apigateway_management_api,
+                self.connection_id,
+                message,
+            )
+            self.gone_frames = 0 if delivered else self.gone_frames + 1
+            if self.cancellation and self.gone_frames >= self.max_gone_frames:
+                self.cancellation.cancel("connection_gone")
+        except Exception as e:
+            self.logger.exception(e)
+            self.logger.error(f"Error sending WebSocket message (9013): {str(e)}")
 
 
 @tracer.capture_method
@@ -565,7 +850,33 @@ def process_attachments(
     required_image_height,
     bedrock_runtime,
     image_model_id,
+    max_workers=ATTACHMENT_MAX_WORKERS,
 ):
+    """
+    Download and prepare message attachments for a Bedrock request.
+
+    Attachments are fetched from S3 and resized/converted concurrently on a bounded
+    pool of workers, so S3 round trips overlap with image processing. Results keep
+    the order of the input. The first failing attachment (in input order) stops the
+    pipeline, and the attachments before it are returned with the error message.
+
+    Args:
+        attachments (list): The attachments sent by the client.
+        user_id (str): The user the attachments belong to.
+        session_id (str): The session the attachments were uploaded for.
+        attachment_bucket (str): The bucket holding the uploaded attachments.
+        logger (logging.Logger): A logger object for logging messages and errors.
+        s3_client (boto3.client): An initialized Boto3 S3 client.
+        allowed_document_types (list): Allowed document file types.
+        required_image_width (int): Width images must have, 0 to keep the original.
+        required_image_height (int): Height images must have, 0 to keep the original.
+        bedrock_runtime (boto3.client): Bedrock runtime client, used for outpainting.
+        image_model_id (str): Image model used to extend images, if needed.
+        max_workers (int): Maximum number of attachments processed at the same time.
+
+    Returns:
+        tuple: (processed_attachments: list, error_message: str)
+    """
     processed_attachments = []
     error_message = ""
     for attachment in attachments:
@@ -579,57 +890,100 @@ def process_attachments(
         ):
             error_message += f"Invalid file type: {file_type}. Allowed types are images, videos and {', '.join(allowed_document_types)}."
             return processed_attachments, error_message
-
-        # Download file from S3
-        if attachment["type"].startswith("video/"):
-            file_key = attachment["url"].split("/")[-1]
-            if file_key:
-                tracer.put_annotation(key="FileName", value=file_key)
-            file_content = None
-        else:
-            try:
-                file_key = attachment["url"].split("/")[-1]
-                if file_key:
-                    tracer.put_annotation(key="FileName", value=file_key)
-                response = s3_client.get_object(
-                    Bucket=attachment_bucket, Key=f"{user_id}/{session_id}/{file_key}"
-                )
-                file_content = response["Body"].read()
-            except Exception as e:
-                logger.exception(e)
-                logger.error(f"Error downloading file from S3: {str(e)}")
-                error_message += f"Error processing attachment: {attachment['name']}"
-                return processed_attachments, error_message
-        if attachment["type"].startswith("image/"):
-            if pil_available:
-                file_content, file_was_modified = resize_image_if_needed(
-                    file_content,
-                    required_image_width,
-                    required_image_height,
-                    bedrock_runtime,
-                    logger,
-                    image_model_id,
-                )
-                file_content = convert_image_to_png(file_content, logger)
-                if file_key:
-                    tracer.put_annotation(key="FileName", value=file_key)
-                attachment["name"] = (
-                    f"{attachment['name'].rsplit('.', 1)[0].replace(' ', '_')}.png"
-                )
-                attachment["type"] = "image/png"
-
-        processed_attachments.append(
-            {
-                "type": attachment["type"],
-                "name": attachment["name"],
-                "s3bucket": attachment_bucket,
-                "s3key": f"{user_id}/{session_id}/{file_key}",
-                "content": file_content,
-            }
-        )
+        file_key = attachment["url"].split("/")[-1]
+        if file_key:
+            tracer.put_annotation(key="FileName", value=file_key)
+    if not attachments:
+        return processed_attachments, error_message
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(max_workers, len(attachments)))
+    ) as executor:
+        futures = [
+            executor.submit(
+                process_attachment,
+                attachment,
+                user_id,
+                session_id,
+                attachment_bucket,
+                logger,
+                s3_client,
+                required_image_width,
+                required_image_height,
+                bedrock_runtime,
+                image_model_id,
+            )
+            for attachment in attachments
+        ]
+        try:
+            for attachment, future in zip(attachments, futures):
+                processed_attachment = future.result()
+                if processed_attachment is None:
+                    error_message += (
+                        f"Error processing attachment: {attachment['name']}"
+                    )
+                    return processed_attachments, error_message
+                processed_attachments.append(processed_attachment)
+        finally:
+            # fail fast: attachments that have not started yet are not needed anymore
+            for future in futures:
+                future.cancel()
     return processed_attachments, error_message
 
 
+def process_attachment(
+    attachment,
+    user_id,
+    session_id,
+    attachment_bucket,
+    logger,
+    s3_client,
+    required_image_width,
+    required_image_height,
+    bedrock_runtime,
+    image_model_id,
+):
+    """Downloads and prepares a single attachment, returns None if it could not be downloaded"""
+    file_key = attachment["url"].split("/")[-1]
+    s3_key = f"{user_id}/{session_id}/{file_key}"
+    name = attachment["name"]
+    content_type = attachment["type"]
+    # Download file from S3
+    if content_type.startswith("video/"):
+        file_content = None
+    else:
+        try:
+            response = s3_client.get_object(Bucket=attachment_bucket, Key=s3_key)
+            file_content = response["Body"].read()
+        except Exception as e:
+            logger.exception(e)
+            logger.error(f"Error downloading file from S3: {str(e)}")
+            return None
+    if content_type.startswith("image/"):
+        if pil_available:
+            file_content, file_was_modified = resize_image_if_needed(
+                file_content,
+                required_image_width,
+                required_image_height,
+                bedrock_runtime,
+                logger,
+                image_model_id,
+            )
+            file_content = convert_image_to_png(file_content, logger)
+            name = f"{name.rsplit('.', 1)[0].replace(' ', '_')}.png"
+            content_type = "image/png"
+            attachment["name"] = name
+            attachment["type"] = content_type
+
+    return {
+        "type": content_type,
+        "name": name,
+        "s3bucket": attachment_bucket,
+        "s3key": s3_key,
+        "content": file_content,
+    }
+
+
 @tracer.capture_method(capture_response=False)
 def resize_image_if_needed(
     file_content,
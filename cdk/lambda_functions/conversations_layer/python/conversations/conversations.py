@@ -1,14 +1,168 @@
-from typing import List, Dict
+from typing import Dict, Iterable, Iterator
+import base64
+import codecs
+import collections
+import concurrent.futures
+import gzip
+import io
 import json
+import math
+import re
+import time
+import zlib
 from datetime import datetime, timezone
-from aws_lambda_powertools import Logger
 
+# sessions whose metadata item has this history_layout keep one item per message in the messages table
+MESSAGES_HISTORY_LAYOUT = "messages"
+# idle sessions are archived to one gzipped JSON Lines object and rehydrated when opened,
+# every line is {"session_id", "user_id", "seq", "message"} so archives can be read in bulk
+ARCHIVED_HISTORY_LAYOUT = "archived"
+CONVERSATION_ARCHIVE_S3_KEY_FORMAT = "archive/{user_id}/{session_id}.jsonl.gz"
+CONVERSATION_ARCHIVE_STORAGE_CLASS = "INTELLIGENT_TIERING"
+S3_DELETE_OBJECTS_BATCH_SIZE = 1000
+# messages whose encoded size is larger than this are stored in S3 and referenced from their item
+MAX_MESSAGE_ITEM_BYTES = 350 * 1024
+# messages too large for an item are packed into one immutable segment object per write,
+# their items keep the byte range so a single message is read with a ranged GET
+MESSAGE_SEGMENT_S3_KEY_FORMAT = "{user_id}/{session_id}/segments/{first_seq:010d}.bin"
+# messages sent per page on load, older pages are requested with load_more and a cursor
+CONVERSATION_PAGE_MESSAGES = 50
+DYNAMODB_BATCH_WRITE_SIZE = 25
+DYNAMODB_BATCH_WRITE_ATTEMPTS = 5
+# a turn stored concurrently by another request is re-read this many times before giving up
+APPEND_CONFLICT_ATTEMPTS = 5
+# a message claimed for a session is in progress until it is completed or failed, a claim
+# still in progress after this long (the lambda timeout) was abandoned
+IN_FLIGHT_IN_PROGRESS = "in_progress"
+IN_FLIGHT_COMPLETED = "completed"
+IN_FLIGHT_FAILED = "failed"
+IN_FLIGHT_MARKER_SECONDS = 900
+# claims are removed by the table's expires_at TTL after this long
+IN_FLIGHT_RETENTION_SECONDS = 24 * 60 * 60
+# stop requests of answers that had already finished expire through the table's expires_at TTL
+STOP_REQUEST_RETENTION_SECONDS = 24 * 60 * 60
+# a deleted session leaves a tombstone in the list index so delta syncs can drop it,
+# tombstones expire through the table's expires_at TTL after the retention period
+CONVERSATION_TOMBSTONE_SUFFIX = "#deleted"
+CONVERSATION_TOMBSTONE_RETENTION_SECONDS = 30 * 24 * 60 * 60
+# encoded history starts with this magic, a format version and a codec id
+HISTORY_CODEC_MAGIC = b"CH"
+HISTORY_CODEC_VERSION = 1
+HISTORY_CODEC_JSON = 0
+HISTORY_CODEC_ZLIB = 1
+# smaller payloads are stored as plain JSON, compressing them saves nothing
+HISTORY_COMPRESSION_MIN_BYTES = 256
+# bytes read from an S3 history body at a time while its messages are parsed
+HISTORY_STREAM_READ_BYTES = 64 * 1024
+# bytes a history chunk may take in a websocket frame, leaving room for the frame's other fields
+HISTORY_FRAME_MAX_BYTES = 31744
+# the search index holds one posting per (user, term, session), keyed "{user_id}#{term}"
+SEARCH_TERM_PATTERN = re.compile(r"[^\W_]{2,40}")
+SEARCH_STOPWORDS = frozenset(
+    "a an and are as at be but by can do for from has have how i if in is it its me my "
+    "no not of on or our so that the their them then there these they this to was we "
+    "what when where which who why will with you your".split()
+)
+# only the most frequent terms of a turn are indexed, bounding the writes per turn
+SEARCH_MAX_TERMS_PER_TURN = 200
+# a title term counts as this many occurrences in the session
+SEARCH_TITLE_TERM_WEIGHT = 3
+SEARCH_SNIPPET_CHARS = 160
+SEARCH_MAX_QUERY_TERMS = 8
+SEARCH_RESULTS_LIMIT = 20
+# keys-only index of the postings by session, read to delete a session's postings
+SEARCH_SESSION_INDEX_NAME = "session_id-index"
+# the conversation list index, counted for the number of sessions a term's idf is based on
+CONVERSATION_LIST_INDEX = "user_id-list-index"
+# keys-only index of the embeddings by session, read to delete a session's embeddings
+EMBEDDING_SESSION_INDEX_NAME = "session_id-index"
+# a deleted session leaves a tombstone among the user's embeddings, so containers caching
+# the user's matrix drop its rows on their next sync, it expires through the expires_at TTL
+EMBEDDING_TOMBSTONE_RETENTION_SECONDS = 7 * 24 * 60 * 60
+SEARCH_INDEX_WORKERS = 8
+# stored turns are indexed by a queue consumer, these tell its two kinds of queued turns apart
+TURN_INDEX_KIND_SEARCH = "search"
+TURN_INDEX_KIND_EMBEDDING = "embedding"
+# characters of each message queued for the search index, keeping a turn within one SQS message
+SEARCH_INDEX_TEXT_MAX_CHARS = 16000
+DYNAMODB_BATCH_GET_SIZE = 100
+# metadata attributes returned with every search result, the same fields the conversation list has
+SEARCH_RESULT_ATTRIBUTES = (
+    "session_id",
+    "user_id",
+    "title",
+    "selected_model_id",
+    "selected_model_name",
+    "last_modified_date",
+    "category",
+    "kb_session_id",
+    "selected_knowledgebase_id",
+    "flow_id",
+    "flow_alias_id",
+    "selected_agent_id",
+    "selected_agent_alias_id",
+    "conversation_history_in_s3",
+    "last_message_id",
+)
 
-def delete_conversation_history(dynamodb, conversations_table_name, logger, session_id):
-    """Function to delete conversation history from DDB"""
+
+def delete_conversation_history(
+    dynamodb,
+    conversations_table_name,
+    logger,
+    session_id,
+    messages_table_name=None,
+    user_id=None,
+    s3_client=None,
+    conversation_history_bucket=None,
+    search_index_table_name=None,
+    embeddings_table_name=None,
+):
+    """Function to delete conversation history from DDB
+
+    When the owner is given, a tombstone is written so clients syncing their conversation
+    list with a since watermark learn about the deletion. The archive of an archived
+    session is deleted when the S3 client and bucket are given, its search postings and
+    embeddings when their tables are given.
+    """
     try:
+        response = dynamodb.delete_item(
+            TableName=conversations_table_name,
+            Key={"session_id": {"S": session_id}},
+            ReturnValues="ALL_OLD",
+        )
+        archive_s3_key = response.get("Attributes", {}).get("archive_s3_key")
+        if archive_s3_key and s3_client and conversation_history_bucket:
+            s3_client.delete_object(
+                Bucket=conversation_history_bucket, Key=archive_s3_key["S"]
+            )
+        if user_id:
+            now = datetime.now(tz=timezone.utc).timestamp()
+            dynamodb.put_item(
+                TableName=conversations_table_name,
+                Item={
+                    "session_id": {"S": f"{session_id}{CONVERSATION_TOMBSTONE_SUFFIX}"},
+                    "user_id": {"S": user_id},
+                    "last_modified_date": {"N": str(now)},
+                    "expires_at": {
+                        "N": str(int(now + CONVERSATION_TOMBSTONE_RETENTION_SECONDS))
+                    },
+                },
+            )
+        if messages_table_name:
+            delete_conversation_messages(dynamodb, messages_table_name, session_id)
+        if search_index_table_name:
+            delete_search_postings(dynamodb, search_index_table_name, session_id)
+        if embeddings_table_name and user_id:
+            delete_conversation_embeddings(
+                dynamodb, embeddings_table_name, user_id, session_id
+            )
+        if user_id:
+            clear_generation_stop(
+                dynamodb, conversations_table_name, session_id, user_id
+            )
         dynamodb.delete_item(
-            TableName=conversations_table_name, Key={"session_id": {"S": session_id}}
+            TableName=conversations_table_name, Key=get_in_flight_key(session_id)
         )
         logger.info(f"Conversation history deleted for session ID: {session_id}")
     except Exception as e:
@@ -16,75 +170,1576 @@ def delete_conversation_history(dynamodb, conversations_table_name, logger, sess
         logger.error(f"Error deleting conversation history (9781): {str(e)}")
 
 
-def send_conversation_history_to_web_client(
-    conversation_history,
+def get_stop_request_key(session_id, user_id):
+    """Key of the item that holds a user's request to stop generating in a session"""
+    return {"session_id": {"S": f"{session_id}#stop#{user_id}"}}
+
+
+def request_generation_stop(
+    dynamodb, conversations_table_name, session_id, user_id, message_id=None
+):
+    """
+    Records that the client wants the answer to message_id in a session to stop.
+
+    The put is conditional on the session belonging to the user, or not being stored
+    yet while its first answer is generated. Every user has their own stop item, so a
+    pending stop of the owner cannot be replaced by anyone else. The item has no user_id
+    or last_modified_date, so it never shows up in the conversation list index.
+
+    Returns:
+        bool: False if the session belongs to another user.
+    """
+    now = datetime.now(tz=timezone.utc).timestamp()
+    item = {
+        **get_stop_request_key(session_id, user_id),
+        "stop_requested_by": {"S": user_id},
+        "stop_requested_at": {"N": str(now)},
+        "expires_at": {"N": str(int(now + STOP_REQUEST_RETENTION_SECONDS))},
+    }
+    if message_id:
+        item["message_id"] = {"S": message_id}
+    try:
+        dynamodb.transact_write_items(
+            TransactItems=[
+                {
+                    "ConditionCheck": {
+                        "TableName": conversations_table_name,
+                        "Key": {"session_id": {"S": session_id}},
+                        "ConditionExpression": "attribute_not_exists(session_id) OR user_id = :user_id",
+                        "ExpressionAttributeValues": {":user_id": {"S": user_id}},
+                    }
+                },
+                {"Put": {"TableName": conversations_table_name, "Item": item}},
+            ]
+        )
+    except dynamodb.exceptions.TransactionCanceledException:
+        return False
+    return True
+
+
+def is_generation_stop_requested(
+    dynamodb, conversations_table_name, session_id, user_id, message_id, sent_at
+):
+    """
+    Returns True if the session's owner asked to stop the answer to message_id.
+
+    A stop request without a message id, sent by an older client, counts when it was
+    made after sent_at, the time the client sent the message. Either way a stop pressed
+    before the worker started streaming is honoured.
+    """
+    response = dynamodb.get_item(
+        TableName=conversations_table_name,
+        Key=get_stop_request_key(session_id, user_id),
+        ConsistentRead=True,
+    )
+    item = response.get("Item")
+    if not item:
+        return False
+    if "message_id" in item:
+        return item["message_id"]["S"] == message_id
+    return float(item["stop_requested_at"]["N"]) >= sent_at
+
+
+def clear_generation_stop(dynamodb, conversations_table_name, session_id, user_id):
+    """Removes a user's stop request for a session once it was handled"""
+    dynamodb.delete_item(
+        TableName=conversations_table_name,
+        Key=get_stop_request_key(session_id, user_id),
+    )
+
+
+def get_in_flight_key(session_id):
+    """Key of the item that holds the message id last submitted to a session"""
+    return {"session_id": {"S": f"{session_id}#inflight"}}
+
+
+def claim_in_flight_message(
+    dynamodb, conversations_table_name, session_id, message_id, request_id=None
+):
+    """
+    Claims a submitted message before any model is called for it.
+
+    Returns False when the same message id was already answered, or is still being
+    answered by another request, so a double-send or a redelivered request is answered
+    once. A claim that failed, or that is in progress for longer than
+    IN_FLIGHT_MARKER_SECONDS, can be taken over. So can a claim made with the same
+    request_id, the Lambda request id, which is kept when Lambda retries an invocation
+    that timed out or crashed. A different message id replaces the claim, concurrent
+    turns are merged on write.
+    """
+    if not message_id:
+        return True
+    now = datetime.now(tz=timezone.utc).timestamp()
+    condition = (
+        "attribute_not_exists(session_id) OR message_id <> :message_id "
+        "OR #status = :failed OR (#status = :in_progress AND claimed_at < :expired_before)"
+    )
+    values = {
+        ":message_id": {"S": message_id},
+        ":failed": {"S": IN_FLIGHT_FAILED},
+        ":in_progress": {"S": IN_FLIGHT_IN_PROGRESS},
+        ":expired_before": {"N": str(now - IN_FLIGHT_MARKER_SECONDS)},
+    }
+    item = {
+        **get_in_flight_key(session_id),
+        "message_id": {"S": message_id},
+        "status": {"S": IN_FLIGHT_IN_PROGRESS},
+        "claimed_at": {"N": str(now)},
+        "expires_at": {"N": str(int(now + IN_FLIGHT_RETENTION_SECONDS))},
+    }
+    if request_id:
+        condition += " OR (#status = :in_progress AND request_id = :request_id)"
+        values[":request_id"] = {"S": request_id}
+        item["request_id"] = {"S": request_id}
+    try:
+        dynamodb.put_item(
+            TableName=conversations_table_name,
+            Item=item,
+            ConditionExpression=condition,
+            ExpressionAttributeNames={"#status": "status"},
+            ExpressionAttributeValues=values,
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+    return True
+
+
+def finish_in_flight_message(
+    dynamodb, conversations_table_name, session_id, message_id, status
+):
+    """
+    Marks a claimed message completed, or failed so that a resend is answered again.
+
+    The claim is left alone when a newer message of the session replaced it.
+    """
+    if not message_id:
+        return
+    try:
+        dynamodb.update_item(
+            TableName=conversations_table_name,
+            Key=get_in_flight_key(session_id),
+            UpdateExpression="SET #status = :status, finished_at = :now",
+            ConditionExpression="message_id = :message_id",
+            ExpressionAttributeNames={"#status": "status"},
+            ExpressionAttributeValues={
+                ":status": {"S": status},
+                ":now": {"N": str(datetime.now(tz=timezone.utc).timestamp())},
+                ":message_id": {"S": message_id},
+            },
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        pass
+
+
+def encode_history(value):
+    """
+    Encodes a message or a history list for storage in a Binary attribute or S3 object.
+
+    Args:
+        value (dict | list): The message or history to encode.
+
+    Returns:
+        bytes: A 4 byte header (magic, version, codec id) followed by the payload.
+    """
+    payload = json.dumps(value, separators=(",", ":")).encode("utf-8")
+    codec = HISTORY_CODEC_JSON
+    if len(payload) >= HISTORY_COMPRESSION_MIN_BYTES:
+        compressed = zlib.compress(payload, 6)
+        if len(compressed) < len(payload):
+            payload = compressed
+            codec = HISTORY_CODEC_ZLIB
+    return HISTORY_CODEC_MAGIC + bytes([HISTORY_CODEC_VERSION, codec]) + payload
+
+
+def decode_history(data):
+    """
+    Decodes stored history, accepting both encode_history output and plain UTF-8 JSON.
+
+    Args:
+        data (bytes): The stored bytes.
+
+    Returns:
+        dict | list: The decoded message or history.
+
+    Raises:
+        ValueError: If the header names an unknown version or codec.
+    """
+    if not data.startswith(HISTORY_CODEC_MAGIC):
+        # stored before the codec existed
+        return json.loads(data.decode("utf-8"))
+    version, codec = data[2], data[3]
+    if version != HISTORY_CODEC_VERSION:
+        raise ValueError(f"Unsupported history codec version: {version}")
+    payload = data[4:]
+    if codec == HISTORY_CODEC_ZLIB:
+        payload = zlib.decompress(payload)
+    elif codec != HISTORY_CODEC_JSON:
+        raise ValueError(f"Unsupported history codec: {codec}")
+    return json.loads(payload.decode("utf-8"))
+
+
+def read_history_stream(body, read_size=HISTORY_STREAM_READ_BYTES):
+    """Yields the decoded UTF-8 JSON text of an encoded history body as it is read"""
+    header = b""
+    while len(header) < len(HISTORY_CODEC_MAGIC) + 2:
+        data = body.read(len(HISTORY_CODEC_MAGIC) + 2 - len(header))
+        if not data:
+            break
+        header += data
+    decompressor = None
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    if header.startswith(HISTORY_CODEC_MAGIC) and len(header) == 4:
+        version, codec = header[2], header[3]
+        if version != HISTORY_CODEC_VERSION:
+            raise ValueError(f"Unsupported history codec version: {version}")
+        if codec == HISTORY_CODEC_ZLIB:
+            decompressor = zlib.decompressobj()
+        elif codec != HISTORY_CODEC_JSON:
+            raise ValueError(f"Unsupported history codec: {codec}")
+    else:
+        # stored before the codec existed
+        yield text_decoder.decode(header)
+    while True:
+        data = body.read(read_size)
+        if not data:
+            break
+        if decompressor:
+            data = decompressor.decompress(data)
+        yield text_decoder.decode(data)
+    if decompressor:
+        yield text_decoder.decode(decompressor.flush())
+    yield text_decoder.decode(b"", final=True)
+
+
+def iter_history_stream(body, read_size=HISTORY_STREAM_READ_BYTES):
+    """
+    Yields the messages of an encoded history list while its body is downloaded.
+
+    Only the unparsed text after the last complete message is held in memory, so the
+    memory used depends on the largest message rather than on the whole history.
+
+    Args:
+        body (StreamingBody): The body of an S3 history object (encode_history output
+            or plain UTF-8 JSON).
+        read_size (int): Bytes read from the body at a time.
+
+    Raises:
+        ValueError: If the body is not a JSON list or uses an unknown codec.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    started = False
+    # a message cut off by the end of the buffer is parsed again once the buffer has doubled
+    retry_length = 0
+    text_chunks = read_history_stream(body, read_size)
+    exhausted = False
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position < len(buffer) and len(buffer) >= retry_length:
+            if not started:
+                if buffer[position] != "[":
+                    raise ValueError("Conversation history is not a JSON list")
+                started = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                message, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+                retry_length = 2 * len(buffer)
+            else:
+                retry_length = 0
+                yield message
+                continue
+        if exhausted:
+            raise ValueError("Conversation history ended before the end of its list")
+        text = next(text_chunks, None)
+        if text is None:
+            exhausted = True
+            retry_length = 0
+            continue
+        buffer = buffer[position:] + text
+        retry_length = max(retry_length - position, 0)
+        position = 0
+
+
+def query_message_items(dynamodb, messages_table_name, session_id, **query_args):
+    """Yields the message items of a session in sequence order, following every page"""
+    query_params = {
+        "TableName": messages_table_name,
+        "KeyConditionExpression": "session_id = :session_id",
+        "ExpressionAttributeValues": {":session_id": {"S": session_id}},
+        **query_args,
+    }
+    while True:
+        response = dynamodb.query(**query_params)
+        yield from response.get("Items", [])
+        last_evaluated_key = response.get("LastEvaluatedKey")
+        if not last_evaluated_key:
+            return
+        query_params["ExclusiveStartKey"] = last_evaluated_key
+
+
+def iter_conversation_messages(
+    dynamodb, messages_table_name, s3_client, conversation_history_bucket, session_id
+):
+    """Yields every message of a session stored one item per message, oldest first"""
+    for item in query_message_items(
+        dynamodb, messages_table_name, session_id, ConsistentRead=True
+    ):
+        yield decode_message_item(item, s3_client, conversation_history_bucket)
+
+
+def load_conversation_messages(
+    dynamodb, messages_table_name, s3_client, conversation_history_bucket, session_id
+):
+    """Loads every message of a session stored one item per message, oldest first"""
+    return list(
+        iter_conversation_messages(
+            dynamodb,
+            messages_table_name,
+            s3_client,
+            conversation_history_bucket,
+            session_id,
+        )
+    )
+
+
+def load_conversation_messages_page(
+    dynamodb,
+    messages_table_name,
+    s3_client,
+    conversation_history_bucket,
+    session_id,
+    limit,
+    before_seq=None,
+):
+    """
+    Loads the newest messages of a session, or the messages older than before_seq.
+
+    Only the items of the page are read, and only the byte ranges of the segments
+    holding its spilled messages are downloaded.
+
+    Args:
+        dynamodb (boto3.client): DynamoDB client.
+        messages_table_name (str): Table holding one item per message (session_id, seq).
+        s3_client (boto3.client): S3 client for spilled messages.
+        conversation_history_bucket (str): Bucket holding spilled messages.
+        session_id (str): The session to read.
+        limit (int): The maximum number of messages to return.
+        before_seq (int): Only messages with a lower sequence number are returned.
+
+    Returns:
+        tuple: A tuple containing:
+            - list: The messages of the page, oldest first
+            - int: The before_seq of the next older page, or None when there is none
+    """
+    key_condition = "session_id = :session_id"
+    values = {":session_id": {"S": session_id}}
+    if before_seq is not None:
+        key_condition += " AND seq < :before_seq"
+        values[":before_seq"] = {"N": str(before_seq)}
+    response = dynamodb.query(
+        TableName=messages_table_name,
+        KeyConditionExpression=key_condition,
+        ExpressionAttributeValues=values,
+        ScanIndexForward=False,
+        Limit=limit,
+        ConsistentRead=True,
+    )
+    items = list(reversed(response.get("Items", [])))
+    messages = [
+        decode_message_item(item, s3_client, conversation_history_bucket)
+        for item in items
+    ]
+    oldest_seq = int(items[0]["seq"]["N"]) if items else 0
+    return messages, (oldest_seq if oldest_seq > 0 else None)
+
+
+def get_history_page(conversation_messages, limit, before_seq=None):
+    """
+    Returns the newest messages of a history blob, or the messages before before_seq.
+
+    Messages are numbered by their position, which is the seq they get as message items,
+    so a cursor stays valid when the session is migrated between two pages. Only the page
+    is held in memory, and reading stops once the page is complete.
+
+    Args:
+        conversation_messages (iterable): Every message of the session, oldest first.
+        limit (int): The maximum number of messages to return.
+        before_seq (int): Only messages with a lower position are returned.
+
+    Returns:
+        tuple: A tuple containing:
+            - list: The messages of the page, oldest first
+            - int: The before_seq of the next older page, or None when there is none
+    """
+    if before_seq is None:
+        page = collections.deque(maxlen=limit)
+        message_count = 0
+        for message in conversation_messages:
+            page.append(message)
+            message_count += 1
+        first_seq = message_count - len(page)
+        return list(page), (first_seq if first_seq > 0 else None)
+    first_seq = max(0, before_seq - limit)
+    page = []
+    for seq, message in enumerate(conversation_messages):
+        if seq >= before_seq:
+            break
+        if seq >= first_seq:
+            page.append(message)
+    return page, (first_seq if page and first_seq > 0 else None)
+
+
+def encode_history_cursor(before_seq):
+    """Returns the opaque cursor a client sends back to load the page before before_seq"""
+    if before_seq is None:
+        return None
+    cursor = json.dumps({"before_seq": before_seq}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(cursor.encode("utf-8")).decode("ascii")
+
+
+def decode_history_cursor(cursor):
+    """
+    Returns the before_seq of a cursor from encode_history_cursor.
+
+    Raises:
+        ValueError: If the cursor was not created by encode_history_cursor.
+    """
+    try:
+        before_seq = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))[
+            "before_seq"
+        ]
+    except (AttributeError, TypeError, KeyError, UnicodeError, ValueError) as e:
+        raise ValueError(f"Invalid history cursor: {cursor}") from e
+    if not isinstance(before_seq, int) or before_seq <= 0:
+        raise ValueError(f"Invalid history cursor: {cursor}")
+    return before_seq
+
+
+def decode_message_item(item, s3_client, conversation_history_bucket):
+    """Returns the message stored in a messages table item"""
+    if "message_data" in item:
+        return decode_history(item["message_data"]["B"])
+    if "s3_key" in item:
+        get_object_args = {
+            "Bucket": conversation_history_bucket,
+            "Key": item["s3_key"]["S"],
+        }
+        if "s3_offset" in item:
+            offset = int(item["s3_offset"]["N"])
+            length = int(item["s3_length"]["N"])
+            get_object_args["Range"] = f"bytes={offset}-{offset + length - 1}"
+        response = s3_client.get_object(**get_object_args)
+        return decode_history(response["Body"].read())
+    return json.loads(item["message"]["S"])
+
+
+def build_message_items(
+    session_id, user_id, first_seq, messages, s3_client, conversation_history_bucket
+):
+    """
+    Builds the messages table items for consecutive messages of a session.
+
+    Messages whose encoded size is too large for an item are written together as one
+    segment object, and their items hold the segment key and their byte range in it.
+
+    Returns:
+        list: The items, in sequence order.
+    """
+    items = []
+    segment = bytearray()
+    segment_key = MESSAGE_SEGMENT_S3_KEY_FORMAT.format(
+        user_id=user_id, session_id=session_id, first_seq=first_seq
+    )
+    for seq, message in enumerate(messages, start=first_seq):
+        message_data = encode_history(message)
+        item = {"session_id": {"S": session_id}, "seq": {"N": str(seq)}}
+        if message.get("message_id"):
+            item["message_id"] = {"S": message["message_id"]}
+        if len(message_data) > MAX_MESSAGE_ITEM_BYTES:
+            item["s3_key"] = {"S": segment_key}
+            item["s3_offset"] = {"N": str(len(segment))}
+            item["s3_length"] = {"N": str(len(message_data))}
+            segment += message_data
+        else:
+            item["message_data"] = {"B": message_data}
+        items.append(item)
+    if segment:
+        s3_client.put_object(
+            Bucket=conversation_history_bucket, Key=segment_key, Body=bytes(segment)
+        )
+    return items
+
+
+def batch_write_message_requests(dynamodb, messages_table_name, write_requests):
+    """Runs put or delete requests against a table in batches, retrying unprocessed items"""
+    for start in range(0, len(write_requests), DYNAMODB_BATCH_WRITE_SIZE):
+        request_items = {
+            messages_table_name: write_requests[
+                start : start + DYNAMODB_BATCH_WRITE_SIZE
+            ]
+        }
+        for attempt in range(DYNAMODB_BATCH_WRITE_ATTEMPTS):
+            response = dynamodb.batch_write_item(RequestItems=request_items)
+            request_items = response.get("UnprocessedItems")
+            if not request_items:
+                break
+            time.sleep(0.05 * 2**attempt)
+        else:
+            raise RuntimeError(
+                f"Unprocessed message writes after {DYNAMODB_BATCH_WRITE_ATTEMPTS} attempts"
+            )
+
+
+def delete_conversation_messages(dynamodb, messages_table_name, session_id):
+    """Deletes every message item of a session"""
+    write_requests = [
+        {
+            "DeleteRequest": {
+                "Key": {"session_id": item["session_id"], "seq": item["seq"]}
+            }
+        }
+        for item in query_message_items(
+            dynamodb,
+            messages_table_name,
+            session_id,
+            ProjectionExpression="session_id, seq",
+        )
+    ]
+    batch_write_message_requests(dynamodb, messages_table_name, write_requests)
+
+
+def delete_conversation_message_seqs(
+    dynamodb, messages_table_name, session_id, message_count
+):
+    """Deletes the message items of a session with a seq below message_count"""
+    batch_write_message_requests(
+        dynamodb,
+        messages_table_name,
+        [
+            {
+                "DeleteRequest": {
+                    "Key": {"session_id": {"S": session_id}, "seq": {"N": str(seq)}}
+                }
+            }
+            for seq in range(message_count)
+        ],
+    )
+
+
+def message_has_attachments(message):
+    """Returns True if a stored message has a content block that points to an S3 attachment"""
+    content = message.get("content")
+    if not isinstance(content, list):
+        return False
+    return any(
+        isinstance(block, dict) and "s3source" in block
+        for item in content
+        if isinstance(item, dict)
+        for block in item.values()
+    )
+
+
+def encode_conversation_archive(session_id, user_id, messages):
+    """Returns a session's messages as gzipped JSON Lines, one message per line"""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", mtime=0) as archive:
+        for seq, message in enumerate(messages):
+            row = {
+                "session_id": session_id,
+                "user_id": user_id,
+                "seq": seq,
+                "message": message,
+            }
+            archive.write(json.dumps(row, separators=(",", ":")).encode("utf-8"))
+            archive.write(b"\n")
+    return buffer.getvalue()
+
+
+def iter_conversation_archive(body, read_size=HISTORY_STREAM_READ_BYTES):
+    """Yields the rows of a gzipped JSON Lines archive as it is read"""
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    pending = b""
+    while True:
+        data = body.read(read_size)
+        if not data:
+            break
+        lines = (pending + decompressor.decompress(data)).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            if line:
+                yield json.loads(line)
+    pending += decompressor.flush()
+    if pending.strip():
+        yield json.loads(pending)
+
+
+def iter_stored_history(
+    dynamodb,
+    messages_table_name,
+    s3_client,
+    conversation_history_bucket,
+    session_id,
+    user_id,
+    item,
+):
+    """Yields the messages of a session that is not archived, whichever way it is stored"""
+    if item.get("history_layout", {}).get("S") == MESSAGES_HISTORY_LAYOUT:
+        return iter_conversation_messages(
+            dynamodb,
+            messages_table_name,
+            s3_client,
+            conversation_history_bucket,
+            session_id,
+        )
+    if item.get("conversation_history_in_s3", {}).get("BOOL", False):
+        response = s3_client.get_object(
+            Bucket=conversation_history_bucket,
+            Key=f"{user_id}/{session_id}/{session_id}.json",
+        )
+        return iter_history_stream(response["Body"])
+    if "conversation_history" in item:
+        return iter(json.loads(item["conversation_history"]["S"]))
+    return iter([])
+
+
+def delete_s3_objects(s3_client, bucket, keys):
+    """Deletes S3 objects in batches of S3_DELETE_OBJECTS_BATCH_SIZE"""
+    keys = list(keys)
+    for start in range(0, len(keys), S3_DELETE_OBJECTS_BATCH_SIZE):
+        s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={
+                "Objects": [
+                    {"Key": key}
+                    for key in keys[start : start + S3_DELETE_OBJECTS_BATCH_SIZE]
+                ],
+                "Quiet": True,
+            },
+        )
+
+
+def get_last_activity(item):
+    """Returns when a session was last written or rehydrated, as a UTC timestamp"""
+    return max(
+        float(item.get("last_modified_date", {}).get("N", "0")),
+        float(item.get("last_opened_date", {}).get("N", "0")),
+    )
+
+
+def archive_idle_conversation(
+    dynamodb,
+    conversations_table_name,
+    messages_table_name,
+    s3_client,
+    conversation_history_bucket,
+    session_id,
+    idle_before,
+):
+    """
+    Moves the history of a session idle since before idle_before to an S3 archive.
+
+    The metadata item keeps the conversation list fields and becomes a stub pointing to
+    the archive, the message items, oversized message segments and history blobs are
+    deleted. A session written while it is archived keeps its history, the archive
+    object is then dropped again.
+
+    Returns:
+        bool: True if the session was archived.
+    """
+    item = dynamodb.get_item(
+        TableName=conversations_table_name,
+        Key={"session_id": {"S": session_id}},
+        ConsistentRead=True,
+    ).get("Item")
+    if (
+        not item
+        or "user_id" not in item
+        or "last_modified_date" not in item
+        or item.get("history_layout", {}).get("S") == ARCHIVED_HISTORY_LAYOUT
+        or get_last_activity(item) >= idle_before
+    ):
+        return False
+    user_id = item["user_id"]["S"]
+    is_messages_layout = (
+        item.get("history_layout", {}).get("S") == MESSAGES_HISTORY_LAYOUT
+    )
+    segment_keys = set()
+    if is_messages_layout:
+        segment_keys = {
+            message_item["s3_key"]["S"]
+            for message_item in query_message_items(
+                dynamodb,
+                messages_table_name,
+                session_id,
+                ProjectionExpression="s3_key",
+            )
+            if "s3_key" in message_item
+        }
+    messages = list(
+        iter_stored_history(
+            dynamodb,
+            messages_table_name,
+            s3_client,
+            conversation_history_bucket,
+            session_id,
+            user_id,
+            item,
+        )
+    )
+    if not messages:
+        return False
+    if is_messages_layout and len(messages) != int(item["message_count"]["N"]):
+        # a turn claimed its sequence numbers but its message items are not all written yet
+        return False
+    archive_s3_key = CONVERSATION_ARCHIVE_S3_KEY_FORMAT.format(
+        user_id=user_id, session_id=session_id
+    )
+    s3_client.put_object(
+        Bucket=conversation_history_bucket,
+        Key=archive_s3_key,
+        Body=encode_conversation_archive(session_id, user_id, messages),
+        ContentType="application/gzip",
+        StorageClass=CONVERSATION_ARCHIVE_STORAGE_CLASS,
+    )
+    try:
+        # a turn stored or a rehydration since the read changes the dates and fails the condition
+        dynamodb.update_item(
+            TableName=conversations_table_name,
+            Key={"session_id": {"S": session_id}},
+            UpdateExpression="SET history_layout = :archived, archive_s3_key = :archive_s3_key, "
+            "archived_at = :now, message_count = :message_count, "
+            "conversation_history_in_s3 = :false REMOVE conversation_history",
+            ConditionExpression="last_modified_date = :last_modified_date AND "
+            "(attribute_not_exists(last_opened_date) OR last_opened_date = :last_opened_date)",
+            ExpressionAttributeValues={
+                ":archived": {"S": ARCHIVED_HISTORY_LAYOUT},
+                ":archive_s3_key": {"S": archive_s3_key},
+                ":now": {"N": str(datetime.now(tz=timezone.utc).timestamp())},
+                ":message_count": {"N": str(len(messages))},
+                ":false": {"BOOL": False},
+                ":last_modified_date": item["last_modified_date"],
+                ":last_opened_date": item.get("last_opened_date", {"N": "0"}),
+            },
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        s3_client.delete_object(Bucket=conversation_history_bucket, Key=archive_s3_key)
+        return False
+    if is_messages_layout:
+        # only the archived messages, appends wait for the rehydration once the stub is written
+        delete_conversation_message_seqs(
+            dynamodb, messages_table_name, session_id, len(messages)
+        )
+    if item.get("conversation_history_in_s3", {}).get("BOOL", False):
+        segment_keys.add(f"{user_id}/{session_id}/{session_id}.json")
+    delete_s3_objects(s3_client, conversation_history_bucket, segment_keys)
+    return True
+
+
+def rehydrate_archived_conversation(
+    dynamodb,
+    conversations_table_name,
+    messages_table_name,
+    s3_client,
+    conversation_history_bucket,
+    session_id,
+    user_id,
+    archive_s3_key,
+):
+    """
+    Restores an archived session to one item per message and drops its archive.
+
+    The messages are written before the metadata item points to them, so a rehydration
+    that fails part way is simply repeated on the next open.
+
+    Returns:
+        int: The number of messages in the session.
+    """
+    response = s3_client.get_object(
+        Bucket=conversation_history_bucket, Key=archive_s3_key
+    )
+    messages = [row["message"] for row in iter_conversation_archive(response["Body"])]
+    batch_write_message_requests(
+        dynamodb,
+        messages_table_name,
+        [
+            {"PutRequest": {"Item": message_item}}
+            for message_item in build_message_items(
+                session_id,
+                user_id,
+                0,
+                messages,
+                s3_client,
+                conversation_history_bucket,
+            )
+        ],
+    )
+    try:
+        dynamodb.update_item(
+            TableName=conversations_table_name,
+            Key={"session_id": {"S": session_id}},
+            UpdateExpression="SET history_layout = :messages, message_count = :message_count, "
+            "last_opened_date = :now REMOVE archive_s3_key, archived_at",
+            ConditionExpression="history_layout = :archived AND archive_s3_key = :archive_s3_key",
+            ExpressionAttributeValues={
+                ":messages": {"S": MESSAGES_HISTORY_LAYOUT},
+                ":message_count": {"N": str(len(messages))},
+                ":now": {"N": str(datetime.now(tz=timezone.utc).timestamp())},
+                ":archived": {"S": ARCHIVED_HISTORY_LAYOUT},
+                ":archive_s3_key": {"S": archive_s3_key},
+            },
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        # rehydrated by a concurrent request, which also drops the archive
+        return len(messages)
+    s3_client.delete_object(Bucket=conversation_history_bucket, Key=archive_s3_key)
+    return len(messages)
+
+
+def append_conversation_messages(
+    dynamodb,
+    conversations_table_name,
+    messages_table_name,
+    s3_client,
+    conversation_history_bucket,
+    session_id,
+    user_id,
+    existing_history,
+    new_messages,
+    metadata,
+):
+    """
+    Appends messages to a session as one item each and updates the session's metadata item.
+
+    Only the new messages are written, so the cost of a turn does not grow with the
+    conversation. Sessions still stored as one history blob (in the item or in S3) are
+    migrated on their first write by storing existing_history as message items too.
+    Archived sessions are rehydrated first.
+
+    The metadata item is updated first, on the condition that message_count and
+    last_message_id are still what was read. If another turn was stored in the meantime
+    the item is read again and this turn is appended after it instead of overwriting it.
+
+    Args:
+        dynamodb (boto3.client): DynamoDB client.
+        conversations_table_name (str): Table holding one metadata item per session.
+        messages_table_name (str): Table holding one item per message (session_id, seq).
+        s3_client (boto3.client): S3 client for messages too large for an item.
+        conversation_history_bucket (str): Bucket for messages too large for an item.
+        session_id (str): The session to append to.
+        user_id (str): The owner of the session.
+        existing_history (list): The history loaded for this turn, used to migrate blob sessions.
+        new_messages (list): The messages of this turn.
+        metadata (dict): DynamoDB typed attributes to set on the metadata item (title, model, ...).
+
+    Returns:
+        int: The number of messages in the session.
+    """
+    for _ in range(APPEND_CONFLICT_ATTEMPTS):
+        response = dynamodb.get_item(
+            TableName=conversations_table_name,
+            Key={"session_id": {"S": session_id}},
+            ProjectionExpression="history_layout, message_count, last_message_id, archive_s3_key",
+            ConsistentRead=True,
+        )
+        item = response.get("Item", {})
+        if item.get("history_layout", {}).get("S") == ARCHIVED_HISTORY_LAYOUT:
+            # archived after this turn's history was loaded, restored before appending
+            rehydrate_archived_conversation(
+                dynamodb,
+                conversations_table_name,
+                messages_table_name,
+                s3_client,
+                conversation_history_bucket,
+                session_id,
+                user_id,
+                item["archive_s3_key"]["S"],
+            )
+            continue
+        migrating = item.get("history_layout", {}).get("S") != MESSAGES_HISTORY_LAYOUT
+        if migrating:
+            first_seq = 0
+            messages = list(existing_history or []) + new_messages
+            condition = "attribute_not_exists(message_count)"
+            condition_values = {}
+        else:
+            first_seq = int(item["message_count"]["N"])
+            messages = new_messages
+            # an archive written since the read changes the layout and fails the condition
+            condition = (
+                "history_layout = :messages_layout AND message_count = :expected_count"
+            )
+            condition_values = {
+                ":messages_layout": {"S": MESSAGES_HISTORY_LAYOUT},
+                ":expected_count": item["message_count"],
+            }
+            if "last_message_id" in item:
+                condition += " AND last_message_id = :expected_last_message_id"
+                condition_values[":expected_last_message_id"] = item["last_message_id"]
+
+        message_count = first_seq + len(messages)
+        attributes = {
+            **metadata,
+            "user_id": {"S": user_id},
+            "last_modified_date": {"N": str(datetime.now(tz=timezone.utc).timestamp())},
+            "history_layout": {"S": MESSAGES_HISTORY_LAYOUT},
+            "message_count": {"N": str(message_count)},
+            "conversation_history_in_s3": {"BOOL": False},
+        }
+        if any(message_has_attachments(message) for message in messages):
+            # kept at write time so loading a session never scans its history for attachments
+            attributes["has_attachments"] = {"BOOL": True}
+        names = {f"#a{index}": name for index, name in enumerate(attributes)}
+        try:
+            # claims the sequence numbers of this turn, a turn stored since the read fails the condition
+            dynamodb.update_item(
+                TableName=conversations_table_name,
+                Key={"session_id": {"S": session_id}},
+                UpdateExpression="SET "
+                + ", ".join(f"{name} = :v{name[2:]}" for name in names),
+                ConditionExpression=condition,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues={
+                    **{
+                        f":v{index}": value
+                        for index, value in enumerate(attributes.values())
+                    },
+                    **condition_values,
+                },
+            )
+        except dynamodb.exceptions.ConditionalCheckFailedException:
+            # re-read and append after the turns stored in the meantime
+            continue
+
+        batch_write_message_requests(
+            dynamodb,
+            messages_table_name,
+            [
+                {"PutRequest": {"Item": message_item}}
+                for message_item in build_message_items(
+                    session_id,
+                    user_id,
+                    first_seq,
+                    messages,
+                    s3_client,
+                    conversation_history_bucket,
+                )
+            ],
+        )
+        if migrating:
+            # the blob is only dropped once its messages are stored as items
+            dynamodb.update_item(
+                TableName=conversations_table_name,
+                Key={"session_id": {"S": session_id}},
+                UpdateExpression="REMOVE conversation_history",
+            )
+        return message_count
+    raise RuntimeError(
+        f"Conversation {session_id} kept changing while a turn was stored (9015)"
+    )
+
+
+def tokenize_search_text(text):
+    """Returns the lower-cased search terms of a text, without stopwords"""
+    return [
+        term
+        for term in SEARCH_TERM_PATTERN.findall(text.lower())
+        if term not in SEARCH_STOPWORDS
+    ]
+
+
+def get_message_search_text(message):
+    """Returns the text of a stored message that is indexed for search"""
+    content = message.get("content")
+    if isinstance(content, str):
+        # generated images and videos store their URL as content, the prompt is indexed instead
+        if message.get("isImage") or message.get("isVideo"):
+            return message.get("prompt", "")
+        return content
+    if not isinstance(content, list):
+        return ""
+    return "\n".join(
+        item["text"]
+        for item in content
+        if isinstance(item, dict) and isinstance(item.get("text"), str)
+    )
+
+
+def get_search_snippet(text, term):
+    """Returns about SEARCH_SNIPPET_CHARS characters of text around the first match of term"""
+    match = re.search(re.escape(term), text, re.IGNORECASE)
+    if not match:
+        return text[:SEARCH_SNIPPET_CHARS].strip()
+    start = max(0, match.start() - SEARCH_SNIPPET_CHARS // 2)
+    end = min(len(text), start + SEARCH_SNIPPET_CHARS)
+    snippet = " ".join(text[start:end].split())
+    return f"{'…' if start > 0 else ''}{snippet}{'…' if end < len(text) else ''}"
+
+
+def build_search_postings(title, texts):
+    """
+    Returns the postings a turn adds to the search index.
+
+    Args:
+        title (str): The session title, empty after the first turn.
+        texts (list): The search text of each message of the turn.
+
+    Returns:
+        dict: term -> {"tf": occurrences in the turn, "snippet": text around the term}
+    """
+    postings = {}
+    weighted_texts = [(text, 1) for text in texts if text]
+    if title:
+        weighted_texts.append((title, SEARCH_TITLE_TERM_WEIGHT))
+    for text, weight in weighted_texts:
+        for term in tokenize_search_text(text):
+            posting = postings.get(term)
+            if posting is None:
+                posting = postings[term] = {"tf": 0, "text": text}
+            posting["tf"] += weight
+    terms = sorted(postings, key=lambda term: postings[term]["tf"], reverse=True)
+    return {
+        term: {
+            "tf": postings[term]["tf"],
+            "snippet": get_search_snippet(postings[term]["text"], term),
+        }
+        for term in terms[:SEARCH_MAX_TERMS_PER_TURN]
+    }
+
+
+def get_search_term_key(user_id, term):
+    """Partition key of a term's postings for one user"""
+    return f"{user_id}#{term}"
+
+
+def build_turn_index_request(session_id, user_id, title, messages):
+    """Returns the queued search index request of a stored turn, only its message texts are kept"""
+    return {
+        "kind": TURN_INDEX_KIND_SEARCH,
+        "user_id": user_id,
+        "session_id": session_id,
+        "title": title or "",
+        "texts": [
+            text[:SEARCH_INDEX_TEXT_MAX_CHARS]
+            for text in map(get_message_search_text, messages)
+            if text
+        ],
+    }
+
+
+def index_conversation_turns(dynamodb, search_index_table_name, turns):
+    """
+    Adds a batch of stored turns to their owners' search indexes.
+
+    Each term of a turn's messages, and of the title, increments the term frequency of
+    the session's posting and replaces its snippet, so the index is maintained with one
+    update per term instead of being rebuilt from the history. Turns of the same session
+    in the batch are merged first, so a posting is updated once per batch.
+
+    Args:
+        turns (list): Queued search index requests, see build_turn_index_request.
+    """
+    postings = {}
+    for turn in turns:
+        for term, posting in build_search_postings(
+            turn["title"], turn["texts"]
+        ).items():
+            key = (turn["user_id"], term, turn["session_id"])
+            if key in postings:
+                posting = {
+                    "tf": postings[key]["tf"] + posting["tf"],
+                    "snippet": posting["snippet"],
+                }
+            postings[key] = posting
+    now = str(datetime.now(tz=timezone.utc).timestamp())
+
+    def update_posting(key):
+        user_id, term, session_id = key
+        dynamodb.update_item(
+            TableName=search_index_table_name,
+            Key={
+                "term_key": {"S": get_search_term_key(user_id, term)},
+                "session_id": {"S": session_id},
+            },
+            UpdateExpression="ADD tf :tf SET snippet = :snippet, last_modified_date = :now",
+            ExpressionAttributeValues={
+                ":tf": {"N": str(postings[key]["tf"])},
+                ":snippet": {"S": postings[key]["snippet"]},
+                ":now": {"N": now},
+            },
+        )
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=SEARCH_INDEX_WORKERS
+    ) as executor:
+        # list() re-raises the first failed update
+        list(executor.map(update_posting, postings))
+
+
+def delete_search_postings(dynamodb, search_index_table_name, session_id):
+    """Deletes every search posting of a session, found through the session_id index"""
+    query_params = {
+        "TableName": search_index_table_name,
+        "IndexName": SEARCH_SESSION_INDEX_NAME,
+        "KeyConditionExpression": "session_id = :session_id",
+        "ExpressionAttributeValues": {":session_id": {"S": session_id}},
+    }
+    write_requests = []
+    while True:
+        response = dynamodb.query(**query_params)
+        write_requests.extend(
+            {
+                "DeleteRequest": {
+                    "Key": {
+                        "term_key": item["term_key"],
+                        "session_id": item["session_id"],
+                    }
+                }
+            }
+            for item in response.get("Items", [])
+        )
+        if "LastEvaluatedKey" not in response:
+            break
+        query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    batch_write_message_requests(dynamodb, search_index_table_name, write_requests)
+
+
+def get_embedding_key(written_at, session_id, suffix):
+    """Sort key of an embeddings table item, ordered by write time so a sync reads only new items"""
+    return f"{written_at:017.6f}#{session_id}#{suffix}"
+
+
+def delete_conversation_embeddings(
+    dynamodb, embeddings_table_name, user_id, session_id
+):
+    """
+    Deletes the embeddings of a session, found through the session_id index.
+
+    A tombstone naming the session is written with the key of a new embedding, so every
+    container caching the user's matrix drops the session's rows on its next sync.
+    """
+    query_params = {
+        "TableName": embeddings_table_name,
+        "IndexName": EMBEDDING_SESSION_INDEX_NAME,
+        "KeyConditionExpression": "session_id = :session_id",
+        "ExpressionAttributeValues": {":session_id": {"S": session_id}},
+    }
+    write_requests = []
+    while True:
+        response = dynamodb.query(**query_params)
+        write_requests.extend(
+            {
+                "DeleteRequest": {
+                    "Key": {
+                        "user_id": item["user_id"],
+                        "embedding_key": item["embedding_key"],
+                    }
+                }
+            }
+            for item in response.get("Items", [])
+            if item["user_id"]["S"] == user_id
+        )
+        if "LastEvaluatedKey" not in response:
+            break
+        query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    batch_write_message_requests(dynamodb, embeddings_table_name, write_requests)
+    now = datetime.now(tz=timezone.utc).timestamp()
+    dynamodb.put_item(
+        TableName=embeddings_table_name,
+        Item={
+            "user_id": {"S": user_id},
+            "embedding_key": {"S": get_embedding_key(now, session_id, "deleted")},
+            "deleted_session_id": {"S": session_id},
+            "expires_at": {"N": str(int(now + EMBEDDING_TOMBSTONE_RETENTION_SECONDS))},
+        },
+    )
+
+
+def query_search_postings(dynamodb, search_index_table_name, user_id, term):
+    """Returns every posting of a term for one user, following every page"""
+    query_params = {
+        "TableName": search_index_table_name,
+        "KeyConditionExpression": "term_key = :term_key",
+        "ExpressionAttributeValues": {
+            ":term_key": {"S": get_search_term_key(user_id, term)}
+        },
+        "ProjectionExpression": "session_id, tf, snippet, last_modified_date",
+    }
+    items = []
+    while True:
+        response = dynamodb.query(**query_params)
+        items.extend(response.get("Items", []))
+        if "LastEvaluatedKey" not in response:
+            return items
+        query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def count_user_conversations(dynamodb, conversations_table_name, user_id):
+    """Returns the number of conversations of a user, deletion tombstones have no title"""
+    query_params = {
+        "TableName": conversations_table_name,
+        "IndexName": CONVERSATION_LIST_INDEX,
+        "KeyConditionExpression": "user_id = :user_id",
+        "FilterExpression": "attribute_exists(title)",
+        "ExpressionAttributeValues": {":user_id": {"S": user_id}},
+        "Select": "COUNT",
+    }
+    count = 0
+    while True:
+        response = dynamodb.query(**query_params)
+        count += response.get("Count", 0)
+        if "LastEvaluatedKey" not in response:
+            return count
+        query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def rank_search_postings(postings_by_term, session_count):
+    """
+    Ranks sessions by the summed tf-idf of the query terms they contain.
+
+    Args:
+        postings_by_term (list): Every posting of each query term.
+        session_count (int): The number of sessions of the user.
+
+    Returns:
+        list: (score, last_modified_date, session_id, snippet), best match first
+    """
+    session_count = max(
+        session_count,
+        len({item["session_id"]["S"] for items in postings_by_term for item in items}),
+    )
+    ranking = {}
+    for items in postings_by_term:
+        if not items:
+            continue
+        # every posting of the term was read, so this is its document frequency
+        idf = math.log(1 + session_count / len(items))
+        for item in items:
+            term_score = (1 + math.log(int(item["tf"]["N"]))) * idf
+            session_id = item["session_id"]["S"]
+            score, last_modified_date, snippet, best_term_score = ranking.get(
+                session_id, (0.0, 0.0, "", 0.0)
+            )
+            if term_score > best_term_score:
+                snippet, best_term_score = item["snippet"]["S"], term_score
+            ranking[session_id] = (
+                score + term_score,
+                max(last_modified_date, float(item["last_modified_date"]["N"])),
+                snippet,
+                best_term_score,
+            )
+    return sorted(
+        (
+            (score, last_modified_date, session_id, snippet)
+            for session_id, (score, last_modified_date, snippet, _) in ranking.items()
+        ),
+        reverse=True,
+    )
+
+
+def batch_get_conversation_metadata(dynamodb, conversations_table_name, session_ids):
+    """Returns the metadata items of sessions by session id, missing sessions are left out"""
+    items = {}
+    for start in range(0, len(session_ids), DYNAMODB_BATCH_GET_SIZE):
+        request_items = {
+            conversations_table_name: {
+                "Keys": [
+                    {"session_id": {"S": session_id}}
+                    for session_id in session_ids[
+                        start : start + DYNAMODB_BATCH_GET_SIZE
+                    ]
+                ],
+                "ProjectionExpression": ", ".join(
+                    f"#{name}" for name in SEARCH_RESULT_ATTRIBUTES
+                ),
+                "ExpressionAttributeNames": {
+                    f"#{name}": name for name in SEARCH_RESULT_ATTRIBUTES
+                },
+            }
+        }
+        for attempt in range(DYNAMODB_BATCH_WRITE_ATTEMPTS):
+            response = dynamodb.batch_get_item(RequestItems=request_items)
+            for item in response.get("Responses", {}).get(conversations_table_name, []):
+                items[item["session_id"]["S"]] = item
+            request_items = response.get("UnprocessedKeys")
+            if not request_items:
+                break
+            time.sleep(0.05 * 2**attempt)
+        else:
+            raise RuntimeError(
+                f"Unprocessed metadata reads after {DYNAMODB_BATCH_WRITE_ATTEMPTS} attempts"
+            )
+    return items
+
+
+def search_conversations(
+    dynamodb,
+    search_index_table_name,
+    conversations_table_name,
+    user_id,
+    query,
+    limit=SEARCH_RESULTS_LIMIT,
+):
+    """
+    Searches a user's conversations for the terms of a query.
+
+    Every query term reads all of its postings, so the cost depends on the number of
+    sessions containing the terms and not on the size of the histories. The idf of a term
+    is based on how many of the user's sessions contain it. Postings of sessions deleted
+    while they were being indexed are dropped when the metadata of the best matches is read.
+
+    Returns:
+        list: Up to limit results, best match first, each with the conversation list
+            fields of the session plus "score" and "snippet".
+    """
+    terms = list(dict.fromkeys(tokenize_search_text(query)))[:SEARCH_MAX_QUERY_TERMS]
+    if not terms:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(len(terms) + 1, SEARCH_INDEX_WORKERS)
+    ) as executor:
+        session_count_future = executor.submit(
+            count_user_conversations, dynamodb, conversations_table_name, user_id
+        )
+        postings_by_term = list(
+            executor.map(
+                lambda term: query_search_postings(
+                    dynamodb, search_index_table_name, user_id, term
+                ),
+                terms,
+            )
+        )
+        session_count = session_count_future.result()
+    results = []
+    ranking = rank_search_postings(postings_by_term, session_count)
+    for start in range(0, len(ranking), limit):
+        candidates = ranking[start : start + limit]
+        metadata = batch_get_conversation_metadata(
+            dynamodb,
+            conversations_table_name,
+            [session_id for _, _, session_id, _ in candidates],
+        )
+        for score, _, session_id, snippet in candidates:
+            item = metadata.get(session_id)
+            if not item or item.get("user_id", {}).get("S") != user_id:
+                continue
+            # typed metadata values are sent as plain JSON values, numbers as floats
+            result = {
+                name: float(value["N"]) if "N" in value else list(value.values())[0]
+                for name, value in item.items()
+                if name != "user_id"
+            }
+            result["score"] = round(score, 4)
+            result["snippet"] = snippet
+            results.append(result)
+            if len(results) == limit:
+                return results
+    return results
+
+
+def search_and_send_conversations(
+    query,
+    connection_id,
+    user_id,
+    dynamodb,
+    search_index_table_name,
+    conversations_table_name,
     logger,
     commons,
     apigateway_management_api,
-    connection_id,
-    session_id,
-    conversation_history_in_s3,
-    message_tail,
 ):
+    """Sends the search_conversations results for a query to the client"""
+    try:
+        results = search_conversations(
+            dynamodb,
+            search_index_table_name,
+            conversations_table_name,
+            user_id,
+            query,
+        )
+    except Exception as e:
+        logger.exception(e)
+        logger.error(f"Error searching conversations (9017): {str(e)}")
+        results = []
+    commons.send_websocket_message(
+        logger,
+        apigateway_management_api,
+        connection_id,
+        {
+            "type": "search_conversations",
+            "query": query,
+            "results": results,
+            "timestamp": datetime.now(tz=timezone.utc).isoformat(),
+        },
+    )
+
+
+class ConversationStore:
+    """
+    Writes conversation turns and token usage for every chat backend.
+
+    Each turn is appended as one item per message, messages too large for an item are
+    spilled to S3 and the session's metadata item is updated, so every backend handles
+    long sessions the same way. When a turn index queue is configured the turn is also
+    queued for the owner's search index, which is updated by the queue's consumer.
     """
-    Sends conversation history to a web client through WebSocket.
 
-    This function takes a conversation history, optionally truncates it to the last
-    N messages, splits it into manageable chunks, and sends these chunks to a web client
-    via WebSocket connection.
+    def __init__(
+        self,
+        dynamodb,
+        s3_client,
+        conversations_table_name,
+        messages_table_name,
+        conversation_history_bucket,
+        usage_table_name=None,
+        sqs_client=None,
+        turn_index_queue_url=None,
+        logger=None,
+    ):
+        """
+        Args:
+            dynamodb (boto3.client): DynamoDB client.
+            s3_client (boto3.client): S3 client for messages too large for an item.
+            conversations_table_name (str): Table holding one metadata item per session.
+            messages_table_name (str): Table holding one item per message (session_id, seq).
+            conversation_history_bucket (str): Bucket for messages too large for an item.
+            usage_table_name (str): Table holding token usage, None when usage is not recorded.
+            sqs_client (boto3.client): SQS client for the turn index queue.
+            turn_index_queue_url (str): Queue of turns waiting for the search index, None
+                when turns are not indexed.
+            logger (Logger): Logger for queuing failures, they are raised when None.
+        """
+        self.dynamodb = dynamodb
+        self.s3_client = s3_client
+        self.conversations_table_name = conversations_table_name
+        self.messages_table_name = messages_table_name
+        self.conversation_history_bucket = conversation_history_bucket
+        self.usage_table_name = usage_table_name
+        self.sqs_client = sqs_client
+        self.turn_index_queue_url = turn_index_queue_url
+        self.logger = logger
+
+    def append_turn(
+        self,
+        session_id,
+        user_id,
+        existing_history,
+        new_messages,
+        metadata,
+        token_usage=None,
+    ):
+        """
+        Appends a turn to a session and records its token usage.
 
-    Parameters:
-    -----------
-    conversation_history : list
-        The complete conversation history to be sent.
+        Args:
+            session_id (str): The session to append to.
+            user_id (str): The owner of the session.
+            existing_history (list): The history loaded for this turn, used to migrate blob sessions.
+            new_messages (list): The messages of this turn.
+            metadata (dict): Plain string attributes for the metadata item (title, model, ...),
+                empty values are left unchanged.
+            token_usage (dict): Keyword arguments for save_token_usage (input_tokens,
+                output_tokens, cache_read_tokens, cache_write_tokens), None to skip.
 
-    logger : logging.Logger
-        Logger instance to record operations.
+        Returns:
+            int: The number of messages in the session.
+        """
+        message_count = append_conversation_messages(
+            self.dynamodb,
+            self.conversations_table_name,
+            self.messages_table_name,
+            self.s3_client,
+            self.conversation_history_bucket,
+            session_id,
+            user_id,
+            existing_history,
+            new_messages,
+            {name: {"S": value} for name, value in metadata.items() if value},
+        )
+        if token_usage is not None and self.usage_table_name:
+            save_token_usage(
+                user_id,
+                dynamodb=self.dynamodb,
+                usage_table_name=self.usage_table_name,
+                **token_usage,
+            )
+        if self.turn_index_queue_url:
+            self.queue_turn_index(
+                session_id, user_id, new_messages, metadata, existing_history
+            )
+        return message_count
 
-    commons : object
-        Common utilities object containing shared methods.
+    def queue_turn_index(
+        self, session_id, user_id, new_messages, metadata, existing_history
+    ):
+        """
+        Queues a turn for the search index, the title only with the first turn of a session.
 
-    apigateway_management_api : object
-        API Gateway Management API client for WebSocket communication.
+        A failure is logged rather than raised when a logger is set, the turn is already
+        stored and only its search postings are missing.
+        """
+        try:
+            self.sqs_client.send_message(
+                QueueUrl=self.turn_index_queue_url,
+                MessageBody=json.dumps(
+                    build_turn_index_request(
+                        session_id,
+                        user_id,
+                        "" if existing_history else metadata.get("title"),
+                        new_messages,
+                    )
+                ),
+            )
+        except Exception as e:
+            if self.logger is None:
+                raise
+            self.logger.exception(e)
+            self.logger.error(f"Error queuing conversation turn index (9018): {str(e)}")
 
-    connection_id : str
-        WebSocket connection identifier for the target client.
 
-    session_id : str
-        Identifier for the current conversation session.
+def stream_conversation_history_to_web_client(
+    conversation_messages,
+    logger,
+    commons,
+    apigateway_management_api,
+    connection_id,
+    session_id,
+    conversation_history_in_s3,
+    message_type="conversation_history",
+    cursor=None,
+):
+    """
+    Sends a conversation history to a web client while its messages are still being read.
 
-    conversation_history_in_s3 : bool
-        Flag indicating whether the conversation history was loaded from S3.
+    Messages are packed into frames as the iterable yields them. Only one chunk is held
+    back, so the final frame can be flagged last_message without knowing the total.
 
-    message_tail : int or None
-        If provided as a positive integer, only the last `message_tail` messages
-        from conversation history will be sent.
+    Args:
+        conversation_messages (iterable): The messages, oldest first.
+        logger (Logger): Logger instance.
+        commons (module): Shared helpers used to send the frames.
+        apigateway_management_api (boto3.client): API Gateway Management API client.
+        connection_id (str): WebSocket connection of the client.
+        session_id (str): The session being loaded.
+        conversation_history_in_s3 (bool): Whether the history was loaded from S3.
+        message_type (str): conversation_history, or conversation_history_older for a
+            page the client prepends.
+        cursor (str): Cursor of the next older page, None when there is none.
 
     Returns:
-    --------
-    None
-        The function sends WebSocket messages but doesn't return any values.
-
-    Notes:
-    ------
-    - The function sends either full history or a tail based on the message_tail parameter
-    - Conversation history is split into chunks before sending
-    - Each chunk is sent with metadata including progress indicators and source information
-    """
-    message_type = "conversation_history"
-    # if message_tail is not null and is an integer and is > 0
-    # then we need to send the last message_tail messages from the conversation history
-    # to the web client
-    if message_tail is not None and isinstance(message_tail, int) and message_tail > 0:
-        # Send the last message_tail messages from the conversation history to the web client
-        conversation_history = conversation_history[-message_tail:]
-        logger.info(f"Sending last {message_tail} messages to web client")
-        message_type = "conversation_history_tail"
-    # Split the conversation history into chunks
-    conversation_history_chunks = split_message(conversation_history, logger)
-    # Send the conversation history chunks to the WebSocket client
-    total_chunks = len(conversation_history_chunks)
-    for index, chunk in enumerate(conversation_history_chunks, start=1):
+        int: The number of frames sent.
+    """
+    held_chunk = None
+    index = 0
+
+    def send_chunk(chunk, current_chunk, last_message):
         commons.send_websocket_message(
             logger,
             apigateway_management_api,
@@ -92,14 +1747,23 @@ def send_conversation_history_to_web_client(
             {
                 "type": message_type,
                 "session_id": session_id,
-                "last_message": index == total_chunks,
+                "last_message": last_message,
                 "loaded_from_s3": conversation_history_in_s3,
                 "chunk": chunk.decode("utf-8"),
-                "current_chunk": index,
-                "total_chunks": total_chunks,
+                "current_chunk": current_chunk,
+                "cursor": cursor,
             },
         )
 
+    for chunk in pack_message_frames(conversation_messages):
+        if held_chunk is not None:
+            send_chunk(held_chunk, index, False)
+        held_chunk = chunk
+        index += 1
+    if held_chunk is not None:
+        send_chunk(held_chunk, index, True)
+    return index
+
 
 def load_and_send_conversation_history(
     session_id: str,
@@ -114,12 +1778,19 @@ def load_and_send_conversation_history(
     apigateway_management_api,
     conversation_history_in_s3,
     return_conversation_without_sending,
+    messages_table_name=None,
 ):
-    """Function to load and send conversation history"""
+    """Function to load and send conversation history
+
+    Sessions written one item per message are read from messages_table_name, older sessions
+    from their history blob in the item or in S3. When sending, only the newest page is sent
+    along with a cursor for load_more. Archived sessions are rehydrated to one item per
+    message first.
+    """
     try:
-        projection_expression = "session_id,category,conversation_history,conversation_history_in_s3,last_message_id,last_modified_date,selected_model_id,title,user_id"
+        projection_expression = "session_id,archive_s3_key,category,conversation_history,conversation_history_in_s3,has_attachments,history_layout,last_message_id,last_modified_date,selected_model_id,title,user_id"
         if conversation_history_in_s3:
-            projection_expression = "session_id,category,conversation_history_in_s3,last_message_id,last_modified_date,selected_model_id,title,user_id"
+            projection_expression = "session_id,archive_s3_key,category,conversation_history_in_s3,has_attachments,history_layout,last_message_id,last_modified_date,selected_model_id,title,user_id"
 
         response = dynamodb.get_item(
             TableName=conversations_table_name,
@@ -136,48 +1807,98 @@ def load_and_send_conversation_history(
                 else item.get("conversation_history_in_s3", False)
             )
 
-            if conversation_history_in_s3:
+            if (
+                messages_table_name
+                and item.get("history_layout", {}).get("S") == ARCHIVED_HISTORY_LAYOUT
+            ):
+                # archived sessions are restored on open and then loaded like any other
+                rehydrate_archived_conversation(
+                    dynamodb,
+                    conversations_table_name,
+                    messages_table_name,
+                    s3_client,
+                    conversation_history_bucket,
+                    session_id,
+                    item["user_id"]["S"],
+                    item["archive_s3_key"]["S"],
+                )
+                item["history_layout"] = {"S": MESSAGES_HISTORY_LAYOUT}
+
+            if (
+                messages_table_name
+                and item.get("history_layout", {}).get("S") == MESSAGES_HISTORY_LAYOUT
+            ):
+                if not return_conversation_without_sending:
+                    # only the newest page is sent, older pages are requested with load_more
+                    page_messages, before_seq = load_conversation_messages_page(
+                        dynamodb,
+                        messages_table_name,
+                        s3_client,
+                        conversation_history_bucket,
+                        session_id,
+                        CONVERSATION_PAGE_MESSAGES,
+                    )
+                    stream_conversation_history_to_web_client(
+                        page_messages,
+                        logger,
+                        commons,
+                        apigateway_management_api,
+                        connection_id,
+                        session_id,
+                        conversation_history_in_s3,
+                        cursor=encode_history_cursor(before_seq),
+                    )
+                    return
+                conversation_messages = iter_conversation_messages(
+                    dynamodb,
+                    messages_table_name,
+                    s3_client,
+                    conversation_history_bucket,
+                    session_id,
+                )
+            elif conversation_history_in_s3:
                 prefix = rf"{user_id}/{session_id}"
-                # Load conversation history from S3
+                # Load conversation history from S3, messages are parsed while it downloads
                 response = s3_client.get_object(
                     Bucket=conversation_history_bucket,
                     Key=f"{prefix}/{session_id}.json",
                 )
-                conversation_history = json.loads(
-                    response["Body"].read().decode("utf-8")
-                )
+                conversation_messages = iter_history_stream(response["Body"])
             else:
                 # Load conversation history from DynamoDB
                 conversation_history_str = item["conversation_history"]["S"]
-                conversation_history = json.loads(conversation_history_str)
+                conversation_messages = json.loads(conversation_history_str)
 
             if return_conversation_without_sending:
+                conversation_history = list(conversation_messages)
                 title_string = item["title"]["S"]
-                needs_load_from_s3 = "s3source" in json.dumps(conversation_history)
+                if item.get("history_layout", {}).get("S") == MESSAGES_HISTORY_LAYOUT:
+                    needs_load_from_s3 = item.get("has_attachments", {}).get(
+                        "BOOL", False
+                    )
+                else:
+                    needs_load_from_s3 = any(
+                        message_has_attachments(message)
+                        for message in conversation_history
+                    )
                 return (
                     needs_load_from_s3,
                     title_string,
                     conversation_history,
                 )
-            send_conversation_history_to_web_client(
-                conversation_history,
-                logger,
-                commons,
-                apigateway_management_api,
-                connection_id,
-                session_id,
-                conversation_history_in_s3,
-                2,
+            # blob sessions are paged like message items, only the newest page is held
+            page_messages, before_seq = get_history_page(
+                conversation_messages, CONVERSATION_PAGE_MESSAGES
             )
-            send_conversation_history_to_web_client(
-                conversation_history,
+            stream_conversation_history_to_web_client(
+                page_messages,
                 logger,
                 commons,
                 apigateway_management_api,
                 connection_id,
                 session_id,
                 conversation_history_in_s3,
-                None,
+                cursor=encode_history_cursor(before_seq),
             )
         else:
             if return_conversation_without_sending:
@@ -200,104 +1921,192 @@ def load_and_send_conversation_history(
         return []
 
 
-def create_base_message(msg: Dict, is_partial: bool = False) -> Dict:
-    """Creates a base message structure for chunking"""
-    msg["msg_partial"] = is_partial
-    msg["msg_partial_last_chunk"] = False
-    return msg
-
+def load_and_send_older_messages(
+    session_id,
+    connection_id,
+    user_id,
+    cursor,
+    dynamodb,
+    conversations_table_name,
+    messages_table_name,
+    s3_client,
+    conversation_history_bucket,
+    logger,
+    commons,
+    apigateway_management_api,
+):
+    """
+    Sends the page of messages before a cursor from an earlier load or load_more.
 
-def split_message(
-    conversation_history: List[Dict], logger: Logger, max_chunk_size: int = 31744
-) -> List[bytes]:
+    The frames have the type conversation_history_older and carry the cursor of the next
+    older page, which is None once the first message of the session was sent.
     """
-    Split conversation messages into chunks within specified size limit, optimizing for minimum chunks.
+    try:
+        before_seq = decode_history_cursor(cursor)
+        response = dynamodb.get_item(
+            TableName=conversations_table_name,
+            Key={"session_id": {"S": session_id}},
+            ProjectionExpression="user_id, history_layout, conversation_history, conversation_history_in_s3",
+        )
+        item = response.get("Item", {})
+        history_layout = item.get("history_layout", {}).get("S")
+        if (
+            item.get("user_id", {}).get("S") != user_id
+            or history_layout == ARCHIVED_HISTORY_LAYOUT
+        ):
+            logger.warn(f"No paginated history to load for session ID: {session_id}")
+            return
+        if history_layout == MESSAGES_HISTORY_LAYOUT:
+            page_messages, next_before_seq = load_conversation_messages_page(
+                dynamodb,
+                messages_table_name,
+                s3_client,
+                conversation_history_bucket,
+                session_id,
+                CONVERSATION_PAGE_MESSAGES,
+                before_seq,
+            )
+        else:
+            # the blob is read up to the end of the page
+            page_messages, next_before_seq = get_history_page(
+                iter_stored_history(
+                    dynamodb,
+                    messages_table_name,
+                    s3_client,
+                    conversation_history_bucket,
+                    session_id,
+                    user_id,
+                    item,
+                ),
+                CONVERSATION_PAGE_MESSAGES,
+                before_seq,
+            )
+        stream_conversation_history_to_web_client(
+            page_messages,
+            logger,
+            commons,
+            apigateway_management_api,
+            connection_id,
+            session_id,
+            False,
+            "conversation_history_older",
+            encode_history_cursor(next_before_seq),
+        )
+    except Exception as e:
+        logger.exception(e)
+        logger.error(f"Error loading older messages (9016): {str(e)}")
 
-    Args:
-        conversation_history (List[Dict]): Array of conversation message objects
-        logger (Logger): AWS Lambda Powertools Logger instance
-        max_chunk_size (int): Maximum size in bytes per chunk. Defaults to 31744.
 
-    Returns:
-        List[bytes]: Array of UTF-8 encoded JSON strings
-    """
-    chunks = []
-    SAFETY_BUFFER = 1000
+def get_frame_text_size(text: str) -> int:
+    """Returns the bytes a string adds to a websocket frame once it is JSON-escaped there"""
+    return len(json.dumps(text)) - 2
 
-    try:
-        for msg_index, msg in enumerate(conversation_history, 1):
-            base_msg = create_base_message(msg)
-            msg_json = json.dumps(base_msg)
-            msg_size = len(msg_json.encode("utf-8"))
-            if msg_size <= max_chunk_size:
-                chunks.append(msg_json.encode("utf-8"))
-                continue
 
-            base_template = create_base_message(msg, is_partial=True)
-            content_limit = max_chunk_size - SAFETY_BUFFER
-            content = str(msg["content"])
-            chunk_count = 0
+def get_partial_frame_chunk(part: str, is_last: bool) -> str:
+    """Returns the chunk carrying one part of the JSON text of an oversized message"""
+    return json.dumps(
+        {
+            "msg_partial": True,
+            "msg_partial_last_chunk": is_last,
+            "msg_partial_data": part,
+        }
+    )
 
-            while content:
-                chunk_count += 1
-                chunk = base_template.copy()
-                current_slice = content[:content_limit]
 
-                # If we can't slice anymore, use all remaining content as the final chunk
-                if not current_slice:
-                    chunk["content"] = content
-                    chunk["msg_partial_last_chunk"] = True
-                    chunk_json = json.dumps(chunk)
-                    chunks.append(chunk_json.encode("utf-8"))
-                    break
+def split_oversized_message(msg_json: str, max_chunk_size: int) -> Iterator[str]:
+    """
+    Splits the JSON text of a message too large for one frame into partial chunks.
 
-                chunk["content"] = current_slice
-                content = content[content_limit:]
+    The text is cut between characters, never inside a UTF-8 sequence, and the client
+    joins the msg_partial_data parts in order and parses them back into the message.
+    """
+    overhead = get_frame_text_size(get_partial_frame_chunk("", False))
+    budget = max_chunk_size - overhead
+    if budget <= 0:
+        raise ValueError(f"max_chunk_size {max_chunk_size} is too small for a frame")
+    position = 0
+    while position < len(msg_json):
+        length = min(len(msg_json) - position, budget)
+        while True:
+            part = msg_json[position : position + length]
+            part_size = get_frame_text_size(json.dumps(part)) - 2
+            if part_size <= budget:
+                break
+            # every character costs at least one byte, so this converges in a few steps
+            length = max(1, min(length - 1, length * budget // part_size))
+        position += length
+        yield get_partial_frame_chunk(part, position >= len(msg_json))
 
-                if not content:
-                    chunk["msg_partial_last_chunk"] = True
 
-                chunk_json = json.dumps(chunk)
-                chunks.append(chunk_json.encode("utf-8"))
-        return chunks
+def pack_message_frames(
+    conversation_history: Iterable[Dict], max_chunk_size: int = HISTORY_FRAME_MAX_BYTES
+) -> Iterator[bytes]:
+    """
+    Packs messages into as few websocket frame chunks as fit the frame size limit.
 
-    except Exception as e:
-        logger.exception(f"Error processing messages: {str(e)}")
-        raise
+    Whole messages are packed into a JSON list per chunk, measured by the bytes they take
+    in the frame after JSON escaping. A message that does not fit a frame on its own is
+    split into partial chunks. Messages are consumed lazily, so a stream of messages is
+    sent without holding all of them.
 
+    Args:
+        conversation_history (iterable): Conversation message objects, oldest first.
+        max_chunk_size (int): Maximum bytes a chunk may take in the frame.
 
-def save_token_usage(user_id, input_tokens, output_tokens, dynamodb, usage_table_name):
-    """Function to save token usage in DDB"""
+    Yields:
+        bytes: UTF-8 encoded JSON chunks.
+    """
+    packed = []
+    # the escaped size of "[" + "]"
+    packed_size = 2
+    for msg in conversation_history:
+        msg_json = json.dumps(msg)
+        msg_size = get_frame_text_size(msg_json)
+        separator_size = 1 if packed else 0
+        if packed and packed_size + separator_size + msg_size > max_chunk_size:
+            yield f"[{','.join(packed)}]".encode("utf-8")
+            packed = []
+            packed_size = 2
+            separator_size = 0
+        if packed_size + msg_size > max_chunk_size:
+            for chunk in split_oversized_message(msg_json, max_chunk_size):
+                yield chunk.encode("utf-8")
+            continue
+        packed.append(msg_json)
+        packed_size += separator_size + msg_size
+    if packed:
+        yield f"[{','.join(packed)}]".encode("utf-8")
+
+
+def save_token_usage(
+    user_id,
+    input_tokens,
+    output_tokens,
+    dynamodb,
+    usage_table_name,
+    cache_read_tokens=0,
+    cache_write_tokens=0,
+):
+    """Function to save token usage in DDB, including prompt cache read/write tokens"""
     current_date_ymd = datetime.now(tz=timezone.utc).strftime("%Y-%m-%d")
     current_date_ym = datetime.now(tz=timezone.utc).strftime("%Y-%m")
 
-    dynamodb.update_item(
-        TableName=usage_table_name,
-        Key={"user_id": {"S": user_id}},
-        UpdateExpression="ADD input_tokens :input_tokens, output_tokens :output_tokens, message_count :message_count",
-        ExpressionAttributeValues={
-            ":input_tokens": {"N": str(input_tokens)},
-            ":output_tokens": {"N": str(output_tokens)},
-            ":message_count": {"N": str(1)},
-        },
-    )
-    dynamodb.update_item(
-        TableName=usage_table_name,
-        Key={"user_id": {"S": user_id + "-" + current_date_ym}},
-        UpdateExpression="ADD input_tokens :input_tokens, output_tokens :output_tokens, message_count :message_count",
-        ExpressionAttributeValues={
-            ":input_tokens": {"N": str(input_tokens)},
-            ":output_tokens": {"N": str(output_tokens)},
-            ":message_count": {"N": str(1)},
-        },
-    )
-    dynamodb.update_item(
-        TableName=usage_table_name,
-        Key={"user_id": {"S": user_id + "-" + current_date_ymd}},
-        UpdateExpression="ADD input_tokens :input_tokens, output_tokens :output_tokens, message_count :message_count",
-        ExpressionAttributeValues={
-            ":input_tokens": {"N": str(input_tokens)},
-            ":output_tokens": {"N": str(output_tokens)},
-            ":message_count": {"N": str(1)},
-        },
-    )
+    for usage_key in [
+        user_id,
+        user_id + "-" + current_date_ym,
+        user_id + "-" + current_date_ymd,
+    ]:
+        dynamodb.update_item(
+            TableName=usage_table_name,
+            Key={"user_id": {"S": usage_key}},
+            UpdateExpression="ADD input_tokens :input_tokens, output_tokens :output_tokens, "
+            "cache_read_input_tokens :cache_read_tokens, cache_write_input_tokens :cache_write_tokens, "
+            "message_count :message_count",
+            ExpressionAttributeValues={
+                ":input_tokens": {"N": str(input_tokens)},
+                ":output_tokens": {"N": str(output_tokens)},
+                ":cache_read_tokens": {"N": str(cache_read_tokens)},
+                ":cache_write_tokens": {"N": str(cache_write_tokens)},
+                ":message_count": {"N": str(1)},
+            },
+        )
@@ -6,7 +6,6 @@ from aws_lambda_powertools import Logger, Metrics, Tracer
 from botocore.config import Config
 from chatbot_commons import commons
 from conversations import conversations
-import copy
 
 dynamodb = boto3.client("dynamodb")
 s3_client = boto3.client("s3")
@@ -17,10 +16,26 @@ conversation_history_bucket = os.environ["CONVERSATION_HISTORY_BUCKET"]
 usage_table_name = os.environ["DYNAMODB_TABLE_USAGE"]
 conversations_table_name = os.environ["CONVERSATIONS_DYNAMODB_TABLE"]
 conversations_table = boto3.resource("dynamodb").Table(conversations_table_name)
+messages_table_name = os.environ["CONVERSATION_MESSAGES_DYNAMODB_TABLE"]
+search_index_table_name = os.environ["CONVERSATION_SEARCH_INDEX_DYNAMODB_TABLE"]
+embeddings_table_name = os.environ["CONVERSATION_EMBEDDINGS_DYNAMODB_TABLE"]
+turn_index_queue_url = os.environ["TURN_INDEX_QUEUE_URL"]
+sqs_client = boto3.client("sqs")
 
 logger = Logger(service="BedrockAgentsClient")
 metrics = Metrics()
 tracer = Tracer()
+conversation_store = conversations.ConversationStore(
+    dynamodb,
+    s3_client,
+    conversations_table_name,
+    messages_table_name,
+    conversation_history_bucket,
+    usage_table_name,
+    sqs_client,
+    turn_index_queue_url,
+    logger,
+)
 ENABLE_CITATIONS = False
 
 
@@ -112,7 +127,16 @@ def process_websocket_message(request_body, force_null_kb_session_id):
     new_message_id = commons.generate_random_string()
     if message_type == "clear_conversation":
         conversations.delete_conversation_history(
-            dynamodb, conversations_table_name, logger, session_id
+            dynamodb,
+            conversations_table_name,
+            logger,
+            session_id,
+            messages_table_name,
+            user_id,
+            s3_client,
+            conversation_history_bucket,
+            search_index_table_name,
+            embeddings_table_name,
         )
         return
     elif message_type == "load":
@@ -130,6 +154,7 @@ def process_websocket_message(request_body, force_null_kb_session_id):
             apigateway_management_api,
             False,
             False,
+            messages_table_name,
         )
         return
     else:
@@ -181,7 +206,7 @@ def process_websocket_message(request_body, force_null_kb_session_id):
                         logger.exception(e)
                         logger.error("Error 187464: " + str(e))
 
-            needs_load_from_s3, chat_title_loaded, original_existing_history = (
+            needs_load_from_s3, chat_title_loaded, existing_history = (
                 conversations.load_and_send_conversation_history(
                     session_id,
                     connection_id,
@@ -195,9 +220,9 @@ def process_websocket_message(request_body, force_null_kb_session_id):
                     apigateway_management_api,
                     False,
                     True,
+                    messages_table_name,
                 )
             )
-            existing_history = copy.deepcopy(original_existing_history)
             new_conversation = bool(not existing_history or len(existing_history) == 0)
             persisted_chat_title = (
                 chat_title_loaded
@@ -247,7 +272,7 @@ def process_websocket_message(request_body, force_null_kb_session_id):
             (
                 needs_load_fneeds_load_from_s3,
                 chat_title_loaded,
-                original_existing_history,
+                existing_history,
             ) = conversations.load_and_send_conversation_history(
                 session_id,
                 connection_id,
@@ -261,13 +286,13 @@ def process_websocket_message(request_body, force_null_kb_session_id):
                 apigateway_management_api,
                 False,
                 True,
+                messages_table_name,
             )
             persisted_chat_title = (
                 chat_title_loaded
                 if chat_title_loaded and chat_title_loaded.strip()
                 else chat_title
             )
-            existing_history = copy.deepcopy(original_existing_history)
             new_conversation = bool(not existing_history or len(existing_history) == 0)
             response_text, contains_errors = process_bedrock_agents_response(
                 iter(response[response_stream_key]),
@@ -310,7 +335,7 @@ def process_websocket_message(request_body, force_null_kb_session_id):
                     }
                 ],
             )
-            needs_load_from_s3, chat_title_loaded, original_existing_history = (
+            needs_load_from_s3, chat_title_loaded, existing_history = (
                 conversations.load_and_send_conversation_history(
                     session_id,
                     connection_id,
@@ -324,6 +349,7 @@ def process_websocket_message(request_body, force_null_kb_session_id):
                     apigateway_management_api,
                     False,
                     True,
+                    messages_table_name,
                 )
             )
             persisted_chat_title = (
@@ -331,7 +357,6 @@ def process_websocket_message(request_body, force_null_kb_session_id):
                 if chat_title_loaded and chat_title_loaded.strip()
                 else chat_title
             )
-            existing_history = copy.deepcopy(original_existing_history)
             new_conversation = bool(not existing_history or len(existing_history) == 0)
             response_text, contains_errors = process_bedrock_agents_response(
                 iter(response[response_stream_key]),
@@ -420,79 +445,88 @@ def process_bedrock_knowledgebase_response_stream(
         kb_session_id = response.get("sessionId")
     citations_list = []
 
-    # Send initial message start
-    commons.send_websocket_message(
-        logger,
-        apigateway_management_api,
-        connection_id,
-        {
-            "type": "message_start",
-            "message_id": message_id,
-            "session_id": session_id,
-            "message": "Agent response started",
-        },
-    )
-    counter += 1
-
-    # Process the stream
-    for event in response["stream"]:
-        if "output" in event:
-            # Handle text output
-            text_chunk = event["output"].get("text", "")
-            if text_chunk:
-                content += text_chunk
-                commons.send_websocket_message(
-                    logger,
-                    apigateway_management_api,
-                    connection_id,
-                    {
-                        "type": "content_block_delta",
-                        "message_id": message_id,
-                        "delta": {"text": text_chunk},
-                        "message_counter": counter,
-                        "kb_session_id": kb_session_id,
-                        "session_id": session_id,
-                        "backend_type": backend_type,
-                    },
-                )
-                counter += 1
-
-        elif "citation" in event:
-            # Collect citations to send later
-            if ENABLE_CITATIONS:
-                citation_data = event["citation"]
-                if citation_data:
-                    citations_list.append(citation_data)
-
-    # Send chat title
-    commons.send_websocket_message(
-        logger,
-        apigateway_management_api,
-        connection_id,
-        {
-            "type": "message_title",
-            "message_id": message_id,
-            "session_id": session_id,
-            "title": chat_title,
-        },
-    )
+    # chunks are coalesced and delivered by a background sender
+    with commons.WebSocketSender(
+        logger, apigateway_management_api, connection_id
+    ) as sender:
+        # Send initial message start
+        sender.send(
+            {
+                "type": "message_start",
+                "message_id": message_id,
+                "session_id": session_id,
+                "message": "Agent response started",
+            },
+        )
+        counter += 1
+
+        # Process the stream
+        for event in response["stream"]:
+            if "output" in event:
+                # Handle text output
+                text_chunk = event["output"].get("text", "")
+                if text_chunk:
+                    content += text_chunk
+                    sender.send_delta(
+                        {
+                            "type": "content_block_delta",
+                            "message_id": message_id,
+                            "delta": {"text": text_chunk},
+                            "message_counter": counter,
+                            "kb_session_id": kb_session_id,
+                            "session_id": session_id,
+                            "backend_type": backend_type,
+                        },
+                    )
+                    counter += 1
+
+            elif "citation" in event:
+                # Collect citations to send later
+                if ENABLE_CITATIONS:
+                    citation_data = event["citation"]
+                    if citation_data:
+                        citations_list.append(citation_data)
 
-    # Send collected citations
-    if citations_list:
-        for citation in citations_list:
-            if len(str(citation)) > 10000:
-                citation_parts = split_string_into_chunks(str(citation))
-                for citation_part in citation_parts:
+        # Send chat title
+        sender.send(
+            {
+                "type": "message_title",
+                "message_id": message_id,
+                "session_id": session_id,
+                "title": chat_title,
+            },
+        )
+
+        # Send collected citations
+        if citations_list:
+            for citation in citations_list:
+                if len(str(citation)) > 10000:
+                    citation_parts = split_string_into_chunks(str(citation))
+                    for citation_part in citation_parts:
+                        try:
+                            sender.send(
+                                {
+                                    "type": "citation_data_part",
+                                    "message_id": message_id,
+                                    "delta": citation_part,
+                                    "last_part": citation_part == citation_parts[-1],
+                                    "kb_session_id": kb_session_id,
+                                    "session_id": session_id,
+                                    "backend_type": backend_type,
+                                },
+                            )
+                        except Exception as e:
+                            logger.error(
+                                "Error sending citation (part) data (not passing error to client)"
+                            )
+                            logger.exception(e)
+                else:
                     try:
-                        commons.send_websocket_message(
-                            logger,
-                            apigateway_management_api,
-                            connection_id,
+                        sender.send(
                             {
-                                "type": "citation_data_part",
+                                "type": "citation_data",
                                 "message_id": message_id,
-                                "delta": citation_part,
-                                "last_part": citation_part == citation_parts[-1],
+                                "delta": citation,
                                 "kb_session_id": kb_session_id,
                                 "session_id": session_id,
                                 "backend_type": backend_type,
@@ -500,45 +534,23 @@ def process_bedrock_knowledgebase_response_stream(
                         )
                     except Exception as e:
                         logger.error(
-                            "Error sending citation (part) data (not passing error to client)"
+                            "Error sending citation data (not passing error to client)"
                         )
                         logger.exception(e)
-            else:
-                try:
-                    commons.send_websocket_message(
-                        logger,
-                        apigateway_management_api,
-                        connection_id,
-                        {
-                            "type": "citation_data",
-                            "message_id": message_id,
-                            "delta": citation,
-                            "kb_session_id": kb_session_id,
-                            "session_id": session_id,
-                            "backend_type": backend_type,
-                        },
-                    )
-                except Exception as e:
-                    logger.error(
-                        "Error sending citation data (not passing error to client)"
-                    )
-                    logger.exception(e)
 
-    # Send message stop
-    commons.send_websocket_message(
-        logger,
-        apigateway_management_api,
-        connection_id,
-        {
-            "type": "message_stop",
-            "message_id": message_id,
-            "new_conversation": new_conversation,
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-            "kb_session_id": kb_session_id,
-            "session_id": session_id,
-            "backend_type": backend_type,
-        },
-    )
+        # Send message stop once every delta was delivered
+        sender.flush()
+        sender.send(
+            {
+                "type": "message_stop",
+                "message_id": message_id,
+                "new_conversation": new_conversation,
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "kb_session_id": kb_session_id,
+                "session_id": session_id,
+                "backend_type": backend_type,
+            },
+        )
 
     return content, kb_session_id
 
@@ -602,156 +614,140 @@ def process_bedrock_agents_response(
     counter = 0
     message_stop_sent = False
     contains_errors = False
-    message_type = "content_block_delta"
-    try:
-        for event in response_stream:
-            if "chunk" in event:
-                chunk = event["chunk"]
-                try:
-                    content_chunk = chunk["bytes"].decode("utf-8")
-                except (UnicodeDecodeError, AttributeError):
-                    # Skip this event if the bytes value is not a valid UTF-8 string
-                    continue
-
-                if counter == 0:
-                    message_type = "message_start"
-
-                # Send the content_block_delta event to the WebSocket client
-                commons.send_websocket_message(
-                    logger,
-                    apigateway_management_api,
-                    connection_id,
-                    {
-                        "type": message_type,
-                        "message_id": message_id,
-                        "session_id": session_id,
-                        "message": {"model": selected_model_id},
-                        "delta": {"text": content_chunk},
-                        "message_counter": counter,
-                        "backend_type": backend_type,
-                    },
-                )
-                message_type = "content_block_delta"
-                counter += 1
-
-                result_text += content_chunk
-            elif "flowOutputEvent" in event:
-                flow_output_event = event["flowOutputEvent"]
-                content = flow_output_event["content"]["document"]
+    # chunks are coalesced and delivered by a background sender
+    with commons.WebSocketSender(
+        logger, apigateway_management_api, connection_id
+    ) as sender:
+        try:
+            for event in response_stream:
+                if "chunk" in event:
+                    chunk = event["chunk"]
+                    try:
+                        content_chunk = chunk["bytes"].decode("utf-8")
+                    except (UnicodeDecodeError, AttributeError):
+                        # Skip this event if the bytes value is not a valid UTF-8 string
+                        continue
+
+                    # Send the content_block_delta event to the WebSocket client
+                    send_agent_delta(
+                        sender,
+                        {
+                            "type": (
+                                "message_start"
+                                if counter == 0
+                                else "content_block_delta"
+                            ),
+                            "message_id": message_id,
+                            "session_id": session_id,
+                            "message": {"model": selected_model_id},
+                            "delta": {"text": content_chunk},
+                            "message_counter": counter,
+                            "backend_type": backend_type,
+                        },
+                    )
+                    counter += 1
 
-                if counter == 0:
-                    message_type = "message_start"
+                    result_text += content_chunk
+                elif "flowOutputEvent" in event:
+                    flow_output_event = event["flowOutputEvent"]
+                    content = flow_output_event["content"]["document"]
 
-                commons.send_websocket_message(
-                    logger,
-                    apigateway_management_api,
-                    connection_id,
-                    {
-                        "type": message_type,
-                        "message_id": message_id,
-                        "session_id": session_id,
-                        "message": {"model": selected_model_id},
-                        "delta": {"text": content},
-                        "message_counter": counter,
-                        "backend_type": backend_type,
-                    },
-                )
-                message_type = "content_block_delta"
-                counter += 1
-                result_text += content
-            elif "flowCompletionEvent" in event:
-                flow_completion_event = event["flowCompletionEvent"]
-                if flow_completion_event["completionReason"] == "SUCCESS":
-                    if counter > 0:
-                        # Send the message_stop event to the WebSocket client
-                        commons.send_websocket_message(
-                            logger,
-                            apigateway_management_api,
-                            connection_id,
-                            {
-                                "type": "message_stop",
-                                "message_id": message_id,
-                                "session_id": session_id,
-                                "new_conversation": new_conversation,
-                                "timestamp": datetime.now(timezone.utc).isoformat(),
-                                "backend_type": backend_type,
-                            },
-                        )
-                        message_stop_sent = True
-                else:
-                    # Send an error message to the WebSocket client
-                    commons.send_websocket_message(
-                        logger,
-                        apigateway_management_api,
-                        connection_id,
+                    send_agent_delta(
+                        sender,
                         {
-                            "type": "error",
+                            "type": (
+                                "message_start"
+                                if counter == 0
+                                else "content_block_delta"
+                            ),
                             "message_id": message_id,
                             "session_id": session_id,
-                            "code": "9200",
-                            "error": "Flow completion event with non-success reason",
+                            "message": {"model": selected_model_id},
+                            "delta": {"text": content},
+                            "message_counter": counter,
+                            "backend_type": backend_type,
                         },
                     )
-                    contains_errors = True
+                    counter += 1
+                    result_text += content
+                elif "flowCompletionEvent" in event:
+                    flow_completion_event = event["flowCompletionEvent"]
+                    if flow_completion_event["completionReason"] == "SUCCESS":
+                        if counter > 0:
+                            # Send the message_stop event to the WebSocket client
+                            sender.flush()
+                            sender.send(
+                                {
+                                    "type": "message_stop",
+                                    "message_id": message_id,
+                                    "session_id": session_id,
+                                    "new_conversation": new_conversation,
+                                    "timestamp": datetime.now(timezone.utc).isoformat(),
+                                    "backend_type": backend_type,
+                                },
+                            )
+                            message_stop_sent = True
+                    else:
+                        # Send an error message to the WebSocket client
+                        sender.send(
+                            {
+                                "type": "error",
+                                "message_id": message_id,
+                                "session_id": session_id,
+                                "code": "9200",
+                                "error": "Flow completion event with non-success reason",
+                            },
+                        )
+                        contains_errors = True
 
-        commons.send_websocket_message(
-            logger,
-            apigateway_management_api,
-            connection_id,
-            {
-                "type": "message_title",
-                "message_id": message_id,
-                "session_id": session_id,
-                "title": chat_title,
-            },
-        )
-        if counter > 0 and not message_stop_sent:
-            # Send the message_stop event to the WebSocket client
-            commons.send_websocket_message(
-                logger,
-                apigateway_management_api,
-                connection_id,
+            sender.send(
                 {
-                    "type": "message_stop",
+                    "type": "message_title",
                     "message_id": message_id,
                     "session_id": session_id,
-                    "new_conversation": new_conversation,
-                    "timestamp": datetime.now(timezone.utc).isoformat(),
-                    "backend_type": backend_type,
+                    "title": chat_title,
                 },
             )
-        message_stop_sent = True
+            if counter > 0 and not message_stop_sent:
+                # Send the message_stop event to the WebSocket client
+                sender.flush()
+                sender.send(
+                    {
+                        "type": "message_stop",
+                        "message_id": message_id,
+                        "session_id": session_id,
+                        "new_conversation": new_conversation,
+                        "timestamp": datetime.now(timezone.utc).isoformat(),
+                        "backend_type": backend_type,
+                    },
+                )
+            message_stop_sent = True
 
-    except Exception as e:
-        logger.exception(e)
-        logger.error(f"Error processing Bedrock response: {str(e)}")
-        # Send an error message to the WebSocket client
-        commons.send_websocket_message(
-            logger,
-            apigateway_management_api,
-            connection_id,
-            {
-                "type": "error",
-                "message_id": message_id,
-                "session_id": session_id,
-                "code": "9200",
-                "error": str(e),
-            },
-        )
-        contains_errors = True
-        if counter > 0:
-            logger.error("Sending message stop now...(error)")
-            commons.send_websocket_message(
-                logger,
-                apigateway_management_api,
-                connection_id,
+        except Exception as e:
+            logger.exception(e)
+            logger.error(f"Error processing Bedrock response: {str(e)}")
+            # Send an error message to the WebSocket client
+            sender.send(
                 {
-                    "type": "message_stop",
+                    "type": "error",
                     "message_id": message_id,
                     "session_id": session_id,
-                    "new_conversation": new_conversation,
+                    "code": "9200",
+                    "error": str(e),
                 },
             )
+            contains_errors = True
+            if counter > 0:
+                logger.error("Sending message stop now...(error)")
+                sender.flush()
+                sender.send(
+                    {
+                        "type": "message_stop",
+                        "message_id": message_id,
+                        "session_id": session_id,
+                        "new_conversation": new_conversation,
+                    },
+                )
 
     return result_text, contains_errors
 
@@ -772,7 +768,7 @@ def store_bedrock_knowledgebase_response(
     new_message_id,
 ):
     """Stores the KB response in DynamoDB"""
-    conversation_history = existing_history + [
+    new_messages = [
         {
             "role": "user",
             "content": [{"text": prompt}],
@@ -786,23 +782,17 @@ def store_bedrock_knowledgebase_response(
             "message_id": new_message_id,
         },
     ]
-    conversation_json = json.dumps(conversation_history)
-    current_timestamp = str(datetime.now(tz=timezone.utc).timestamp())
-    dynamodb.put_item(
-        TableName=conversations_table_name,
-        Item={
-            "session_id": {"S": session_id},
-            "user_id": {"S": user_id},
-            "title": {"S": chat_title},
-            "last_modified_date": {"N": current_timestamp},
-            "selected_knowledgebase_id": {"S": selected_knowledgebase_id},
-            "selected_model_id": {"S": selected_model_id},
-            "selected_model_name": {"S": selected_model_name},
-            "kb_session_id": {"S": kb_session_id},
-            "category": {"S": selected_model_category},
-            "conversation_history": {"S": conversation_json},
-            "conversation_history_in_s3": {"BOOL": False},
-        },
+    metadata = {
+        "title": chat_title,
+        "selected_knowledgebase_id": selected_knowledgebase_id,
+        "selected_model_id": selected_model_id,
+        "selected_model_name": selected_model_name,
+        "kb_session_id": kb_session_id,
+        "category": selected_model_category,
+        "last_message_id": new_message_id,
+    }
+    conversation_store.append_turn(
+        session_id, user_id, existing_history, new_messages, metadata
     )
 
 
@@ -822,7 +812,7 @@ def store_bedrock_agents_response(
     new_message_id,
 ):
     """Stores the Agent response in DynamoDB"""
-    conversation_history = existing_history + [
+    new_messages = [
         {
             "role": "user",
             "content": [{"text": prompt}],
@@ -836,26 +826,26 @@ def store_bedrock_agents_response(
             "message_id": new_message_id,
         },
     ]
-    conversation_json = json.dumps(conversation_history)
-    current_timestamp = str(datetime.now(tz=timezone.utc).timestamp())
-    item_value = {
-        "session_id": {"S": session_id},
-        "user_id": {"S": user_id},
-        "title": {"S": chat_title},
-        "last_modified_date": {"N": current_timestamp},
-        "category": {"S": category},
-        "conversation_history": {"S": conversation_json},
-        "conversation_history_in_s3": {"BOOL": False},
+    metadata = {
+        "title": chat_title,
+        "category": category,
+        "last_message_id": new_message_id,
+        "flow_id": flow_id,
+        "flow_alias_id": flow_alias_id,
+        "selected_agent_id": selected_agent_id,
+        "selected_agent_alias_id": selected_agent_alias_id,
     }
-    if flow_id:
-        item_value["flow_id"] = {"S": flow_id}
-    if flow_alias_id:
-        item_value["flow_alias_id"] = {"S": flow_alias_id}
-    if selected_agent_id:
-        item_value["selected_agent_id"] = {"S": selected_agent_id}
-    if selected_agent_alias_id:
-        item_value["selected_agent_alias_id"] = {"S": selected_agent_alias_id}
-    dynamodb.put_item(TableName=conversations_table_name, Item=item_value)
+    conversation_store.append_turn(
+        session_id, user_id, existing_history, new_messages, metadata
+    )
+
+
+def send_agent_delta(sender, message):
+    """Sends the first chunk of a response right away and coalesces the following ones"""
+    if message["type"] == "message_start":
+        sender.send(message)
+    else:
+        sender.send_delta(message)
 
 
 def split_string_into_chunks(input_string, max_chars: int = 10000):
@@ -0,0 +1,85 @@
+import os
+import concurrent.futures
+from datetime import datetime, timezone
+import boto3
+from aws_lambda_powertools import Logger, Metrics, Tracer
+from aws_lambda_powertools.metrics import MetricUnit
+from conversations import conversations
+
+logger = Logger(service="ConversationArchive")
+metrics = Metrics()
+tracer = Tracer()
+
+dynamodb = boto3.client("dynamodb")
+s3_client = boto3.client("s3")
+conversations_table_name = os.environ["CONVERSATIONS_DYNAMODB_TABLE"]
+messages_table_name = os.environ["CONVERSATION_MESSAGES_DYNAMODB_TABLE"]
+conversation_history_bucket = os.environ["CONVERSATION_HISTORY_BUCKET"]
+# sessions neither written nor opened for this many days are archived
+ARCHIVE_IDLE_DAYS = int(os.environ.get("ARCHIVE_IDLE_DAYS", "90"))
+ARCHIVE_WORKERS = 8
+# the scan stops with this much time left, the remaining sessions are archived by the next run
+ARCHIVE_TIME_RESERVE_MILLIS = 60 * 1000
+
+
+@metrics.log_metrics
+@tracer.capture_lambda_handler
+def lambda_handler(event, context):
+    """Scheduled handler that archives the history of idle conversations to S3"""
+    idle_before = (
+        datetime.now(timezone.utc).timestamp() - ARCHIVE_IDLE_DAYS * 24 * 60 * 60
+    )
+    scanned, archived = 0, 0
+    scan_params = {
+        "TableName": conversations_table_name,
+        "ProjectionExpression": "session_id",
+        # stop requests, in-flight claims and tombstones have a # in their key
+        "FilterExpression": "attribute_exists(user_id) AND NOT contains(session_id, :marker) "
+        "AND last_modified_date < :idle_before "
+        "AND (attribute_not_exists(last_opened_date) OR last_opened_date < :idle_before) "
+        "AND (attribute_not_exists(history_layout) OR history_layout <> :archived)",
+        "ExpressionAttributeValues": {
+            ":marker": {"S": "#"},
+            ":idle_before": {"N": str(idle_before)},
+            ":archived": {"S": conversations.ARCHIVED_HISTORY_LAYOUT},
+        },
+    }
+    with concurrent.futures.ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS) as executor:
+        while context.get_remaining_time_in_millis() > ARCHIVE_TIME_RESERVE_MILLIS:
+            response = dynamodb.scan(**scan_params)
+            session_ids = [item["session_id"]["S"] for item in response["Items"]]
+            scanned += len(session_ids)
+            archived += sum(
+                executor.map(
+                    lambda session_id: archive_conversation(session_id, idle_before),
+                    session_ids,
+                )
+            )
+            if "LastEvaluatedKey" not in response:
+                break
+            scan_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    metrics.add_metric(
+        name="ConversationsArchived", unit=MetricUnit.Count, value=archived
+    )
+    logger.info(f"Archived {archived} of {scanned} idle conversations")
+    return {"statusCode": 200, "archived": archived}
+
+
+def archive_conversation(session_id, idle_before):
+    """Archives one session, returns 1 if it was archived"""
+    try:
+        return int(
+            conversations.archive_idle_conversation(
+                dynamodb,
+                conversations_table_name,
+                messages_table_name,
+                s3_client,
+                conversation_history_bucket,
+                session_id,
+                idle_before,
+            )
+        )
+    except Exception as e:
+        logger.exception(e)
+        logger.error(f"Error archiving conversation {session_id} (9021): {str(e)}")
+        return 0
@@ -0,0 +1,207 @@
+import os
+from collections import OrderedDict
+
+# context window sizes in tokens, the first entry contained in the model id wins
+MODEL_CONTEXT_TOKENS = (
+    ("anthropic.claude-instant", 100000),
+    ("anthropic.claude-v2", 100000),
+    ("anthropic.claude", 200000),
+    ("amazon.nova-micro", 128000),
+    ("amazon.nova", 300000),
+    ("amazon.titan-text-premier", 32000),
+    ("amazon.titan-text", 8000),
+    ("meta.llama3-8b", 8000),
+    ("meta.llama3-70b", 8000),
+    ("meta.llama", 128000),
+    ("mistral.mistral-large", 128000),
+    ("mistral.pixtral", 128000),
+    ("mistral.", 32000),
+    ("cohere.command-r", 128000),
+    ("cohere.command", 4000),
+    ("ai21.jamba", 256000),
+    ("deepseek.", 128000),
+    ("writer.palmyra", 128000),
+)
+DEFAULT_CONTEXT_TOKENS = 32000
+# fraction of the context window the history may use, the rest is left for the answer
+CONTEXT_BUDGET_RATIO = float(os.environ.get("CONTEXT_BUDGET_RATIO", "0.75"))
+# absolute cap on input tokens per request, 0 uses the model's context window only
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "0"))
+
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+ATTACHMENT_TOKEN_ESTIMATES = {"image": 1600, "document": 2000, "video": 2000}
+TOKEN_CACHE_SIZE = 10000
+# history is dropped in steps of this many messages so the kept prefix stays cacheable for several turns
+CONTEXT_TRIM_STEP = 8
+token_estimate_cache = OrderedDict()
+
+
+def get_context_tokens(model_id):
+    """Returns the context window size in tokens for a model id or inference profile"""
+    model_id = (model_id or "").lower()
+    for model_prefix, context_tokens in MODEL_CONTEXT_TOKENS:
+        if model_prefix in model_id:
+            return context_tokens
+    return DEFAULT_CONTEXT_TOKENS
+
+
+def get_token_budget(model_id):
+    """Returns the number of input tokens a request to the model may use"""
+    budget = int(get_context_tokens(model_id) * CONTEXT_BUDGET_RATIO)
+    if CONTEXT_TOKEN_BUDGET > 0:
+        budget = min(budget, CONTEXT_TOKEN_BUDGET)
+    return budget
+
+
+def estimate_text_tokens(text):
+    """Rough token estimate for a piece of text"""
+    if not text:
+        return 0
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def estimate_content_tokens(content, content_types):
+    """Estimates the tokens of a message's content blocks of the given types"""
+    if not isinstance(content, list):
+        return 0
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    for item in content:
+        content_type = next((key for key in content_types if key in item), None)
+        if content_type == "text":
+            tokens += estimate_text_tokens(item["text"])
+        elif content_type:
+            tokens += ATTACHMENT_TOKEN_ESTIMATES.get(content_type, 0)
+    return tokens
+
+
+def estimate_message_tokens(message, content_types):
+    """
+    Estimates the tokens a stored message adds to a converse request.
+
+    Stored messages never change once written, so estimates are cached by message id.
+
+    Args:
+        message (dict): A message from the stored conversation history.
+        content_types (tuple): The content block types replayed to the model.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    message_id = message.get("message_id")
+    if not message_id:
+        return estimate_content_tokens(message.get("content"), content_types)
+    cache_key = (message_id, message.get("role"), content_types)
+    tokens = token_estimate_cache.get(cache_key)
+    if tokens is not None:
+        token_estimate_cache.move_to_end(cache_key)
+        return tokens
+    tokens = estimate_content_tokens(message.get("content"), content_types)
+    token_estimate_cache[cache_key] = tokens
+    if len(token_estimate_cache) > TOKEN_CACHE_SIZE:
+        token_estimate_cache.popitem(last=False)
+    return tokens
+
+
+def fit_history_to_budget(existing_history, model_id, reserved_tokens, content_types):
+    """
+    Drops the oldest turns of the history until the request fits the model's token budget.
+
+    The newest messages are kept and the oldest are dropped in steps of CONTEXT_TRIM_STEP,
+    so the start of the history (and the prompt cache prefix) only moves every few turns.
+    The kept history always starts with a user message because the converse API rejects a conversation that starts with the assistant.
+
+    Args:
+        existing_history (list): The stored conversation history, oldest first.
+        model_id (str): The model the request is sent to.
+        reserved_tokens (int): Tokens already used by the system prompt and the new message.
+        content_types (tuple): The content block types replayed to the model.
+
+    Returns:
+        tuple: A tuple containing:
+            - list: The history messages to send, oldest first
+            - dict: Context metrics for the message_stop event
+    """
+    budget = get_token_budget(model_id)
+    available_tokens = max(budget - reserved_tokens, 0)
+    messages = [
+        message
+        for message in existing_history or []
+        if message.get("role") in ["user", "assistant"]
+    ]
+    estimates = [estimate_message_tokens(message, content_types) for message in messages]
+
+    first_kept = len(messages)
+    used_tokens = 0
+    while first_kept > 0 and used_tokens + estimates[first_kept - 1] <= available_tokens:
+        first_kept -= 1
+        used_tokens += estimates[first_kept]
+    if first_kept > 0:
+        first_kept = min(-(-first_kept // CONTEXT_TRIM_STEP) * CONTEXT_TRIM_STEP, len(messages))
+        used_tokens = sum(estimates[first_kept:])
+    while first_kept < len(messages) and messages[first_kept].get("role") != "user":
+        used_tokens -= estimates[first_kept]
+        first_kept += 1
+
+    dropped_tokens = sum(estimates[:first_kept])
+    context_metrics = {
+        "contextTokenBudget": budget,
+        "contextHistoryTokenEstimate": used_tokens,
+        "contextDroppedMessages": first_kept,
+        "contextDroppedTokenEstimate": dropped_tokens,
+    }
+    return messages[first_kept:], context_metrics
+
+
+# models that accept converse cachePoint blocks
+PROMPT_CACHE_MODELS = (
+    "anthropic.claude-3-5-haiku",
+    "anthropic.claude-3-7-sonnet",
+    "anthropic.claude-sonnet-4",
+    "anthropic.claude-opus-4",
+    "anthropic.claude-haiku-4",
+    "amazon.nova-micro",
+    "amazon.nova-lite",
+    "amazon.nova-pro",
+    "amazon.nova-premier",
+)
+# prefixes shorter than this are not cached by bedrock, so no checkpoint is added
+PROMPT_CACHE_MIN_TOKENS = 1024
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+
+def supports_prompt_caching(model_id):
+    """Returns True if converse requests to the model may contain cachePoint blocks"""
+    model_id = (model_id or "").lower()
+    return any(model_prefix in model_id for model_prefix in PROMPT_CACHE_MODELS)
+
+
+def add_cache_points(system_prompt_array, messages, system_tokens, history_tokens):
+    """
+    Adds cache checkpoints after the system prompt and after the last history message.
+
+    Everything before a checkpoint must be identical between requests for the cache to
+    be read, so per-request content has to come after the last checkpoint.
+
+    Args:
+        system_prompt_array (list): The converse system blocks, extended in place.
+        messages (list): The converse messages, the last one being the new user message.
+            The content list of the last history message is extended in place.
+        system_tokens (int): Estimated tokens of the system prompt.
+        history_tokens (int): Estimated tokens of the history messages.
+
+    Returns:
+        int: The number of checkpoints added.
+    """
+    cache_points = 0
+    if system_prompt_array and system_tokens >= PROMPT_CACHE_MIN_TOKENS:
+        system_prompt_array.append(CACHE_POINT)
+        cache_points += 1
+    if (
+        len(messages) > 1
+        and messages[-2]["content"]
+        and system_tokens + history_tokens >= PROMPT_CACHE_MIN_TOKENS
+    ):
+        messages[-2]["content"].append(CACHE_POINT)
+        cache_points += 1
+    return cache_points
@@ -1,6 +1,6 @@
 import json
 import os
-import copy
+import concurrent.futures
 import re
 import time
 from datetime import datetime, timezone
@@ -12,8 +12,30 @@ import conversations
 
 # use AWS powertools for logging
 from aws_lambda_powertools import Logger, Metrics, Tracer
+from context_window import (
+    add_cache_points,
+    estimate_content_tokens,
+    estimate_text_tokens,
+    fit_history_to_budget,
+    supports_prompt_caching,
+)
+from prompt_assembly import (
+    SystemPromptCache,
+    build_system_prompt_blocks,
+    build_timezone_prompt,
+    is_reload_requested,
+)
+from semantic_search import (
+    EMBEDDING_TEXT_MAX_CHARS,
+    SEMANTIC_SEARCH_MAX_TOP_K,
+    SEMANTIC_SEARCH_TOP_K,
+    SemanticIndex,
+    create_embedder,
+)
 from llm_conversion_functions import (
-    process_message_history_converse,
+    HISTORY_CONTENT_TYPES,
+    download_history_attachments,
+    plan_history_content,
     process_bedrock_converse_response,
     process_bedrock_converse_response_for_title,
 )
@@ -34,7 +56,23 @@ image_bucket_name = os.environ["S3_IMAGE_BUCKET_NAME"]
 WEBSOCKET_API_ENDPOINT = os.environ["WEBSOCKET_API_ENDPOINT"]
 conversations_table_name = os.environ["CONVERSATIONS_DYNAMODB_TABLE"]
 conversations_table = boto3.resource("dynamodb").Table(conversations_table_name)
+messages_table_name = os.environ["CONVERSATION_MESSAGES_DYNAMODB_TABLE"]
 usage_table_name = os.environ["DYNAMODB_TABLE_USAGE"]
+search_index_table_name = os.environ["CONVERSATION_SEARCH_INDEX_DYNAMODB_TABLE"]
+embeddings_table_name = os.environ["CONVERSATION_EMBEDDINGS_DYNAMODB_TABLE"]
+turn_index_queue_url = os.environ["TURN_INDEX_QUEUE_URL"]
+sqs_client = boto3.client("sqs")
+conversation_store = conversations.ConversationStore(
+    dynamodb,
+    s3_client,
+    conversations_table_name,
+    messages_table_name,
+    conversation_history_bucket,
+    usage_table_name,
+    sqs_client,
+    turn_index_queue_url,
+    logger,
+)
 region = os.environ["REGION"]
 # models that do not support a system prompt (also includes all amazon models)
 SYSTEM_PROMPT_EXCLUDED_MODELS = (
@@ -45,11 +83,10 @@ SYSTEM_PROMPT_EXCLUDED_MODELS = (
 )
 tokenizer_cache = {}
 # Constants
-MAX_DDB_SIZE = 400 * 1024  # 400KB
-DDB_SIZE_THRESHOLD = 0.8
-S3_KEY_FORMAT = "{prefix}/{session_id}.json"
-
 MAX_CONTENT_ITEMS = 20
+# allowance for the timezone prompt appended to the system prompt on every request
+TIMEZONE_PROMPT_TOKENS = 100
+CURRENT_MESSAGE_CONTENT_TYPES = ("text", "image", "document", "video")
 MAX_IMAGES = 20
 MAX_DOCUMENTS = 5
 ALLOWED_DOCUMENT_TYPES = [
@@ -68,11 +105,31 @@ ALLOWED_DOCUMENT_TYPES = [
     "gif",
     "webp",
 ]
+# fields read from each kind of queued turn index request
+TURN_INDEX_REQUEST_KEYS = {
+    conversations.TURN_INDEX_KIND_SEARCH: (
+        "kind",
+        "user_id",
+        "session_id",
+        "title",
+        "texts",
+    ),
+    conversations.TURN_INDEX_KIND_EMBEDDING: (
+        "kind",
+        "user_id",
+        "session_id",
+        "message_id",
+        "text",
+    ),
+}
 
 # Initialize bedrock_runtime client
 config = Config(retries={"total_max_attempts": 5, "mode": "standard"})
 bedrock_runtime = boto3.client("bedrock-runtime", config=config)
 bedrock_client = boto3.client("bedrock", config=config)
+semantic_index = SemanticIndex(
+    dynamodb, embeddings_table_name, create_embedder(bedrock_runtime)
+)
 
 
 # AWS API Gateway Management API client
@@ -81,14 +138,20 @@ apigateway_management_api = boto3.client(
     endpoint_url=f"{WEBSOCKET_API_ENDPOINT.replace('wss', 'https')}/ws",
 )
 
-system_prompt = ""
+# title generation runs beside the main answer stream, so it never delays the first token
+title_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+# independent reads before the Bedrock call run at the same time
+preflight_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
 
 
 @tracer.capture_lambda_handler
 def lambda_handler(event, context):
     """Lambda Hander Function"""
     try:
-        process_websocket_message(event)
+        if "Records" in event:
+            # stored turns queued for search and semantic search arrive in batches from SQS
+            return index_queued_turns(event["Records"])
+        process_websocket_message(event, context.aws_request_id)
         return {"statusCode": 200}
 
     except Exception as e:
@@ -98,10 +161,8 @@ def lambda_handler(event, context):
 
 
 @tracer.capture_method
-def process_websocket_message(request_body):
-    """Function to process a websocket message"""
-    # amazonq-ignore-next-line
-    global system_prompt
+def process_websocket_message(request_body, request_id=None):
+    """Function to process a websocket message, request_id is the Lambda request id"""
     access_token = request_body.get("access_token", {})
     session_id = request_body.get("session_id", "XYZ")
     connection_id = request_body.get("connection_id", "ZYX")
@@ -115,17 +176,25 @@ def process_websocket_message(request_body):
         tracer.put_annotation(key="MessageType", value=message_type)
     if connection_id:
         tracer.put_annotation(key="ConnectionID", value=connection_id)
-    # Check if the WebSocket connection is open
-    try:
-        connection = apigateway_management_api.get_connection(
-            ConnectionId=connection_id
-        )
-        connection_state = connection.get("ConnectionStatus", "OPEN")
-        if connection_state != "OPEN":
-            logger.info(f"WebSocket connection is not open (state: {connection_state})")
-            return
-    except apigateway_management_api.exceptions.GoneException:
-        logger.warn(f"WebSocket connection is closed (connectionId: {connection_id})")
+    if message_type == "stop_generation":
+        # the worker streaming the answer to message_id polls for the request
+        if not conversations.request_generation_stop(
+            dynamodb,
+            conversations_table_name,
+            session_id,
+            user_id,
+            request_body.get("message_id"),
+        ):
+            logger.warn(f"Ignoring stop request for session ID: {session_id}")
+        return
+    # prompts check the connection during the pre-flight stage
+    if message_type in [
+        "clear_conversation",
+        "load",
+        "load_more",
+        "search_conversations",
+        "semantic_search",
+    ] and not is_connection_open(connection_id):
         return
 
     if message_type == "clear_conversation":
@@ -141,7 +210,16 @@ def process_websocket_message(request_body):
             session_id, conversation_history_bucket, user_id, None, s3_client, logger
         )
         conversations.delete_conversation_history(
-            dynamodb, conversations_table_name, logger, session_id
+            dynamodb,
+            conversations_table_name,
+            logger,
+            session_id,
+            messages_table_name,
+            user_id,
+            s3_client,
+            conversation_history_bucket,
+            search_index_table_name,
+            embeddings_table_name,
         )
         return
     elif message_type == "load":
@@ -164,6 +242,44 @@ def process_websocket_message(request_body):
             apigateway_management_api,
             conversation_history_in_s3,
             False,
+            messages_table_name,
+        )
+        return
+    elif message_type == "load_more":
+        conversations.load_and_send_older_messages(
+            session_id,
+            connection_id,
+            user_id,
+            request_body.get("cursor"),
+            dynamodb,
+            conversations_table_name,
+            messages_table_name,
+            s3_client,
+            conversation_history_bucket,
+            logger,
+            commons,
+            apigateway_management_api,
+        )
+        return
+    elif message_type == "search_conversations":
+        conversations.search_and_send_conversations(
+            request_body.get("query", ""),
+            connection_id,
+            user_id,
+            dynamodb,
+            search_index_table_name,
+            conversations_table_name,
+            logger,
+            commons,
+            apigateway_management_api,
+        )
+        return
+    elif message_type == "semantic_search":
+        send_semantic_search_results(
+            request_body.get("query", ""),
+            request_body.get("top_k"),
+            connection_id,
+            user_id,
         )
         return
     else:
@@ -224,52 +340,9 @@ def process_websocket_message(request_body):
                 },
             )
             return {"statusCode": 400}
-        processed_attachments, error_message = commons.process_attachments(
-            attachments,
-            user_id,
-            session_id,
-            attachment_bucket_name,
-            logger,
-            s3_client,
-            ALLOWED_DOCUMENT_TYPES,
-            0,
-            0,
-            bedrock_runtime,
-            selected_model_id,
-        )
-        if error_message and len(error_message) > 1:
-            commons.send_websocket_message(
-                logger,
-                apigateway_management_api,
-                connection_id,
-                {"type": "error", "session_id": session_id, "error": error_message},
-            )
-            return {"statusCode": 400}
-
-        # Query existing history for the session from DynamoDB
-        needs_load_from_s3, chat_title, original_existing_history = (
-            conversations.load_and_send_conversation_history(
-                session_id,
-                connection_id,
-                user_id,
-                dynamodb,
-                conversations_table_name,
-                s3_client,
-                conversation_history_bucket,
-                logger,
-                commons,
-                apigateway_management_api,
-                conversation_history_in_s3,
-                True,
-            )
+        reload_prompt_config = is_reload_requested(
+            request_body.get("reloadPromptConfig", False)
         )
-        if needs_load_from_s3:
-            existing_history = load_documents_from_existing_history(
-                original_existing_history
-            )
-        else:
-            existing_history = copy.deepcopy(original_existing_history)
-        reload_prompt_config = bool(request_body.get("reloadPromptConfig", "False"))
         system_prompt_user_or_system = request_body.get(
             "systemPromptUserOrSystem", "system"
         )
@@ -277,272 +350,512 @@ def process_websocket_message(request_body):
             tracer.put_annotation(
                 key="PromptUserOrSystem", value=system_prompt_user_or_system
             )
-        if not system_prompt or reload_prompt_config:
-            system_prompt = load_system_prompt_config(
-                system_prompt_user_or_system, user_id
+        if reload_prompt_config:
+            system_prompt_cache.invalidate(user_id)
+        if not conversations.claim_in_flight_message(
+            dynamodb,
+            conversations_table_name,
+            session_id,
+            request_body.get("message_id", None),
+            request_id,
+        ):
+            # a double-send or a redelivered request that is answered or still answering
+            logger.info(f"Skipping duplicate message for session ID: {session_id}")
+            return {"statusCode": 200}
+
+        in_flight_status = conversations.IN_FLIGHT_FAILED
+        try:
+            # none of these depend on each other, so their round trips overlap
+            preflight_results, failed_step, preflight_timings = run_preflight(
+                {
+                    "connection": (
+                        lambda: is_connection_open(connection_id),
+                        lambda is_open: not is_open,
+                    ),
+                    "attachments": (
+                        lambda: commons.process_attachments(
+                            attachments,
+                            user_id,
+                            session_id,
+                            attachment_bucket_name,
+                            logger,
+                            s3_client,
+                            ALLOWED_DOCUMENT_TYPES,
+                            0,
+                            0,
+                            bedrock_runtime,
+                            selected_model_id,
+                        ),
+                        lambda result: result[1] and len(result[1]) > 1,
+                    ),
+                    # Query existing history for the session from DynamoDB
+                    "history": (
+                        lambda: conversations.load_and_send_conversation_history(
+                            session_id,
+                            connection_id,
+                            user_id,
+                            dynamodb,
+                            conversations_table_name,
+                            s3_client,
+                            conversation_history_bucket,
+                            logger,
+                            commons,
+                            apigateway_management_api,
+                            conversation_history_in_s3,
+                            True,
+                            messages_table_name,
+                        ),
+                        None,
+                    ),
+                    "system_prompt": (
+                        lambda: system_prompt_cache.get(
+                            system_prompt_user_or_system, user_id
+                        ),
+                        None,
+                    ),
+                }
             )
-
-        title_theme = request_body.get("titleGenTheme", "")
-        title_gen_model = request_body.get("titleGenModel", "")
-        if title_gen_model == "DEFAULT" or not title_gen_model:
-            title_gen_model = ""
-        if "/" in title_gen_model:
-            title_gen_model = title_gen_model.split("/")[1]
-
-        message_id = request_body.get("message_id", None)
-        new_message_id = commons.generate_random_string()
-        message_received_timestamp_utc = request_body.get(
-            "timestamp", datetime.now(tz=timezone.utc).isoformat()
-        )
-        timestamp_local_timezone = request_body.get("timestamp_local_timezone")
-        bedrock_request = None
-        converse_content_array = []
-        converse_content_with_s3_pointers = []
-        if prompt:
-            converse_content_array.append({"text": prompt})
-            converse_content_with_s3_pointers.append({"text": prompt})
-        for attachment in processed_attachments:
-            if attachment["type"].startswith("image/"):
-                converse_content_array.append(
+            logger.info(f"Pre-flight timings (ms): {preflight_timings}")
+            tracer.put_metadata(key="PreflightTimings", value=preflight_timings)
+            if failed_step == "connection":
+                return
+            if failed_step == "attachments":
+                commons.send_websocket_message(
+                    logger,
+                    apigateway_management_api,
+                    connection_id,
                     {
-                        "image": {
-                            "format": attachment["type"].split("/")[1],
-                            "source": {"bytes": attachment["content"]},
-                        }
-                    }
+                        "type": "error",
+                        "session_id": session_id,
+                        "error": preflight_results["attachments"][1],
+                    },
                 )
-                converse_content_with_s3_pointers.append(
-                    {
-                        "image": {
-                            "format": attachment["type"].split("/")[1],
-                            "s3source": {
-                                "s3bucket": attachment["s3bucket"],
-                                "s3key": attachment["s3key"],
-                            },
+                return {"statusCode": 400}
+            processed_attachments, error_message = preflight_results["attachments"]
+            needs_load_from_s3, chat_title, existing_history = preflight_results[
+                "history"
+            ]
+            system_prompt = preflight_results["system_prompt"]
+
+            title_theme = request_body.get("titleGenTheme", "")
+            title_gen_model = request_body.get("titleGenModel", "")
+            if title_gen_model == "DEFAULT" or not title_gen_model:
+                title_gen_model = ""
+            if "/" in title_gen_model:
+                title_gen_model = title_gen_model.split("/")[1]
+
+            message_id = request_body.get("message_id", None)
+            new_message_id = commons.generate_random_string()
+            message_received_timestamp_utc = request_body.get(
+                "timestamp", datetime.now(tz=timezone.utc).isoformat()
+            )
+            timestamp_local_timezone = request_body.get("timestamp_local_timezone")
+            message_sent_at = get_message_sent_at(message_received_timestamp_utc)
+            bedrock_request = None
+            converse_content_array = []
+            converse_content_with_s3_pointers = []
+            if prompt:
+                converse_content_array.append({"text": prompt})
+                converse_content_with_s3_pointers.append({"text": prompt})
+            for attachment in processed_attachments:
+                if attachment["type"].startswith("image/"):
+                    converse_content_array.append(
+                        {
+                            "image": {
+                                "format": attachment["type"].split("/")[1],
+                                "source": {"bytes": attachment["content"]},
+                            }
                         }
-                    }
-                )
-            elif attachment["type"].startswith("video/"):
-                video_format = attachment["type"].split("/")[1]
-                if video_format == "3pg":
-                    video_format = "three_gp"
-
-                converse_content_array.append(
-                    {
-                        "video": {
-                            "format": video_format,
-                            "source": {
-                                "s3Location": {
-                                    "uri": f"s3://{attachment['s3bucket']}/{attachment['s3key']}"
-                                }
-                            },
+                    )
+                    converse_content_with_s3_pointers.append(
+                        {
+                            "image": {
+                                "format": attachment["type"].split("/")[1],
+                                "s3source": {
+                                    "s3bucket": attachment["s3bucket"],
+                                    "s3key": attachment["s3key"],
+                                },
+                            }
                         }
-                    }
-                )
-                converse_content_with_s3_pointers.append(
-                    {
-                        "video": {
-                            "format": video_format,
-                            "s3source": {
-                                "s3bucket": attachment["s3bucket"],
-                                "s3key": attachment["s3key"],
-                            },
+                    )
+                elif attachment["type"].startswith("video/"):
+                    video_format = attachment["type"].split("/")[1]
+                    if video_format == "3pg":
+                        video_format = "three_gp"
+
+                    converse_content_array.append(
+                        {
+                            "video": {
+                                "format": video_format,
+                                "source": {
+                                    "s3Location": {
+                                        "uri": f"s3://{attachment['s3bucket']}/{attachment['s3key']}"
+                                    }
+                                },
+                            }
                         }
-                    }
-                )
-            else:
-                file_type = attachment["type"].split("/")[-1]
-                if file_type == "plain":
-                    file_type = "txt"
-                converse_content_array.append(
-                    {
-                        "document": {
-                            "format": file_type,
-                            "name": sanitize_filename(attachment["name"]),
-                            "source": {"bytes": attachment["content"]},
+                    )
+                    converse_content_with_s3_pointers.append(
+                        {
+                            "video": {
+                                "format": video_format,
+                                "s3source": {
+                                    "s3bucket": attachment["s3bucket"],
+                                    "s3key": attachment["s3key"],
+                                },
+                            }
                         }
-                    }
-                )
-                converse_content_with_s3_pointers.append(
-                    {
-                        "document": {
-                            "format": file_type,
-                            "name": sanitize_filename(attachment["name"]),
-                            "s3source": {
-                                "s3bucket": attachment["s3bucket"],
-                                "s3key": attachment["s3key"],
-                            },
+                    )
+                else:
+                    file_type = attachment["type"].split("/")[-1]
+                    if file_type == "plain":
+                        file_type = "txt"
+                    converse_content_array.append(
+                        {
+                            "document": {
+                                "format": file_type,
+                                "name": sanitize_filename(attachment["name"]),
+                                "source": {"bytes": attachment["content"]},
+                            }
                         }
-                    }
+                    )
+                    converse_content_with_s3_pointers.append(
+                        {
+                            "document": {
+                                "format": file_type,
+                                "name": sanitize_filename(attachment["name"]),
+                                "s3source": {
+                                    "s3bucket": attachment["s3bucket"],
+                                    "s3key": attachment["s3key"],
+                                },
+                            }
+                        }
+                    )
+            reserved_tokens = (
+                estimate_text_tokens(system_prompt)
+                + TIMEZONE_PROMPT_TOKENS
+                + estimate_content_tokens(
+                    converse_content_array, CURRENT_MESSAGE_CONTENT_TYPES
                 )
-        message_content = process_message_history_converse(existing_history) + [
-            {
-                "role": "user",
-                "content": converse_content_array,
-            }
-        ]
-        bedrock_request = {"messages": message_content}
-        if model_provider == "meta":
-            bedrock_request["additionalModelRequestFields"] = {"max_gen_len": 2048}
-        try:
-            if selected_model_id:
-                tracer.put_annotation(key="Model", value=selected_model_id)
-            system_prompt_array = []
-            if (not chat_title and len(bedrock_request.get("messages")) == 1) or (
-                chat_title.startswith("New Conversation:")
-            ):
-                title_prompt_string = (
-                    f"Generate a Title in under 16 characters, "
-                    f'for a Chatbot conversation Header where the initial user prompt is: "{prompt}". '
+            )
+            context_history, context_metrics = fit_history_to_budget(
+                existing_history,
+                selected_model_id,
+                reserved_tokens,
+                HISTORY_CONTENT_TYPES,
+            )
+            if context_metrics["contextDroppedMessages"]:
+                logger.info(
+                    f"Context window: dropped {context_metrics['contextDroppedMessages']} messages "
+                    f"(~{context_metrics['contextDroppedTokenEstimate']} tokens) for {selected_model_id}"
                 )
-                if len(title_theme) > 0:
+            history_messages, pending_downloads = plan_history_content(
+                context_history, HISTORY_CONTENT_TYPES
+            )
+            if pending_downloads:
+                download_history_attachments(s3_client, pending_downloads)
+            message_content = history_messages + [
+                {
+                    "role": "user",
+                    "content": converse_content_array,
+                }
+            ]
+            bedrock_request = {"messages": message_content}
+            if model_provider == "meta":
+                bedrock_request["additionalModelRequestFields"] = {"max_gen_len": 2048}
+            title_future = None
+            try:
+                if selected_model_id:
+                    tracer.put_annotation(key="Model", value=selected_model_id)
+                system_prompt_array = []
+                if (not chat_title and len(bedrock_request.get("messages")) == 1) or (
+                    chat_title.startswith("New Conversation:")
+                ):
+                    title_prompt_string = (
+                        f"Generate a Title in under 16 characters, "
+                        f'for a Chatbot conversation Header where the initial user prompt is: "{prompt}". '
+                    )
+                    if len(title_theme) > 0:
+                        title_prompt_string = (
+                            title_prompt_string
+                            + f' Be creative using the following theme: "{title_theme}" '
+                        )
                     title_prompt_string = (
                         title_prompt_string
-                        + f' Be creative using the following theme: "{title_theme}" '
+                        + 'You MUST answer in RAW JSON format only matching this well defined json format: {"title":"title_value"}'
                     )
-                title_prompt_string = (
-                    title_prompt_string
-                    + 'You MUST answer in RAW JSON format only matching this well defined json format: {"title":"title_value"}'
-                )
 
-                title_prompt_request = [
-                    {"role": "user", "content": [{"text": title_prompt_string}]}
-                ]
-                try:
-                    chat_title = get_title_from_message(
+                    title_prompt_request = [
+                        {"role": "user", "content": [{"text": title_prompt_string}]}
+                    ]
+                    title_future = title_executor.submit(
+                        generate_chat_title,
                         title_prompt_request,
                         title_gen_model if title_gen_model else selected_model_id,
                         connection_id,
                         new_message_id,
                         session_id,
+                        prompt,
                     )
-                except Exception:
-                    chat_title = f"New Conversation: {hash(prompt) % 1000000:06x}"
-            new_conversation = bool(
-                not original_existing_history or len(original_existing_history) == 0
-            )
-            timezone_prompt = (
-                f"The Current Time in UTC is: {message_received_timestamp_utc}. "
-                f"Use the timezone of {timestamp_local_timezone} when making a reference to time. "
-                "ALWAYS use the date format of: Month DD, YYYY HH24:mm:ss. "
-                "ONLY include the time if needed. "
-                "NEVER reference this date randomly. "
-                "Use it to support high quality answers when the current date is NEEDED."
-            )
-
-            if system_prompt:
-                system_prompt = system_prompt + " " + timezone_prompt
-            else:
-                system_prompt = timezone_prompt
-            response = None
-            if (
-                system_prompt
-                and selected_model_id not in SYSTEM_PROMPT_EXCLUDED_MODELS
-                and model_provider != "amazon"
-                and "imported-model" not in selected_model_id
-            ):
-                system_prompt_array.append({"text": system_prompt})
-                response = bedrock_runtime.converse_stream(
-                    messages=bedrock_request.get("messages"),
-                    modelId=selected_model_id,
-                    system=system_prompt_array,
-                    additionalModelRequestFields=bedrock_request.get(
-                        "additionalModelRequestFields", {}
-                    ),
+                new_conversation = bool(
+                    not existing_history or len(existing_history) == 0
                 )
-                # uncomment for prompt debugging
-                # commons.send_websocket_message(logger, apigateway_management_api, connection_id, {
-                #     'type': 'system_prompt_used',
-                #     'system_prompt': system_prompt,
-                #     'session_id':session_id,
-                # });
-            else:
-                response = bedrock_runtime.converse_stream(
-                    messages=bedrock_request.get("messages"),
-                    modelId=selected_model_id,
-                    additionalModelRequestFields=bedrock_request.get(
-                        "additionalModelRequestFields", {}
-                    ),
-                )
-            (
-                assistant_response,
-                reasoning_text,
-                input_tokens,
-                output_tokens,
-                message_end_timestamp_utc,
-                message_stop_reason,
-            ) = process_bedrock_converse_response(
-                apigateway_management_api,
-                response,
-                selected_model_id,
-                connection_id,
-                converse_content_with_s3_pointers,
-                new_conversation,
-                session_id,
-                new_message_id,
-            )
-            store_conversation_history_converse(
-                session_id,
-                selected_model_id,
-                original_existing_history,
-                converse_content_with_s3_pointers,
-                prompt,
-                assistant_response,
-                reasoning_text,
-                user_id,
-                input_tokens,
-                output_tokens,
-                message_end_timestamp_utc,
-                message_received_timestamp_utc,
-                message_id,
-                chat_title,
-                new_conversation,
-                selected_model_category,
-                message_stop_reason,
-                new_message_id,
-            )
-        except Exception as e:
-            if "ResourceNotFoundException" in str(e):
-                logger.error(
-                    f"Imported Model not found: {selected_model_name} - {selected_model_id}"
+                timezone_prompt = build_timezone_prompt(
+                    message_received_timestamp_utc, timestamp_local_timezone
                 )
-                commons.send_websocket_message(
+
+                prompt_caching = supports_prompt_caching(selected_model_id)
+                if (
+                    selected_model_id not in SYSTEM_PROMPT_EXCLUDED_MODELS
+                    and model_provider != "amazon"
+                    and "imported-model" not in selected_model_id
+                ):
+                    system_prompt_array.extend(
+                        build_system_prompt_blocks(
+                            system_prompt,
+                            timezone_prompt,
+                            message_content[-1],
+                            prompt_caching,
+                        )
+                    )
+                if prompt_caching:
+                    add_cache_points(
+                        system_prompt_array,
+                        message_content,
+                        estimate_text_tokens(system_prompt),
+                        context_metrics["contextHistoryTokenEstimate"],
+                    )
+                response = None
+                if system_prompt_array:
+                    response = bedrock_runtime.converse_stream(
+                        messages=bedrock_request.get("messages"),
+                        modelId=selected_model_id,
+                        system=system_prompt_array,
+                        additionalModelRequestFields=bedrock_request.get(
+                            "additionalModelRequestFields", {}
+                        ),
+                    )
+                    # uncomment for prompt debugging
+                    # commons.send_websocket_message(logger, apigateway_management_api, connection_id, {
+                    #     'type': 'system_prompt_used',
+                    #     'system_prompt': system_prompt_array,
+                    #     'session_id':session_id,
+                    # });
+                else:
+                    response = bedrock_runtime.converse_stream(
+                        messages=bedrock_request.get("messages"),
+                        modelId=selected_model_id,
+                        additionalModelRequestFields=bedrock_request.get(
+                            "additionalModelRequestFields", {}
+                        ),
+                    )
+                cancellation = commons.StreamCancellation(
                     logger,
-                    apigateway_management_api,
-                    connection_id,
-                    {
-                        "type": "error",
-                        "session_id": session_id,
-                        "error": f"Imported Model: {selected_model_name} Not Found. Please re-scan models.",
-                    },
+                    lambda: conversations.is_generation_stop_requested(
+                        dynamodb,
+                        conversations_table_name,
+                        session_id,
+                        user_id,
+                        message_id,
+                        message_sent_at,
+                    ),
                 )
-                return {"statusCode": 400}
-            if "ThrottlingException" not in str(e):
-                logger.exception(e)
-            logger.warn(f"Error calling bedrock model (912): {str(e)}")
-            if "have access to the model with the specified model ID." in str(e):
-                model_access_url = f"https://{region}.console.aws.amazon.com/bedrock/home?region={region}#/modelaccess"
-                commons.send_websocket_message(
-                    logger,
+                (
+                    assistant_response,
+                    reasoning_text,
+                    input_tokens,
+                    output_tokens,
+                    message_end_timestamp_utc,
+                    message_stop_reason,
+                    cache_read_tokens,
+                    cache_write_tokens,
+                ) = process_bedrock_converse_response(
                     apigateway_management_api,
+                    response,
+                    selected_model_id,
                     connection_id,
-                    {
-                        "type": "error",
-                        "session_id": session_id,
-                        "error": f"You have not enabled the selected model. Please visit the following link to request model access: [{model_access_url}]({model_access_url})",
-                    },
+                    converse_content_with_s3_pointers,
+                    new_conversation,
+                    session_id,
+                    new_message_id,
+                    context_metrics,
+                    cancellation,
                 )
-            else:
-                commons.send_websocket_message(
-                    logger,
-                    apigateway_management_api,
-                    connection_id,
-                    {
-                        "type": "error",
-                        "session_id": session_id,
-                        "error": f"An Error has occurred, please try again: {str(e)}",
-                    },
+                if message_stop_reason == "cancelled":
+                    # bedrock only reports usage at the end of the stream, so estimate what was used
+                    input_tokens = input_tokens or (
+                        reserved_tokens + context_metrics["contextHistoryTokenEstimate"]
+                    )
+                    output_tokens = output_tokens or estimate_text_tokens(
+                        assistant_response + reasoning_text
+                    )
+                    if cancellation.reason == "stop_requested":
+                        conversations.clear_generation_stop(
+                            dynamodb, conversations_table_name, session_id, user_id
+                        )
+                if title_future:
+                    # only persisting needs the title, the message_title frame is sent when it completes
+                    chat_title = title_future.result()
+                store_conversation_history_converse(
+                    session_id,
+                    selected_model_id,
+                    existing_history,
+                    converse_content_with_s3_pointers,
+                    prompt,
+                    assistant_response,
+                    reasoning_text,
+                    user_id,
+                    input_tokens,
+                    output_tokens,
+                    message_end_timestamp_utc,
+                    message_received_timestamp_utc,
+                    message_id,
+                    chat_title,
+                    new_conversation,
+                    selected_model_category,
+                    message_stop_reason,
+                    new_message_id,
+                    cache_read_tokens,
+                    cache_write_tokens,
                 )
+                in_flight_status = conversations.IN_FLIGHT_COMPLETED
+                queue_turn_embedding(
+                    user_id, session_id, new_message_id, assistant_response
+                )
+            except Exception as e:
+                if "ResourceNotFoundException" in str(e):
+                    logger.error(
+                        f"Imported Model not found: {selected_model_name} - {selected_model_id}"
+                    )
+                    commons.send_websocket_message(
+                        logger,
+                        apigateway_management_api,
+                        connection_id,
+                        {
+                            "type": "error",
+                            "session_id": session_id,
+                            "error": f"Imported Model: {selected_model_name} Not Found. Please re-scan models.",
+                        },
+                    )
+                    return {"statusCode": 400}
+                if "ThrottlingException" not in str(e):
+                    logger.exception(e)
+                logger.warn(f"Error calling bedrock model (912): {str(e)}")
+                if "have access to the model with the specified model ID." in str(e):
+                    model_access_url = f"https://{region}.console.aws.amazon.com/bedrock/home?region={region}#/modelaccess"
+                    commons.send_websocket_message(
+                        logger,
+                        apigateway_management_api,
+                        connection_id,
+                        {
+                            "type": "error",
+                            "session_id": session_id,
+                            "error": f"You have not enabled the selected model. Please visit the following link to request model access: [{model_access_url}]({model_access_url})",
+                        },
+                    )
+                else:
+                    commons.send_websocket_message(
+                        logger,
+                        apigateway_management_api,
+                        connection_id,
+                        {
+                            "type": "error",
+                            "session_id": session_id,
+                            "error": f"An Error has occurred, please try again: {str(e)}",
+                        },
+                    )
+            finally:
+                # never leave a title request running into a frozen execution environment
+                if title_future:
+                    concurrent.futures.wait([title_future])
+        finally:
+            # a failed turn is answered again when it is resent or retried by Lambda
+            finish_in_flight_message(
+                session_id, request_body.get("message_id", None), in_flight_status
+            )
+
+
+def finish_in_flight_message(session_id, message_id, status):
+    """Records the outcome of a claimed message, a failure is only logged"""
+    try:
+        conversations.finish_in_flight_message(
+            dynamodb, conversations_table_name, session_id, message_id, status
+        )
+    except Exception as e:
+        logger.exception(e)
+        logger.error(f"Error updating the in-flight message (9022): {str(e)}")
+
+
+def is_connection_open(connection_id):
+    """Returns True if the WebSocket connection is still open"""
+    try:
+        connection = apigateway_management_api.get_connection(
+            ConnectionId=connection_id
+        )
+        connection_state = connection.get("ConnectionStatus", "OPEN")
+        if connection_state != "OPEN":
+            logger.info(f"WebSocket connection is not open (state: {connection_state})")
+            return False
+    except apigateway_management_api.exceptions.GoneException:
+        logger.warn(f"WebSocket connection is closed (connectionId: {connection_id})")
+        return False
+    return True
+
+
+def get_message_sent_at(timestamp):
+    """Returns the client's ISO 8601 send time of a message as a UTC timestamp, now if it is invalid"""
+    try:
+        sent_at = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return datetime.now(tz=timezone.utc).timestamp()
+    if sent_at.tzinfo is None:
+        sent_at = sent_at.replace(tzinfo=timezone.utc)
+    return sent_at.timestamp()
+
+
+def run_preflight(steps):
+    """
+    Runs the independent I/O steps that precede a Bedrock call concurrently.
+
+    Args:
+        steps (dict): Step name -> (function, is_fatal). is_fatal receives the step's
+            result and returns True when the request cannot continue, or is None.
+
+    Returns:
+        tuple: A tuple containing:
+            - dict: The result of every completed step, by name
+            - str: The name of the first step whose result was fatal, or None
+            - dict: The duration of every completed step in milliseconds, by name
+    """
+    timings = {}
+
+    def timed_step(name, function):
+        step_started = time.monotonic()
+        try:
+            return function()
+        finally:
+            timings[name] = round((time.monotonic() - step_started) * 1000)
+
+    futures = {
+        preflight_executor.submit(timed_step, name, function): name
+        for name, (function, _) in steps.items()
+    }
+    results = {}
+    failed_step = None
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            results[name] = future.result()
+            is_fatal = steps[name][1]
+            if is_fatal and is_fatal(results[name]):
+                failed_step = name
+                break
+    finally:
+        for future in futures:
+            future.cancel()
+        # steps already running are short reads, never leave them to a frozen environment
+        concurrent.futures.wait(futures)
+    return results, failed_step, dict(timings)
 
 
 @tracer.capture_method
@@ -572,78 +885,161 @@ def get_title_from_message(
     return chat_title["title"]
 
 
+def generate_chat_title(
+    messages: list,
+    selected_model_id: str,
+    connection_id: str,
+    message_id: str,
+    session_id: str,
+    prompt: str,
+) -> str:
+    """Generates the chat title off the main thread, falling back to a placeholder title on failure"""
+    try:
+        return get_title_from_message(
+            messages,
+            selected_model_id,
+            connection_id,
+            message_id,
+            session_id,
+        )
+    except Exception as e:
+        logger.warn(f"Error generating conversation title (0902): {str(e)}")
+        return f"New Conversation: {hash(prompt) % 1000000:06x}"
+
+
+def queue_turn_embedding(user_id, session_id, message_id, text):
+    """Queues an answer for embedding, a failure only leaves it out of semantic search"""
+    if not text.strip():
+        return
+    try:
+        sqs_client.send_message(
+            QueueUrl=turn_index_queue_url,
+            MessageBody=json.dumps(
+                {
+                    "kind": conversations.TURN_INDEX_KIND_EMBEDDING,
+                    "user_id": user_id,
+                    "session_id": session_id,
+                    "message_id": message_id,
+                    "text": text[:EMBEDDING_TEXT_MAX_CHARS],
+                }
+            ),
+        )
+    except Exception as e:
+        logger.exception(e)
+        logger.error(f"Error queuing conversation turn embedding (9023): {str(e)}")
+
+
 @tracer.capture_method
-def download_s3_content(item, content_type):
+def index_queued_turns(records):
     """
-    Download content from S3 and update the item with the downloaded content.
-
-    Args:
-        item (dict): The item containing the content to be downloaded.
-        content_type (str): The type of content, either 'document' or 'image'.
+    Adds a batch of queued turns to the search index and embeds the queued answers.
 
-    Returns:
-        None
+    Each kind of turn is handled in one pass, turns of sessions deleted while they were
+    queued are dropped. Returns the SQS partial batch response, so only the turns of a
+    failed pass are retried by the queue.
     """
-    content = item[content_type]
-    status = False
-    if "s3source" in content:
-        s3_bucket = content["s3source"]["s3bucket"]
-        s3_key = content["s3source"]["s3key"]
+    turns = {}
+    for record in records:
+        try:
+            turn = json.loads(record["body"])
+            turns[record["messageId"]] = {
+                key: turn[key] for key in TURN_INDEX_REQUEST_KEYS[turn["kind"]]
+            }
+        except (KeyError, TypeError, ValueError):
+            logger.warn(
+                f"Dropping malformed turn index request: {record.get('messageId')}"
+            )
+    try:
+        metadata = conversations.batch_get_conversation_metadata(
+            dynamodb,
+            conversations_table_name,
+            list(dict.fromkeys(turn["session_id"] for turn in turns.values())),
+        )
+    except Exception as e:
+        logger.exception(e)
+        logger.error(f"Error reading queued turn sessions (9019): {str(e)}")
+        return {
+            "batchItemFailures": [
+                {"itemIdentifier": message_id} for message_id in turns
+            ]
+        }
+    live_turns = {
+        message_id: turn
+        for message_id, turn in turns.items()
+        if metadata.get(turn["session_id"], {}).get("user_id", {}).get("S")
+        == turn["user_id"]
+    }
+    failed_message_ids = []
+    for kind, index_turns in (
+        (
+            conversations.TURN_INDEX_KIND_SEARCH,
+            lambda turns: conversations.index_conversation_turns(
+                dynamodb, search_index_table_name, turns
+            ),
+        ),
+        (conversations.TURN_INDEX_KIND_EMBEDDING, semantic_index.add_turns),
+    ):
+        kind_turns = {
+            message_id: turn
+            for message_id, turn in live_turns.items()
+            if turn["kind"] == kind
+        }
+        if not kind_turns:
+            continue
         try:
-            response = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
-            if response is not None and response["Body"] is not None:
-                file_content = response["Body"].read()
-                content["source"] = {"bytes": file_content}
-                status = True
-        except ClientError as e:
-            logger.error(f"Error downloading content from S3: {e}")
-            if e.response["Error"]["Code"] == "NoSuchKey":
-                logger.error("Key %s not found in bucket %s", s3_key, s3_bucket)
+            index_turns(list(kind_turns.values()))
+        except Exception as e:
             logger.exception(e)
-        del content["s3source"]
-        return status
+            logger.error(f"Error indexing {kind} turns (9019): {str(e)}")
+            failed_message_ids.extend(kind_turns)
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": message_id} for message_id in failed_message_ids
+        ]
+    }
 
 
 @tracer.capture_method
-def load_documents_from_existing_history(existing_history):
+def send_semantic_search_results(query, top_k, connection_id, user_id):
     """
-    Load documents and images from the existing history, where the content is stored in S3.
+    Sends the user's stored answers closest in meaning to a query.
 
-    Args:
-        existing_history (list): A list of dictionaries representing the existing history.
-
-    Returns:
-        list: The modified history with the downloaded content.
+    Answers of deleted sessions are left out, each result carries the session title.
     """
-    modified_history = []
-    existing_history = copy.deepcopy(existing_history)
-    for item in existing_history:
-        modified_item = {}
-        modified_item["role"] = item["role"]
-        modified_item["timestamp"] = item["timestamp"]
-        modified_item["message_id"] = item["message_id"]
-        modified_item["content"] = []
-        for content_item in item["content"]:
-            modified_content_item = {}
-            add_item = True
-            for key, value in content_item.items():
-                if key in ["video"]:
-                    modified_content_item[key] = (
-                        convert_video_s3_source_to_bedrock_format(value)
-                    )
-                elif key in ["text"]:
-                    modified_content_item[key] = value
-                elif key in ["document", "image"]:
-                    modified_content_item[key] = value
-                    download_s3_content_worked = download_s3_content(
-                        modified_content_item, key
-                    )
-                    if not download_s3_content_worked:
-                        add_item = False
-            if add_item:
-                modified_item["content"].append(modified_content_item)
-        modified_history.append(modified_item)
-    return modified_history
+    try:
+        top_k = max(1, min(int(top_k), SEMANTIC_SEARCH_MAX_TOP_K))
+    except (TypeError, ValueError):
+        top_k = SEMANTIC_SEARCH_TOP_K
+    results = []
+    try:
+        if query.strip():
+            # extra candidates make up for answers of deleted sessions
+            candidates = semantic_index.search(user_id, query, top_k * 2)
+            metadata = conversations.batch_get_conversation_metadata(
+                dynamodb,
+                conversations_table_name,
+                list(dict.fromkeys(result["session_id"] for result in candidates)),
+            )
+            for result in candidates:
+                item = metadata.get(result["session_id"])
+                if item and item.get("user_id", {}).get("S") == user_id:
+                    result["title"] = item.get("title", {}).get("S", "")
+                    results.append(result)
+            results = results[:top_k]
+    except Exception as e:
+        logger.exception(e)
+        logger.error(f"Error running semantic search (9020): {str(e)}")
+    commons.send_websocket_message(
+        logger,
+        apigateway_management_api,
+        connection_id,
+        {
+            "type": "semantic_search",
+            "query": query,
+            "results": results,
+            "timestamp": datetime.now(tz=timezone.utc).isoformat(),
+        },
+    )
 
 
 @tracer.capture_method
@@ -666,8 +1062,10 @@ def store_conversation_history_converse(
     selected_model_category,
     message_stop_reason,
     new_message_id,
+    cache_read_tokens=0,
+    cache_write_tokens=0,
 ):
-    """Function to store conversation history in DDB or S3 in the converse format"""
+    """Function to append a turn to the conversation history in the converse format"""
     # logger.info(f"Storing conversation for session ID: {session_id}")
 
     if not (user_message.strip() and assistant_message.strip()):
@@ -681,12 +1079,10 @@ def store_conversation_history_converse(
             )
         return
 
-    prefix = rf"{user_id}/{session_id}"
-    # Prepare the updated conversation history once
     assistant_content_array = [{"text": assistant_message}]
     if reasoning_text and len(reasoning_text) > 1:
         assistant_content_array.append({"reasoning": reasoning_text})
-    conversation_history = existing_history + [
+    new_messages = [
         {
             "role": "user",
             "content": converse_content_array,
@@ -702,72 +1098,26 @@ def store_conversation_history_converse(
         },
     ]
 
-    # Convert to JSON string once
-    conversation_json = json.dumps(conversation_history)
-    conversation_history_size = len(conversation_json.encode("utf-8"))
-    current_timestamp = str(datetime.now(tz=timezone.utc).timestamp())
-
     try:
-        if conversation_history_size > (MAX_DDB_SIZE * DDB_SIZE_THRESHOLD):
-            logger.warn(
-                f"Warning: Session ID {session_id} has reached 80% of the DynamoDB limit. Storing conversation history in S3."
-            )
-
-            # Store in S3
-            s3_client.put_object(
-                Bucket=conversation_history_bucket,
-                Key=S3_KEY_FORMAT.format(prefix=prefix, session_id=session_id),
-                Body=conversation_json.encode("utf-8"),
-            )
-
-            # Update DynamoDB to indicate S3 storage
-            dynamodb.update_item(
-                TableName=conversations_table_name,
-                Key={"session_id": {"S": session_id}},
-                UpdateExpression="SET conversation_history_in_s3=:true, last_modified_date = :current_time, last_message_id=:last_message_id",
-                ExpressionAttributeValues={
-                    ":true": {"BOOL": True},
-                    ":current_time": {"N": current_timestamp},
-                    ":last_message_id": {"S": new_message_id},
-                },
-            )
-
-        else:
-            # Store in DynamoDB
-            logger.info(f"Storing TITLE for conversation history in DynamoDB: {title}")
-            if new_conversation:
-                dynamodb.put_item(
-                    TableName=conversations_table_name,
-                    Item={
-                        "session_id": {"S": session_id},
-                        "user_id": {"S": user_id},
-                        "title": {"S": title},
-                        "last_modified_date": {"N": current_timestamp},
-                        "selected_model_id": {"S": selected_model_id},
-                        "category": {"S": selected_model_category},
-                        "last_message_id": {"S": new_message_id},
-                        "conversation_history": {"S": conversation_json},
-                        "conversation_history_in_s3": {"BOOL": False},
-                    },
-                )
-            else:
-                dynamodb.update_item(
-                    TableName=conversations_table_name,
-                    Key={"session_id": {"S": session_id}},
-                    UpdateExpression="SET last_modified_date = :current_time, title = :title, selected_model_id = :selected_model_id, conversation_history = :conversation_history, category = :category, last_message_id=:last_message_id",
-                    ExpressionAttributeValues={
-                        ":current_time": {"N": current_timestamp},
-                        ":title": {"S": title},
-                        ":selected_model_id": {"S": selected_model_id},
-                        ":conversation_history": {"S": conversation_json},
-                        ":category": {"S": selected_model_category},
-                        ":last_message_id": {"S": new_message_id},
-                    },
-                )
-
-        # Batch token usage update
-        conversations.save_token_usage(
-            user_id, input_tokens, output_tokens, dynamodb, usage_table_name
+        # only this turn's messages are written, older sessions are migrated on their first write
+        logger.info(f"Storing TITLE for conversation history in DynamoDB: {title}")
+        conversation_store.append_turn(
+            session_id,
+            user_id,
+            existing_history,
+            new_messages,
+            {
+                "title": title,
+                "selected_model_id": selected_model_id,
+                "category": selected_model_category,
+                "last_message_id": new_message_id,
+            },
+            token_usage={
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "cache_read_tokens": cache_read_tokens,
+                "cache_write_tokens": cache_write_tokens,
+            },
         )
 
     except (ClientError, Exception) as e:
@@ -776,22 +1126,18 @@ def store_conversation_history_converse(
 
 
 @tracer.capture_method
-def load_system_prompt_config(system_prompt_user_or_system, user_id):
+def load_system_prompt_config(user_key, config_type):
     """Function to load system prompt from DDB config"""
-    user_key = "system"
-    if system_prompt_user_or_system == "user":
-        user_key = user_id if user_id else "system"
-    if system_prompt_user_or_system == "global":
-        system_prompt_user_or_system = "system"
     # Get the configuration from DynamoDB
-    response = config_table.get_item(
-        Key={"user": user_key, "config_type": system_prompt_user_or_system}
-    )
+    response = config_table.get_item(Key={"user": user_key, "config_type": config_type})
     config = response.get("Item", {})
     config_item = config.get("config", {})
     return config_item.get("systemPrompt", "")
 
 
+system_prompt_cache = SystemPromptCache(load_system_prompt_config)
+
+
 def sanitize_filename(filename: str) -> str:
     """
     Sanitizes a filename to only contain alphanumeric characters, whitespace characters, hyphens, parentheses, and square brackets.
@@ -809,27 +1155,9 @@ def sanitize_filename(filename: str) -> str:
     return sanitized_filename
 
 
-@tracer.capture_method(capture_response=False)
-def convert_video_s3_source_to_bedrock_format(input_json):
-    # Extract the necessary information from the input dictionary
-    videoformat = input_json["format"]
-    s3bucket = input_json["s3source"]["s3bucket"]
-    s3key = input_json["s3source"]["s3key"]
-
-    # Construct the S3 URI
-    s3_uri = f"s3://{s3bucket}/{s3key}"
-
-    # Create the new dictionary structure
-    output_dict = {"format": videoformat, "source": {"s3Location": {"uri": s3_uri}}}
-
-    return output_dict
-
-
 def generate(
     connection_id,
     result_length,
-    buffer,
-    char_count,
     session_id,
     message_id,
     tokenizer,
@@ -872,99 +1200,72 @@ def generate(
             )
             event_stream = response["body"]
             counter = 0
-            for event in event_stream:
-                if "chunk" in event:
-                    data = event["chunk"]["bytes"]
-                    event_json = json.loads(data.decode("utf8"))
-                    message_stop_reason = event_json["stop_reason"]
-                    if event_json["prompt_token_count"] is not None:
-                        current_input_tokens += event_json["prompt_token_count"]
-                    if event_json["generation_token_count"] is not None:
-                        current_output_tokens += event_json["generation_token_count"]
-                    if message_stop_reason is not None and len(message_stop_reason) > 2:
-                        result += event_json["generation"]
-                        message_end_timestamp_utc = datetime.now(
-                            timezone.utc
-                        ).isoformat()
-                        needs_code_end = False
-                        if result.count("```") % 2 != 0:
-                            needs_code_end = True
-                        # Send any remaining buffered messages
-                        if buffer:
-                            combined_text = "".join(buffer)
-                            commons.send_websocket_message(
-                                logger,
-                                apigateway_management_api,
-                                connection_id,
+            with commons.WebSocketSender(
+                logger, apigateway_management_api, connection_id
+            ) as sender:
+                for event in event_stream:
+                    if "chunk" in event:
+                        data = event["chunk"]["bytes"]
+                        event_json = json.loads(data.decode("utf8"))
+                        message_stop_reason = event_json["stop_reason"]
+                        if event_json["prompt_token_count"] is not None:
+                            current_input_tokens += event_json["prompt_token_count"]
+                        if event_json["generation_token_count"] is not None:
+                            current_output_tokens += event_json[
+                                "generation_token_count"
+                            ]
+                        if (
+                            message_stop_reason is not None
+                            and len(message_stop_reason) > 2
+                        ):
+                            result += event_json["generation"]
+                            message_end_timestamp_utc = datetime.now(
+                                timezone.utc
+                            ).isoformat()
+                            needs_code_end = False
+                            if result.count("```") % 2 != 0:
+                                needs_code_end = True
+                            # Deliver any coalesced deltas first
+                            sender.flush()
+                            sender.send(
                                 {
-                                    "type": "content_block_delta",
+                                    "type": "message_stop",
+                                    "session_id": session_id,
+                                    "message_id": message_id,
+                                    "message_counter": counter,
+                                    "message_stop_reason": message_stop_reason,
+                                    "needs_code_end": needs_code_end,
+                                    "new_conversation": True,
+                                    "timestamp": message_end_timestamp_utc,
+                                    "amazon_bedrock_invocation_metrics": {
+                                        "inputTokenCount": current_input_tokens,
+                                        "outputTokenCount": current_output_tokens,
+                                    },
+                                },
+                            )
+                        elif result_length + len(result) == 0:
+                            sender.send(
+                                {
+                                    "type": "message_start",
                                     "message": {"model": selected_model_name},
-                                    "delta": {"text": combined_text},
+                                    "delta": {"text": event_json["generation"]},
                                     "message_id": message_id,
                                     "session_id": session_id,
                                 },
                             )
-                            buffer.clear()
-                            char_count = 0
-                        commons.send_websocket_message(
-                            logger,
-                            apigateway_management_api,
-                            connection_id,
-                            {
-                                "type": "message_stop",
-                                "session_id": session_id,
-                                "message_id": message_id,
-                                "message_counter": counter,
-                                "message_stop_reason": message_stop_reason,
-                                "needs_code_end": needs_code_end,
-                                "new_conversation": True,
-                                "timestamp": message_end_timestamp_utc,
-                                "amazon_bedrock_invocation_metrics": {
-                                    "inputTokenCount": current_input_tokens,
-                                    "outputTokenCount": current_output_tokens,
-                                },
-                            },
-                        )
-                    else:
-                        if result_length + len(result) <= 1000:
-                            commons.send_websocket_message(
-                                logger,
-                                apigateway_management_api,
-                                connection_id,
+                        else:
+                            sender.send_delta(
                                 {
-                                    "type": "message_start"
-                                    if (result_length + len(result) == 0)
-                                    else "content_block_delta",
+                                    "type": "content_block_delta",
                                     "message": {"model": selected_model_name},
                                     "delta": {"text": event_json["generation"]},
                                     "message_id": message_id,
                                     "session_id": session_id,
                                 },
                             )
-                        else:
-                            buffer.append(event_json["generation"])
-                            char_count += len(event_json["generation"])
-                            # Check if the accumulated buffer exceeds or equals 300 characters
-                            if char_count >= 300:
-                                combined_text = "".join(buffer)
-                                commons.send_websocket_message(
-                                    logger,
-                                    apigateway_management_api,
-                                    connection_id,
-                                    {
-                                        "type": "content_block_delta",
-                                        "message": {"model": selected_model_name},
-                                        "delta": {"text": combined_text},
-                                        "message_id": message_id,
-                                        "session_id": session_id,
-                                    },
-                                )
-                                # Clear the buffer and reset character count
-                                buffer.clear()
-                                char_count = 0
 
-                    counter += 1
-                    result += event_json["generation"]
+                        counter += 1
+                        result += event_json["generation"]
             json_result = {"generation": result, "stop_reason": message_stop_reason}
             return (
                 json_result,
@@ -1024,8 +1325,6 @@ def auto_generate(
     Handle longer responses that exceed token limit
     """
     assistant_response = ""
-    buffer = []
-    char_count = 0
     result_length = 0
     iterations = 0
     (
@@ -1038,8 +1337,6 @@ def auto_generate(
     ) = generate(
         connection_id,
         result_length,
-        buffer,
-        char_count,
         session_id,
         message_id,
         tokenizer,
@@ -1069,8 +1366,6 @@ def auto_generate(
         ) = generate(
             connection_id,
             result_length,
-            buffer,
-            char_count,
             session_id,
             message_id,
             tokenizer,
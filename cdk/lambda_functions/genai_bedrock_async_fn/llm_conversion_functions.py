@@ -1,26 +1,157 @@
+import concurrent.futures
 import json
 import re
 import os
 import commons
 from datetime import datetime, timezone
 from aws_lambda_powertools import Logger
+from botocore.exceptions import ClientError
 
 logger = Logger(service="BedrockAsyncLLMFunctions")
 WEBSOCKET_API_ENDPOINT = os.environ["WEBSOCKET_API_ENDPOINT"]
 
 
-def process_message_history_converse(existing_history):
-    """Function to process message history for converse"""
+# content block types of earlier turns that may be replayed to the model
+HISTORY_REPLAYABLE_CONTENT_TYPES = ("text", "image", "document", "video")
+HISTORY_DOWNLOAD_WORKERS = 8
+
+
+def parse_history_content_types(value):
+    """
+    Parses the comma separated content block types replayed from history.
+
+    Text is always replayed, unknown types are ignored.
+    """
+    content_types = {
+        content_type.strip().lower() for content_type in (value or "").split(",")
+    }
+    return tuple(
+        content_type
+        for content_type in HISTORY_REPLAYABLE_CONTENT_TYPES
+        if content_type == "text" or content_type in content_types
+    )
+
+
+# content block types from earlier turns that are replayed to the model on every request,
+# attachments of earlier turns are only downloaded when their type is listed
+HISTORY_CONTENT_TYPES = parse_history_content_types(
+    os.environ.get("HISTORY_CONTENT_TYPES", "text")
+)
+
+
+def plan_history_content(existing_history, content_types=HISTORY_CONTENT_TYPES):
+    """
+    Plan the history part of a converse request.
+
+    Only the content blocks the outgoing request will include are kept. Stored
+    blocks are shared rather than copied, and attachment blocks that point to S3
+    are rebuilt without their s3source and queued for download.
+
+    Args:
+        existing_history (list): The stored conversation history.
+        content_types (tuple): The content block types to replay from history.
+
+    Returns:
+        tuple: A tuple containing:
+            - list: The normalized history messages for the converse request
+            - list: Pending downloads as (content list, content item, s3source) tuples.
+              The bytes must be loaded into the item's source, or the item removed
+              from its content list if the download fails.
+    """
     normalized_history = []
+    pending_downloads = []
     for message in existing_history:
         role = message.get("role")
-        content = [item for item in message.get("content") if "text" in item]
-        if role in ["user", "assistant"]:
-            normalized_message = {"role": role, "content": content}
+        if role not in ["user", "assistant"]:
+            continue
+        content = []
+        stored_content = message.get("content")
+        if not isinstance(stored_content, list):
+            stored_content = []
+        for item in stored_content:
+            content_type = next((key for key in content_types if key in item), None)
+            if not content_type:
+                continue
+            block = item[content_type]
+            if content_type == "video" and "s3source" in block:
+                content.append(
+                    {content_type: convert_video_s3_source_to_bedrock_format(block)}
+                )
+            elif content_type in ["document", "image"] and "s3source" in block:
+                planned_item = {
+                    content_type: {
+                        key: value for key, value in block.items() if key != "s3source"
+                    }
+                }
+                content.append(planned_item)
+                pending_downloads.append((content, planned_item, block["s3source"]))
+            else:
+                content.append(item)
+        normalized_history.append({"role": role, "content": content})
+
+    return normalized_history, pending_downloads
 
-            normalized_history.append(normalized_message)
 
-    return normalized_history
+def download_s3_content(s3_client, s3source):
+    """
+    Download the bytes of a stored attachment from S3.
+
+    Args:
+        s3_client (boto3.client): S3 client.
+        s3source (dict): The s3bucket and s3key of the attachment.
+
+    Returns:
+        bytes: The attachment content, or None if it could not be downloaded.
+    """
+    s3_bucket = s3source["s3bucket"]
+    s3_key = s3source["s3key"]
+    try:
+        response = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
+        if response is not None and response["Body"] is not None:
+            return response["Body"].read()
+    except ClientError as e:
+        logger.error(f"Error downloading content from S3: {e}")
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            logger.error("Key %s not found in bucket %s", s3_key, s3_bucket)
+        logger.exception(e)
+    return None
+
+
+def download_history_attachments(s3_client, pending_downloads):
+    """
+    Load the attachments planned by plan_history_content, in parallel.
+
+    Attachments that fail to download are removed from the request, like before.
+
+    Args:
+        s3_client (boto3.client): S3 client.
+        pending_downloads (list): (content list, content item, s3source) tuples.
+
+    Returns:
+        None
+    """
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(HISTORY_DOWNLOAD_WORKERS, len(pending_downloads))
+    ) as executor:
+        contents = executor.map(
+            lambda s3source: download_s3_content(s3_client, s3source),
+            [s3source for _, _, s3source in pending_downloads],
+        )
+        for (content, item, _), file_content in zip(pending_downloads, contents):
+            if file_content is None:
+                content[:] = [existing for existing in content if existing is not item]
+                continue
+            block = next(iter(item.values()))
+            block["source"] = {"bytes": file_content}
+
+
+def convert_video_s3_source_to_bedrock_format(input_json):
+    """Converts a stored video block with an s3source into the converse s3Location format"""
+    videoformat = input_json["format"]
+    s3bucket = input_json["s3source"]["s3bucket"]
+    s3key = input_json["s3source"]["s3key"]
+    s3_uri = f"s3://{s3bucket}/{s3key}"
+    return {"format": videoformat, "source": {"s3Location": {"uri": s3_uri}}}
 
 
 def process_bedrock_converse_response(
@@ -32,159 +163,137 @@ def process_bedrock_converse_response(
     new_conversation,
     session_id,
     message_id,
+    context_metrics=None,
+    cancellation=None,
 ):
-    """Function to process a bedrock response and send the messages back to the websocket for converse API"""
+    """Function to process a bedrock response and send the messages back to the websocket for converse API
+
+    When the optional StreamCancellation is cancelled, the Bedrock stream is closed early
+    and the partial answer is returned with the stop reason "cancelled".
+    """
     result_text = ""
     reasoning_text = ""
     current_input_tokens = 0
     current_output_tokens = 0
+    cache_read_tokens = 0
+    cache_write_tokens = 0
     counter = 0
     message_end_timestamp_utc = ""
     message_stop_reason = ""
     stream = response.get("stream")
 
     if stream:
-        buffer = []
-        char_count = 0
-        is_reasoning = False
-        for event in stream:
-            if "contentBlockDelta" in event:
-                msg_text = ""
-                if "reasoningContent" in event["contentBlockDelta"]["delta"]:
-                    msg_text = event["contentBlockDelta"]["delta"]["reasoningContent"][
-                        "text"
-                    ]
-                    is_reasoning = True
-                else:
-                    msg_text = event["contentBlockDelta"]["delta"]["text"]
-                    is_reasoning = False
-
-                if counter == 0:
-                    # Always send the first message immediately
-                    commons.send_websocket_message(
-                        logger,
-                        apigateway_management_api,
-                        connection_id,
-                        {
-                            "type": "message_start",
-                            "message": {"model": selected_model_id},
-                            "message_id": message_id,
-                            "session_id": session_id,
-                            "is_reasoning": is_reasoning,
-                            "delta": {"text": msg_text},
-                            "message_counter": counter,
-                        },
-                    )
-                elif len(result_text) < 1000:
-                    commons.send_websocket_message(
-                        logger,
-                        apigateway_management_api,
-                        connection_id,
-                        {
-                            "type": "content_block_delta",
-                            "message_id": message_id,
-                            "session_id": session_id,
-                            "is_reasoning": is_reasoning,
-                            "delta": {"text": msg_text},
-                            "message_counter": counter,
-                        },
-                    )
-                else:
-                    # Add the new message text to the buffer
-                    buffer.append(msg_text)
-                    char_count += len(msg_text)
-
-                    # Check if the accumulated buffer exceeds or equals 300 characters
-                    if char_count >= 300:
-                        combined_text = "".join(buffer)
-                        commons.send_websocket_message(
-                            logger,
-                            apigateway_management_api,
-                            connection_id,
+        # deltas are delivered by a background sender, so reading the stream never waits on the websocket
+        with commons.WebSocketSender(
+            logger, apigateway_management_api, connection_id, cancellation=cancellation
+        ) as sender:
+            for event in stream:
+                if cancellation and cancellation.is_cancelled():
+                    # stop paying for output tokens nobody will read
+                    message_stop_reason = "cancelled"
+                    stream.close()
+                    break
+                if "contentBlockDelta" in event:
+                    msg_text = ""
+                    if "reasoningContent" in event["contentBlockDelta"]["delta"]:
+                        msg_text = event["contentBlockDelta"]["delta"][
+                            "reasoningContent"
+                        ]["text"]
+                        is_reasoning = True
+                    else:
+                        msg_text = event["contentBlockDelta"]["delta"]["text"]
+                        is_reasoning = False
+
+                    if counter == 0:
+                        # Always send the first message immediately
+                        sender.send(
+                            {
+                                "type": "message_start",
+                                "message": {"model": selected_model_id},
+                                "message_id": message_id,
+                                "session_id": session_id,
+                                "is_reasoning": is_reasoning,
+                                "delta": {"text": msg_text},
+                                "message_counter": counter,
+                            },
+                        )
+                    else:
+                        # reasoning and answer text are coalesced in separate buffers
+                        sender.send_delta(
                             {
                                 "type": "content_block_delta",
                                 "message_id": message_id,
                                 "session_id": session_id,
                                 "is_reasoning": is_reasoning,
-                                "delta": {"text": combined_text},
+                                "delta": {"text": msg_text},
                                 "message_counter": counter,
                             },
+                            "reasoning" if is_reasoning else "text",
                         )
-                        # Clear the buffer and reset character count
-                        buffer.clear()
-                        char_count = 0
-                if is_reasoning:
-                    reasoning_text += msg_text
-                else:
-                    result_text += msg_text
-                counter += 1
-
-            if "messageStop" in event:
-                message_stop = event["messageStop"]
-                if "stopReason" in message_stop:
-                    message_stop_reason = message_stop["stopReason"]
-
-            if "metadata" in event:
-                metadata = event["metadata"]
-                if "usage" in metadata:
-                    current_input_tokens = metadata["usage"]["inputTokens"]
-                    current_output_tokens = metadata["usage"]["outputTokens"]
-
-        # Send any remaining buffered messages
-        if buffer:
-            combined_text = "".join(buffer)
-            commons.send_websocket_message(
-                logger,
-                apigateway_management_api,
-                connection_id,
+                    if is_reasoning:
+                        reasoning_text += msg_text
+                    else:
+                        result_text += msg_text
+                    counter += 1
+
+                if "messageStop" in event:
+                    message_stop = event["messageStop"]
+                    if "stopReason" in message_stop:
+                        message_stop_reason = message_stop["stopReason"]
+
+                if "metadata" in event:
+                    metadata = event["metadata"]
+                    if "usage" in metadata:
+                        current_input_tokens = metadata["usage"]["inputTokens"]
+                        current_output_tokens = metadata["usage"]["outputTokens"]
+                        cache_read_tokens = metadata["usage"].get(
+                            "cacheReadInputTokens", 0
+                        )
+                        cache_write_tokens = metadata["usage"].get(
+                            "cacheWriteInputTokens", 0
+                        )
+
+            logger.info(
+                f"TokenCounts (Converse): {str(current_input_tokens)}/{str(current_output_tokens)} "
+                f"cache read/write: {cache_read_tokens}/{cache_write_tokens}"
+            )
+            # Send the message_stop event to the WebSocket client once every delta was delivered
+            sender.flush()
+            message_end_timestamp_utc = datetime.now(timezone.utc).isoformat()
+            needs_code_end = False
+
+            if result_text.count("```") % 2 != 0:
+                needs_code_end = True
+            sender.send(
                 {
-                    "type": "content_block_delta",
+                    "type": "message_stop",
                     "message_id": message_id,
                     "session_id": session_id,
-                    "is_reasoning": is_reasoning,
-                    "delta": {"text": combined_text},
                     "message_counter": counter,
+                    "message_stop_reason": message_stop_reason,
+                    "needs_code_end": needs_code_end,
+                    "new_conversation": new_conversation,
+                    "timestamp": message_end_timestamp_utc,
+                    "amazon_bedrock_invocation_metrics": {
+                        "inputTokenCount": current_input_tokens,
+                        "outputTokenCount": current_output_tokens,
+                        "cacheReadInputTokenCount": cache_read_tokens,
+                        "cacheWriteInputTokenCount": cache_write_tokens,
+                        **(context_metrics or {}),
+                    },
                 },
             )
-            buffer.clear()
 
-        logger.info(
-            f"TokenCounts (Converse): {str(current_input_tokens)}/{str(current_output_tokens)}"
-        )
-        # Send the message_stop event to the WebSocket client
-        message_end_timestamp_utc = datetime.now(timezone.utc).isoformat()
-        needs_code_end = False
-
-        if result_text.count("```") % 2 != 0:
-            needs_code_end = True
-        commons.send_websocket_message(
-            logger,
-            apigateway_management_api,
-            connection_id,
-            {
-                "type": "message_stop",
-                "message_id": message_id,
-                "session_id": session_id,
-                "message_counter": counter,
-                "message_stop_reason": message_stop_reason,
-                "needs_code_end": needs_code_end,
-                "new_conversation": new_conversation,
-                "timestamp": message_end_timestamp_utc,
-                "amazon_bedrock_invocation_metrics": {
-                    "inputTokenCount": current_input_tokens,
-                    "outputTokenCount": current_output_tokens,
-                },
-            },
-        )
-
-        return (
-            result_text,
-            reasoning_text,
-            current_input_tokens,
-            current_output_tokens,
-            message_end_timestamp_utc,
-            message_stop_reason,
-        )
+            return (
+                result_text,
+                reasoning_text,
+                current_input_tokens,
+                current_output_tokens,
+                message_end_timestamp_utc,
+                message_stop_reason,
+                cache_read_tokens,
+                cache_write_tokens,
+            )
 
 
 def process_bedrock_converse_response_for_title(response):
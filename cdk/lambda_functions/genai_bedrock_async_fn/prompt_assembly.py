@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+
+# seconds a loaded system prompt is reused before it is read from the config table again
+SYSTEM_PROMPT_CACHE_TTL_SECONDS = int(
+    os.environ.get("SYSTEM_PROMPT_CACHE_TTL_SECONDS", "300")
+)
+SYSTEM_PROMPT_CACHE_MAX_ENTRIES = 1000
+
+
+def resolve_prompt_config_key(system_prompt_user_or_system, user_id):
+    """Returns the (user, config_type) key of the config item holding the system prompt"""
+    user_key = "system"
+    if system_prompt_user_or_system == "user":
+        user_key = user_id if user_id else "system"
+    if system_prompt_user_or_system == "global":
+        system_prompt_user_or_system = "system"
+    return user_key, system_prompt_user_or_system
+
+
+class SystemPromptCache:
+    """
+    Caches system prompts per config key for the lifetime of a warm container.
+
+    Entries expire after a TTL, so prompts saved from another container are picked up
+    without a config table read on every request. A client that just saved its
+    settings can force a reload with invalidate().
+    """
+
+    def __init__(
+        self,
+        loader,
+        ttl_seconds=SYSTEM_PROMPT_CACHE_TTL_SECONDS,
+        max_entries=SYSTEM_PROMPT_CACHE_MAX_ENTRIES,
+    ):
+        """
+        Args:
+            loader (callable): Loads the prompt for a (user, config_type) key.
+            ttl_seconds (int): Seconds an entry is served from the cache.
+            max_entries (int): Entries kept before the oldest are evicted.
+        """
+        self.loader = loader
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, system_prompt_user_or_system, user_id):
+        """Returns the cached system prompt for the scope, loading it when missing or expired"""
+        key = resolve_prompt_config_key(system_prompt_user_or_system, user_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry[1] > now:
+            return entry[0]
+        system_prompt = self.loader(*key) or ""
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                self._entries.pop(min(self._entries, key=lambda k: self._entries[k][1]))
+            self._entries[key] = (system_prompt, now + self.ttl_seconds)
+        return system_prompt
+
+    def invalidate(self, user_id=None):
+        """Drops the global prompt and the given user's prompt, or every entry when no user is given"""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                return
+            for key in list(self._entries):
+                if key[0] in ["system", user_id]:
+                    del self._entries[key]
+
+
+def build_timezone_prompt(message_received_timestamp_utc, timestamp_local_timezone):
+    """Builds the per-request prompt with the current time, it is never cached"""
+    return (
+        f"The Current Time in UTC is: {message_received_timestamp_utc}. "
+        f"Use the timezone of {timestamp_local_timezone} when making a reference to time. "
+        "ALWAYS use the date format of: Month DD, YYYY HH24:mm:ss. "
+        "ONLY include the time if needed. "
+        "NEVER reference this date randomly. "
+        "Use it to support high quality answers when the current date is NEEDED."
+    )
+
+
+def build_system_prompt_blocks(
+    system_prompt, timezone_prompt, new_message, prompt_caching
+):
+    """
+    Returns the converse system blocks of a request.
+
+    The timestamp changes on every request, so with prompt caching it goes into the new
+    user message instead and the system blocks stay identical between requests. The
+    content list of new_message is replaced in that case.
+    """
+    if prompt_caching:
+        new_message["content"] = [{"text": timezone_prompt}] + new_message["content"]
+        return [{"text": system_prompt}] if system_prompt else []
+    if system_prompt:
+        return [{"text": system_prompt + " " + timezone_prompt}]
+    return [{"text": timezone_prompt}]
+
+
+def is_reload_requested(value):
+    """Parses the reloadPromptConfig flag, which may arrive as a boolean or a string"""
+    if isinstance(value, str):
+        return value.strip().lower() == "true"
+    return bool(value)
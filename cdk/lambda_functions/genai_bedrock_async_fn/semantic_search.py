@@ -0,0 +1,451 @@
+import concurrent.futures
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import operator
+import os
+import re
+import struct
+import threading
+import time
+
+from conversations import get_embedding_key
+
+try:
+    import numpy as np
+except ImportError:
+    # the function is deployed without numpy unless a layer provides it, search then
+    # runs the same brute-force scan in pure python over the memory-mapped matrix
+    np = None
+
+EMBEDDING_MODEL_ID = os.environ.get(
+    "EMBEDDING_MODEL_ID", "amazon.titan-embed-text-v2:0"
+)
+EMBEDDING_DIMENSIONS = int(os.environ.get("EMBEDDING_DIMENSIONS", "256"))
+# deterministic feature-hashing embedder that needs no model, for local runs and tests
+LOCAL_EMBEDDING_MODEL_ID = "local-hashing"
+# characters of a turn that are embedded, longer answers are truncated
+EMBEDDING_TEXT_MAX_CHARS = 8000
+EMBEDDING_SNIPPET_CHARS = 200
+# cohere embedding models accept this many texts per request, titan models one
+COHERE_EMBEDDING_BATCH_SIZE = 96
+EMBEDDING_REQUEST_WORKERS = 4
+DYNAMODB_BATCH_WRITE_SIZE = 25
+DYNAMODB_BATCH_WRITE_ATTEMPTS = 5
+# each user's matrix is cached here as packed float32 rows beside a JSON file with the row metadata
+SEMANTIC_INDEX_CACHE_DIR = "/tmp/semantic_index"
+# embeddings written by other containers with a slightly older clock are re-read for this long
+EMBEDDING_SYNC_LAG_SECONDS = 10
+SEMANTIC_SEARCH_TOP_K = 10
+SEMANTIC_SEARCH_MAX_TOP_K = 50
+# scores are ranked at the precision they are returned with, newest turn first on a tie, so
+# the float32 numpy scan and the pure python scan rank the same turns the same way
+SEMANTIC_SCORE_DIGITS = 4
+EMBEDDING_TERM_PATTERN = re.compile(r"[^\W_]+")
+
+
+def normalize_vector(vector):
+    """Returns the vector scaled to unit length, so a dot product is the cosine similarity"""
+    norm = math.sqrt(sum(value * value for value in vector))
+    if not norm:
+        return list(vector)
+    return [value / norm for value in vector]
+
+
+def pack_vector(vector):
+    """Packs a vector as little-endian float32"""
+    return struct.pack(f"<{len(vector)}f", *vector)
+
+
+class HashingEmbedder:
+    """
+    Embeds text by feature hashing its terms.
+
+    The vectors are deterministic and need no model or network access, so semantic
+    search can be exercised locally and in tests. Similar wording gives similar vectors,
+    it does not capture meaning like a trained model.
+    """
+
+    model_id = LOCAL_EMBEDDING_MODEL_ID
+
+    def __init__(self, dimensions=EMBEDDING_DIMENSIONS):
+        self.dimensions = dimensions
+
+    def embed_text(self, text):
+        """Returns the unit vector of one text"""
+        vector = [0.0] * self.dimensions
+        for term in EMBEDDING_TERM_PATTERN.findall(text.lower()):
+            digest = hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dimensions
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        return normalize_vector(vector)
+
+    def embed(self, texts, input_type="search_document"):
+        """Returns one unit vector per text"""
+        return [self.embed_text(text) for text in texts]
+
+
+class BedrockEmbedder:
+    """Embeds text with a Bedrock embedding model (amazon.titan-embed-* or cohere.embed-*)"""
+
+    def __init__(
+        self,
+        bedrock_runtime,
+        model_id=EMBEDDING_MODEL_ID,
+        dimensions=EMBEDDING_DIMENSIONS,
+    ):
+        self.bedrock_runtime = bedrock_runtime
+        self.model_id = model_id
+        self.dimensions = dimensions
+
+    def invoke(self, body):
+        response = self.bedrock_runtime.invoke_model(
+            modelId=self.model_id,
+            body=json.dumps(body),
+            contentType="application/json",
+            accept="application/json",
+        )
+        return json.loads(response["body"].read())
+
+    def embed(self, texts, input_type="search_document"):
+        """
+        Returns one unit vector per text.
+
+        Cohere models embed up to COHERE_EMBEDDING_BATCH_SIZE texts per request, titan
+        models take one text per request and the requests run concurrently.
+        """
+        if self.model_id.startswith("cohere.embed"):
+            vectors = []
+            for start in range(0, len(texts), COHERE_EMBEDDING_BATCH_SIZE):
+                vectors.extend(
+                    self.invoke(
+                        {
+                            "texts": texts[start : start + COHERE_EMBEDDING_BATCH_SIZE],
+                            "input_type": input_type,
+                            "truncate": "END",
+                        }
+                    )["embeddings"]
+                )
+            return [normalize_vector(vector) for vector in vectors]
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=EMBEDDING_REQUEST_WORKERS
+        ) as executor:
+            return list(
+                executor.map(
+                    lambda text: self.invoke(
+                        {
+                            "inputText": text,
+                            "dimensions": self.dimensions,
+                            "normalize": True,
+                        }
+                    )["embedding"],
+                    texts,
+                )
+            )
+
+
+def create_embedder(bedrock_runtime, model_id=EMBEDDING_MODEL_ID):
+    """Returns the embedder configured by EMBEDDING_MODEL_ID"""
+    if model_id == LOCAL_EMBEDDING_MODEL_ID:
+        return HashingEmbedder()
+    return BedrockEmbedder(bedrock_runtime, model_id)
+
+
+class SemanticIndex:
+    """
+    Stores turn embeddings per user and searches them by cosine similarity.
+
+    Every embedding is one item in the embeddings table, sorted by the time it was
+    written. A user's embeddings are cached in /tmp as one packed float32 matrix that is
+    extended with the items written since the last search and memory-mapped for the
+    scan, so a warm container reads each embedding from DynamoDB once. Deleting a session
+    writes a tombstone among the items, which removes the session's rows on the next sync.
+    """
+
+    def __init__(
+        self,
+        dynamodb,
+        embeddings_table_name,
+        embedder,
+        cache_dir=SEMANTIC_INDEX_CACHE_DIR,
+    ):
+        """
+        Args:
+            dynamodb (boto3.client): DynamoDB client.
+            embeddings_table_name (str): Table holding one item per embedded turn
+                (user_id, embedding_key).
+            embedder: HashingEmbedder, BedrockEmbedder or any object with model_id and
+                embed(texts, input_type).
+            cache_dir (str): Directory for the memory-mapped matrices.
+        """
+        self.dynamodb = dynamodb
+        self.embeddings_table_name = embeddings_table_name
+        self.embedder = embedder
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+
+    def add_turns(self, turns):
+        """
+        Embeds turns in one batch and stores their embeddings.
+
+        Args:
+            turns (list): {"user_id", "session_id", "message_id", "text"} per turn, the
+                turns may belong to different users, turns without text are skipped.
+
+        Returns:
+            int: The number of embeddings stored.
+        """
+        turns = [turn for turn in turns if turn["text"].strip()]
+        if not turns:
+            return 0
+        vectors = self.embedder.embed(
+            [turn["text"][:EMBEDDING_TEXT_MAX_CHARS] for turn in turns],
+            "search_document",
+        )
+        written_at = time.time()
+        write_requests = []
+        for turn, vector in zip(turns, vectors):
+            # keys sort by write time, so a sync only reads the embeddings it has not seen
+            embedding_key = get_embedding_key(
+                written_at, turn["session_id"], turn["message_id"]
+            )
+            snippet = " ".join(turn["text"][: EMBEDDING_SNIPPET_CHARS * 2].split())
+            write_requests.append(
+                {
+                    "PutRequest": {
+                        "Item": {
+                            "user_id": {"S": turn["user_id"]},
+                            "embedding_key": {"S": embedding_key},
+                            "session_id": {"S": turn["session_id"]},
+                            "message_id": {"S": turn["message_id"]},
+                            "snippet": {"S": snippet[:EMBEDDING_SNIPPET_CHARS]},
+                            "model_id": {"S": self.embedder.model_id},
+                            "vector": {"B": pack_vector(vector)},
+                        }
+                    }
+                }
+            )
+        for start in range(0, len(write_requests), DYNAMODB_BATCH_WRITE_SIZE):
+            request_items = {
+                self.embeddings_table_name: write_requests[
+                    start : start + DYNAMODB_BATCH_WRITE_SIZE
+                ]
+            }
+            for attempt in range(DYNAMODB_BATCH_WRITE_ATTEMPTS):
+                response = self.dynamodb.batch_write_item(RequestItems=request_items)
+                request_items = response.get("UnprocessedItems")
+                if not request_items:
+                    break
+                time.sleep(0.05 * 2**attempt)
+            else:
+                raise RuntimeError(
+                    f"Unprocessed embedding writes after {DYNAMODB_BATCH_WRITE_ATTEMPTS} attempts"
+                )
+        return len(write_requests)
+
+    def get_cache_paths(self, user_id):
+        """Returns the (matrix, metadata) cache file paths of a user"""
+        name = hashlib.sha256(user_id.encode("utf-8")).hexdigest()
+        return (
+            os.path.join(self.cache_dir, f"{name}.f32"),
+            os.path.join(self.cache_dir, f"{name}.json"),
+        )
+
+    def query_embedding_items(self, user_id, after_key):
+        """Yields the user's embedding items written after after_key, oldest first"""
+        query_args = {
+            "TableName": self.embeddings_table_name,
+            "KeyConditionExpression": "user_id = :user_id AND embedding_key > :after_key",
+            "ExpressionAttributeValues": {
+                ":user_id": {"S": user_id},
+                ":after_key": {"S": after_key},
+            },
+            "ConsistentRead": True,
+        }
+        while True:
+            response = self.dynamodb.query(**query_args)
+            yield from response.get("Items", [])
+            if "LastEvaluatedKey" not in response:
+                return
+            query_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def sync_matrix(self, user_id):
+        """
+        Brings the user's cached matrix up to date with the embeddings table.
+
+        Embeddings written since the last sync are appended. Tombstones of deleted
+        sessions remove the session's rows, and the matrix is then rewritten.
+
+        Returns:
+            tuple: The matrix file path, the number of dimensions and the row metadata
+                ([embedding_key, session_id, message_id, snippet] per matrix row).
+        """
+        matrix_path, metadata_path = self.get_cache_paths(user_id)
+        metadata = {
+            "model_id": self.embedder.model_id,
+            "dimensions": 0,
+            "synced_key": "",
+            "rows": [],
+        }
+        try:
+            with open(metadata_path, encoding="utf-8") as metadata_file:
+                cached_metadata = json.load(metadata_file)
+            matrix_size = (
+                os.path.getsize(matrix_path) if os.path.exists(matrix_path) else 0
+            )
+            # a matrix shorter than its rows was left by a rewrite that did not finish
+            if (
+                cached_metadata["model_id"] == self.embedder.model_id
+                and matrix_size
+                >= len(cached_metadata["rows"]) * cached_metadata["dimensions"] * 4
+            ):
+                metadata = cached_metadata
+        except (OSError, ValueError, KeyError):
+            pass
+        rows = metadata["rows"]
+        # keys written within the lag are re-read, in case a write with an older key landed late
+        after_key = f"{0.0:017.6f}"
+        if metadata.get("synced_key"):
+            synced_at = float(metadata["synced_key"].split("#", 1)[0])
+            after_key = f"{synced_at - EMBEDDING_SYNC_LAG_SECONDS:017.6f}"
+        recent_keys = {row[0] for row in rows if row[0] > after_key}
+        new_rows = []
+        new_vectors = []
+        # session id -> tombstone key, rows of the session written before it are dropped
+        deleted_sessions = {}
+        synced_key = metadata.get("synced_key", "")
+        for item in self.query_embedding_items(user_id, after_key):
+            embedding_key = item["embedding_key"]["S"]
+            synced_key = max(synced_key, embedding_key)
+            if "deleted_session_id" in item:
+                deleted_sessions[item["deleted_session_id"]["S"]] = embedding_key
+                continue
+            if (
+                embedding_key in recent_keys
+                or item["model_id"]["S"] != self.embedder.model_id
+            ):
+                continue
+            vector = item["vector"]["B"]
+            if not metadata["dimensions"]:
+                metadata["dimensions"] = len(vector) // 4
+            if len(vector) != metadata["dimensions"] * 4:
+                continue
+            new_rows.append(
+                [
+                    embedding_key,
+                    item["session_id"]["S"],
+                    item["message_id"]["S"],
+                    item["snippet"]["S"],
+                ]
+            )
+            new_vectors.append(vector)
+        all_rows = rows + new_rows
+        kept = [
+            index
+            for index, row in enumerate(all_rows)
+            if row[0] > deleted_sessions.get(row[1], "")
+        ]
+        rows_changed = bool(new_rows) or len(kept) < len(all_rows)
+        row_bytes = metadata["dimensions"] * 4
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if len(kept) < len(all_rows):
+            cached_vectors = b""
+            if rows:
+                with open(matrix_path, "rb") as matrix_file:
+                    cached_vectors = matrix_file.read(len(rows) * row_bytes)
+            vectors = [
+                cached_vectors[index * row_bytes : (index + 1) * row_bytes]
+                for index in range(len(rows))
+            ] + new_vectors
+            temp_matrix_path = f"{matrix_path}.tmp"
+            with open(temp_matrix_path, "wb") as matrix_file:
+                matrix_file.writelines(vectors[index] for index in kept)
+            os.replace(temp_matrix_path, matrix_path)
+            all_rows = [all_rows[index] for index in kept]
+        elif new_rows:
+            with open(matrix_path, "ab") as matrix_file:
+                # drops rows appended by a sync that failed before its metadata was saved
+                matrix_file.truncate(len(rows) * row_bytes)
+                matrix_file.writelines(new_vectors)
+        if rows_changed or synced_key != metadata.get("synced_key", ""):
+            rows = metadata["rows"] = all_rows
+            metadata["synced_key"] = synced_key
+            temp_metadata_path = f"{metadata_path}.tmp"
+            with open(temp_metadata_path, "w", encoding="utf-8") as metadata_file:
+                json.dump(metadata, metadata_file)
+            os.replace(temp_metadata_path, metadata_path)
+        return matrix_path, metadata["dimensions"], rows
+
+    def search(self, user_id, query, top_k=SEMANTIC_SEARCH_TOP_K):
+        """
+        Returns the user's turns most similar to a query.
+
+        Returns:
+            list: Up to top_k {"session_id", "message_id", "score", "snippet"}, best
+                match first, turns unrelated to the query (score <= 0) are left out.
+        """
+        query_vector = self.embedder.embed([query], "search_query")[0]
+        with self._lock:
+            matrix_path, dimensions, rows = self.sync_matrix(user_id)
+        if not rows or len(query_vector) != dimensions:
+            return []
+        with open(matrix_path, "rb") as matrix_file, mmap.mmap(
+            matrix_file.fileno(), len(rows) * dimensions * 4, access=mmap.ACCESS_READ
+        ) as matrix_map:
+            if np is not None:
+                matrix = np.frombuffer(matrix_map, dtype="<f4").reshape(
+                    len(rows), dimensions
+                )
+                scores = np.round(
+                    (matrix @ np.asarray(query_vector, dtype=np.float32)).astype(
+                        np.float64
+                    ),
+                    SEMANTIC_SCORE_DIGITS,
+                )
+                count = min(top_k, len(rows))
+                # every row tied with the last one kept is a candidate for the tie-break
+                threshold = scores[np.argpartition(-scores, count - 1)[count - 1]]
+                ranked = heapq.nlargest(
+                    count,
+                    (
+                        (float(scores[row]), int(row))
+                        for row in np.flatnonzero(scores >= threshold)
+                    ),
+                )
+                del matrix
+            else:
+                values = memoryview(matrix_map).cast("f")
+                ranked = heapq.nlargest(
+                    top_k,
+                    (
+                        (
+                            round(
+                                sum(
+                                    map(
+                                        operator.mul,
+                                        values[
+                                            row * dimensions : (row + 1) * dimensions
+                                        ],
+                                        query_vector,
+                                    )
+                                ),
+                                SEMANTIC_SCORE_DIGITS,
+                            ),
+                            row,
+                        )
+                        for row in range(len(rows))
+                    ),
+                )
+                values.release()
+        return [
+            {
+                "session_id": rows[row][1],
+                "message_id": rows[row][2],
+                "score": score,
+                "snippet": rows[row][3],
+            }
+            for score, row in ranked
+            if score > 0
+        ]
@@ -1,6 +1,9 @@
 import os
+import base64
+import json
+from decimal import Decimal
 import boto3
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.conditions import Attr, Key
 import jwt
 from chatbot_commons import commons
 from datetime import datetime, timezone
@@ -25,6 +28,33 @@ image_bucket = os.environ["S3_IMAGE_BUCKET_NAME"]
 WEBSOCKET_API_ENDPOINT = os.environ["WEBSOCKET_API_ENDPOINT"]
 usage_table_name = os.environ["DYNAMODB_TABLE_USAGE"]
 region = os.environ["REGION"]
+# projects only the conversation list fields, never the history
+CONVERSATION_LIST_INDEX = "user_id-list-index"
+# conversations sent per load_conversation_list page unless the client asks for another size
+CONVERSATION_LIST_PAGE_SIZE = 50
+CONVERSATION_LIST_MAX_PAGE_SIZE = 200
+# written by conversations.delete_conversation_history when a session is deleted
+CONVERSATION_TOMBSTONE_SUFFIX = "#deleted"
+CONVERSATION_TOMBSTONE_RETENTION_SECONDS = 30 * 24 * 60 * 60
+# the list index is eventually consistent, so watermarks overlap recent writes by this much
+SYNC_WATERMARK_LAG_SECONDS = 10
+CONVERSATION_LIST_ATTRIBUTE_NAMES = {
+    "#session_id": "session_id",
+    "#title": "title",
+    "#selected_model_id": "selected_model_id",
+    "#selected_model_name": "selected_model_name",
+    "#last_modified_date": "last_modified_date",
+    "#category": "category",
+    "#kb_session_id": "kb_session_id",
+    "#selected_knowledgebase_id": "selected_knowledgebase_id",
+    "#flow_id": "flow_id",
+    "#flow_alias_id": "flow_alias_id",
+    "#selected_agent_id": "selected_agent_id",
+    "#selected_agent_alias_id": "selected_agent_alias_id",
+    "#conversation_history_in_s3": "conversation_history_in_s3",
+    "#last_message_id": "last_message_id",
+}
+CONVERSATION_LIST_PROJECTION = ", ".join(CONVERSATION_LIST_ATTRIBUTE_NAMES)
 
 # AWS API Gateway Management API client
 apigateway_management_api = boto3.client(
@@ -43,8 +73,31 @@ def lambda_handler(event, context):
     )
     user_id = decoded_token["cognito:username"]
     connection_id = event["connection_id"]
-    conversation_items = get_conversation_list_from_dynamodb_conversation_history_table(
-        user_id
+    sync_watermark = datetime.now(timezone.utc).timestamp() - SYNC_WATERMARK_LAG_SECONDS
+    since = get_since_watermark(event.get("since"))
+    if since is not None:
+        changed_items = get_conversation_changes(user_id, since)
+        # None when there are too many changes for one frame, the client then reloads the list
+        if changed_items is not None:
+            commons.send_websocket_message(
+                logger,
+                apigateway_management_api,
+                connection_id,
+                {
+                    "type": "load_conversation_list",
+                    "conversation_list": changed_items,
+                    "selected_session_id": selected_session_id,
+                    "timestamp": datetime.now(timezone.utc).isoformat(),
+                    "since": since,
+                    "sync_watermark": sync_watermark,
+                },
+            )
+            return {"statusCode": 200}
+    cursor = event.get("cursor")
+    conversation_items, next_cursor = (
+        get_conversation_list_from_dynamodb_conversation_history_table(
+            user_id, get_page_size(event.get("limit")), cursor
+        )
     )
     commons.send_websocket_message(
         logger,
@@ -55,40 +108,154 @@ def lambda_handler(event, context):
             "conversation_list": conversation_items,
             "selected_session_id": selected_session_id,
             "timestamp": datetime.now(timezone.utc).isoformat(),
+            # the cursor this page was requested with, a page without one replaces the list
+            "cursor": cursor,
+            "next_cursor": next_cursor,
+            "sync_watermark": sync_watermark,
         },
     )
     return {"statusCode": 200}
 
 
+def get_page_size(limit):
+    """Returns the requested page size, clamped to CONVERSATION_LIST_MAX_PAGE_SIZE"""
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return CONVERSATION_LIST_PAGE_SIZE
+    return max(1, min(limit, CONVERSATION_LIST_MAX_PAGE_SIZE))
+
+
+def encode_list_cursor(last_evaluated_key):
+    """Returns an opaque cursor for the index key a conversation list page ended at"""
+    if not last_evaluated_key:
+        return None
+    typed_key = {
+        name: {"N": str(value)} if isinstance(value, Decimal) else {"S": value}
+        for name, value in last_evaluated_key.items()
+    }
+    return base64.urlsafe_b64encode(
+        json.dumps(typed_key, separators=(",", ":")).encode("utf-8")
+    ).decode("ascii")
+
+
+def decode_list_cursor(cursor, user_id):
+    """
+    Returns the ExclusiveStartKey for a cursor from encode_list_cursor.
+
+    Raises:
+        ValueError: If the cursor is malformed or belongs to another user.
+    """
+    try:
+        typed_key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        last_evaluated_key = {
+            name: Decimal(value["N"]) if "N" in value else value["S"]
+            for name, value in typed_key.items()
+        }
+    except (AttributeError, TypeError, KeyError, ArithmeticError, ValueError) as e:
+        raise ValueError(f"Invalid conversation list cursor: {cursor}") from e
+    if last_evaluated_key.get("user_id") != user_id:
+        raise ValueError("Conversation list cursor belongs to another user")
+    return last_evaluated_key
+
+
+def get_since_watermark(since):
+    """
+    Returns the since watermark of a delta sync request.
+
+    None is returned when no watermark was sent or it is older than the tombstone
+    retention, because deletions before then can no longer be reported.
+    """
+    try:
+        since = float(since)
+    except (TypeError, ValueError):
+        return None
+    oldest_since = (
+        datetime.now(timezone.utc).timestamp()
+        - CONVERSATION_TOMBSTONE_RETENTION_SECONDS
+    )
+    return since if since > oldest_since else None
+
+
+@tracer.capture_method
+def get_conversation_changes(user_id, since):
+    """
+    Function to get the conversations created, renamed or deleted after since.
+
+    Deleted conversations are returned as {"session_id", "last_modified_date", "deleted"}.
+
+    Returns:
+        list: The changed conversations, newest first, or None when there are more than
+            CONVERSATION_LIST_MAX_PAGE_SIZE changes.
+    """
+    try:
+        response = conversations_table.query(
+            IndexName=CONVERSATION_LIST_INDEX,
+            KeyConditionExpression=Key("user_id").eq(user_id)
+            & Key("last_modified_date").gt(Decimal(str(since))),
+            ProjectionExpression=CONVERSATION_LIST_PROJECTION,
+            ExpressionAttributeNames=CONVERSATION_LIST_ATTRIBUTE_NAMES,
+            ScanIndexForward=False,
+            Limit=CONVERSATION_LIST_MAX_PAGE_SIZE,
+        )
+        if response.get("LastEvaluatedKey"):
+            return None
+        items = response.get("Items", [])
+        live_session_ids = {
+            item["session_id"]
+            for item in items
+            if not item["session_id"].endswith(CONVERSATION_TOMBSTONE_SUFFIX)
+        }
+        changes = []
+        for item in items:
+            if not item["session_id"].endswith(CONVERSATION_TOMBSTONE_SUFFIX):
+                changes.append(item)
+                continue
+            session_id = item["session_id"][: -len(CONVERSATION_TOMBSTONE_SUFFIX)]
+            # a session re-created after it was deleted is reported as live
+            if session_id not in live_session_ids:
+                changes.append(
+                    {
+                        "session_id": session_id,
+                        "last_modified_date": item["last_modified_date"],
+                        "deleted": True,
+                    }
+                )
+        return changes
+    except Exception as e:
+        logger.exception(e)
+        logger.error("Error querying DynamoDB (7267)")
+        return None
+
+
 @tracer.capture_method
-def get_conversation_list_from_dynamodb_conversation_history_table(user_id):
-    """Function to get conversation list from DynamoDB, sorted by last_modified_date desc."""
+def get_conversation_list_from_dynamodb_conversation_history_table(
+    user_id, limit=CONVERSATION_LIST_PAGE_SIZE, cursor=None
+):
+    """
+    Function to get a page of the conversation list from DynamoDB, sorted by last_modified_date desc.
+
+    Returns:
+        tuple: A tuple containing:
+            - list: Up to limit conversations
+            - str: The cursor of the next page, None when this was the last page
+    """
     try:
         items = []
-        last_evaluated_key = None
+        last_evaluated_key = decode_list_cursor(cursor, user_id) if cursor else None
 
-        while True:
+        while len(items) < limit:
             query_params = {
-                "IndexName": "user_id-index",
+                "IndexName": CONVERSATION_LIST_INDEX,
                 "KeyConditionExpression": Key("user_id").eq(user_id),
-                "ProjectionExpression": "#session_id, #selected_model_id,#selected_model_name, #last_modified_date, #title, #category,#kb_session_id,#selected_knowledgebase_id,#flow_id,#flow_alias_id,#selected_agent_id,#selected_agent_alias_id,#conversation_history_in_s3,#last_message_id",
-                "ExpressionAttributeNames": {
-                    "#session_id": "session_id",
-                    "#title": "title",
-                    "#selected_model_id": "selected_model_id",
-                    "#selected_model_name": "selected_model_name",
-                    "#last_modified_date": "last_modified_date",
-                    "#category": "category",
-                    "#kb_session_id": "kb_session_id",
-                    "#selected_knowledgebase_id": "selected_knowledgebase_id",
-                    "#flow_id": "flow_id",
-                    "#flow_alias_id": "flow_alias_id",
-                    "#selected_agent_id": "selected_agent_id",
-                    "#selected_agent_alias_id": "selected_agent_alias_id",
-                    "#conversation_history_in_s3": "conversation_history_in_s3",
-                    "#last_message_id": "last_message_id",
-                },
+                "ProjectionExpression": CONVERSATION_LIST_PROJECTION,
+                "ExpressionAttributeNames": CONVERSATION_LIST_ATTRIBUTE_NAMES,
+                # tombstones of deleted sessions are only returned to delta syncs
+                "FilterExpression": ~Attr("session_id").contains(
+                    CONVERSATION_TOMBSTONE_SUFFIX
+                ),
                 "ScanIndexForward": False,
+                "Limit": limit - len(items),
             }
 
             # Add ExclusiveStartKey if we have a LastEvaluatedKey from previous query
@@ -107,8 +274,8 @@ def get_conversation_list_from_dynamodb_conversation_history_table(user_id):
             if not last_evaluated_key:
                 break
 
-        return items
+        return items, encode_list_cursor(last_evaluated_key)
     except Exception as e:
         logger.exception(e)
         logger.error("Error querying DynamoDB (7266)")
-        return []
+        return [], None
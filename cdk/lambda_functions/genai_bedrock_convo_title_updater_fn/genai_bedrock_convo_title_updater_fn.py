@@ -24,6 +24,8 @@ image_bucket = os.environ["S3_IMAGE_BUCKET_NAME"]
 WEBSOCKET_API_ENDPOINT = os.environ["WEBSOCKET_API_ENDPOINT"]
 usage_table_name = os.environ["DYNAMODB_TABLE_USAGE"]
 region = os.environ["REGION"]
+# projects only the conversation list fields, never the history
+CONVERSATION_LIST_INDEX = "user_id-list-index"
 
 # AWS API Gateway Management API client
 apigateway_management_api = boto3.client(
@@ -51,7 +53,7 @@ def get_conversation_list_from_dynamodb_conversation_history_bucket(user_id):
     """Function to get conversation list from DynamoDB, sorted by last_modified_date desc."""
     try:
         response = conversations_table.query(
-            IndexName="user_id-index",
+            IndexName=CONVERSATION_LIST_INDEX,
             KeyConditionExpression=Key("user_id").eq(user_id),
             ProjectionExpression="#session_id, #selected_model_id, #last_modified_date, #title",
             ExpressionAttributeNames={
@@ -3,7 +3,6 @@ import boto3
 import base64
 import uuid
 import os
-import copy
 from datetime import datetime, timezone
 from aws_lambda_powertools import Logger, Metrics, Tracer
 from botocore.config import Config
@@ -22,7 +21,22 @@ dynamodb = boto3.client("dynamodb")
 image_bucket = os.environ["S3_IMAGE_BUCKET_NAME"]
 conversations_table_name = os.environ["CONVERSATIONS_DYNAMODB_TABLE"]
 conversations_table = boto3.resource("dynamodb").Table(conversations_table_name)
+messages_table_name = os.environ["CONVERSATION_MESSAGES_DYNAMODB_TABLE"]
 conversation_history_bucket = os.environ["CONVERSATION_HISTORY_BUCKET"]
+search_index_table_name = os.environ["CONVERSATION_SEARCH_INDEX_DYNAMODB_TABLE"]
+embeddings_table_name = os.environ["CONVERSATION_EMBEDDINGS_DYNAMODB_TABLE"]
+turn_index_queue_url = os.environ["TURN_INDEX_QUEUE_URL"]
+sqs_client = boto3.client("sqs")
+conversation_store = conversations.ConversationStore(
+    dynamodb,
+    s3_client,
+    conversations_table_name,
+    messages_table_name,
+    conversation_history_bucket,
+    sqs_client=sqs_client,
+    turn_index_queue_url=turn_index_queue_url,
+    logger=logger,
+)
 
 apigateway_management_api = boto3.client(
     "apigatewaymanagementapi",
@@ -63,7 +77,16 @@ def lambda_handler(event, context):
                 session_id, image_bucket, user_id, "images", s3_client, logger
             )
             conversations.delete_conversation_history(
-                dynamodb, conversations_table_name, logger, session_id
+                dynamodb,
+                conversations_table_name,
+                logger,
+                session_id,
+                messages_table_name,
+                user_id,
+                s3_client,
+                conversation_history_bucket,
+                search_index_table_name,
+                embeddings_table_name,
             )
             return
         elif message_type == "load":
@@ -81,6 +104,7 @@ def lambda_handler(event, context):
                 apigateway_management_api,
                 False,
                 False,
+                messages_table_name,
             )
             return
         # if model_id contains titan or nova then
@@ -107,7 +131,7 @@ def lambda_handler(event, context):
         else:
             raise ValueError(f"Unsupported model: {model_id}")
 
-        needs_load_from_s3, chat_title_loaded, original_existing_history = (
+        needs_load_from_s3, chat_title_loaded, existing_history = (
             conversations.load_and_send_conversation_history(
                 session_id,
                 connection_id,
@@ -121,9 +145,9 @@ def lambda_handler(event, context):
                 apigateway_management_api,
                 False,
                 True,
+                messages_table_name,
             )
         )
-        existing_history = copy.deepcopy(original_existing_history)
         new_conversation = bool(not existing_history or len(existing_history) == 0)
         persisted_chat_title = (
             chat_title_loaded
@@ -285,7 +309,7 @@ def store_bedrock_images_response(
     chat_title,
     new_message_id,
 ):
-    conversation_history = existing_history + [
+    new_messages = [
         {
             "role": "user",
             "content": [{"text": prompt}],
@@ -303,16 +327,15 @@ def store_bedrock_images_response(
             "message_id": new_message_id,
         },
     ]
-    conversation_json = json.dumps(conversation_history)
-    current_timestamp = str(datetime.now(tz=timezone.utc).timestamp())
-    item_value = {
-        "session_id": {"S": session_id},
-        "user_id": {"S": user_id},
-        "title": {"S": chat_title},
-        "last_modified_date": {"N": current_timestamp},
-        "selected_model_id": {"S": model_id},
-        "category": {"S": selected_model_category},
-        "conversation_history": {"S": conversation_json},
-        "conversation_history_in_s3": {"BOOL": False},
-    }
-    dynamodb.put_item(TableName=conversations_table_name, Item=item_value)
+    conversation_store.append_turn(
+        session_id,
+        user_id,
+        existing_history,
+        new_messages,
+        {
+            "title": chat_title,
+            "selected_model_id": model_id,
+            "category": selected_model_category,
+            "last_message_id": new_message_id,
+        },
+    )
@@ -60,6 +60,18 @@ def route_request(request_body, message_type, selected_mode):
             InvocationType="Event",
             Payload=json.dumps(request_body),
         )
+    elif message_type in [
+        "stop_generation",
+        "load_more",
+        "search_conversations",
+        "semantic_search",
+    ]:
+        # the bedrock function records stop requests, pages history and searches for every category
+        lambda_client.invoke(
+            FunctionName=bedrock_function_name,
+            InvocationType="Event",
+            Payload=json.dumps(request_body),
+        )
     elif (
         selected_mode.get("category") == "Bedrock Agents"
         or selected_mode.get("category") == "Bedrock KnowledgeBases"
@@ -48,6 +48,7 @@ async function getCurrentSession() {
 Amplify.configure(amplifyConfig);
 const awsChatbotUrl = amplifyConfig.aws_chatbot_url;
 const restSendMessageEndpoint = `${awsChatbotUrl}/rest/send-message`;
+const CONVERSATION_LIST_PAGE_SIZE = 50;
 
 const App = memo(({ signOut, user, awsRum }) => {
 	const [partialMessages, setPartialMessages] = useState([]);
@@ -61,6 +62,11 @@ const App = memo(({ signOut, user, awsRum }) => {
 	const [firstLoad, setFirstLoad] = useState(true);
 	const [messages, setMessages] = useState([]);
 	const [messagesProcessing, setMessagesProcessing] = useState(false);
+	const [historyCursor, setHistoryCursor] = useState(null);
+	const [loadingOlderMessages, setLoadingOlderMessages] = useState(false);
+	const olderMessagesRef = useRef([]);
+	// message id of the prompt being answered, a stop request names it
+	const answeringMessageIdRef = useRef(null);
 	const [uploadedFileNames, setUploadedFileNames] = useState([]);
 	const [conversationList, setConversationList] = useState(
 		localStorage.getItem("load_conversation_list")
@@ -68,6 +74,15 @@ const App = memo(({ signOut, user, awsRum }) => {
 			: [],
 	);
 	const [conversationListLoading, setConversationListLoading] = useState(false);
+	const [conversationListCursor, setConversationListCursor] = useState(
+		localStorage.getItem("load_conversation_list_cursor"),
+	);
+	const [conversationListLoadingMore, setConversationListLoadingMore] =
+		useState(false);
+	// null while no search is active, otherwise the results of the last search
+	const [searchResults, setSearchResults] = useState(null);
+	const [searchLoading, setSearchLoading] = useState(false);
+	const searchQueryRef = useRef("");
 
 	const [selectedConversation, setSelectedConversation] = useState(() => {
 		const storedValue = localStorage.getItem("selectedConversation");
@@ -653,12 +668,57 @@ const App = memo(({ signOut, user, awsRum }) => {
 		const data = {
 			type: "load_conversation_list",
 			selectedSessionId: selected_session_id,
+			limit: CONVERSATION_LIST_PAGE_SIZE,
 			idToken: `${idToken}`,
 			accessToken: `${accessToken}`,
 		};
+		// with a cached list only the changes since the last sync are requested
+		const syncWatermark = localStorage.getItem(
+			"load_conversation_list_watermark",
+		);
+		if (conversationList.length > 0 && syncWatermark) {
+			data.since = Number(syncWatermark);
+		}
 		sendMessageViaRest(data, restSendMessageEndpoint, "loadConversationList");
 	};
 
+	const loadMoreConversations = async () => {
+		if (!conversationListCursor || conversationListLoadingMore) return;
+		setConversationListLoadingMore(true);
+		const { accessToken, idToken } = await getCurrentSession();
+		const data = {
+			type: "load_conversation_list",
+			limit: CONVERSATION_LIST_PAGE_SIZE,
+			cursor: conversationListCursor,
+			idToken: `${idToken}`,
+			accessToken: `${accessToken}`,
+		};
+		sendMessageViaRest(data, restSendMessageEndpoint, "loadMoreConversations");
+	};
+
+	const searchConversations = async (query) => {
+		searchQueryRef.current = query.trim();
+		if (!searchQueryRef.current) {
+			clearConversationSearch();
+			return;
+		}
+		setSearchLoading(true);
+		const { accessToken, idToken } = await getCurrentSession();
+		const data = {
+			type: "search_conversations",
+			query: searchQueryRef.current,
+			idToken: `${idToken}`,
+			accessToken: `${accessToken}`,
+		};
+		sendMessageViaRest(data, restSendMessageEndpoint, "searchConversations");
+	};
+
+	const clearConversationSearch = () => {
+		searchQueryRef.current = "";
+		setSearchResults(null);
+		setSearchLoading(false);
+	};
+
 	const loadConversationHistory = async (
 		sessId,
 		chatHistoryExists,
@@ -711,13 +771,46 @@ const App = memo(({ signOut, user, awsRum }) => {
 		);
 	};
 
+	const loadOlderMessages = async () => {
+		if (
+			loadingOlderMessages ||
+			!historyCursor?.cursor ||
+			historyCursor.session_id !== selectedConversation?.session_id
+		) {
+			return;
+		}
+		setLoadingOlderMessages(true);
+		const { accessToken, idToken } = await getCurrentSession();
+		const data = {
+			type: "load_more",
+			cursor: historyCursor.cursor,
+			selected_mode: selectedMode,
+			idToken: `${idToken}`,
+			accessToken: `${accessToken}`,
+		};
+		sendMessageViaRest(data, restSendMessageEndpoint, "loadOlderMessages");
+	};
+
+	const stopGeneration = async () => {
+		const { accessToken, idToken } = await getCurrentSession();
+		const data = {
+			type: "stop_generation",
+			message_id: answeringMessageIdRef.current,
+			selected_mode: selectedMode,
+			idToken: `${idToken}`,
+			accessToken: `${accessToken}`,
+		};
+		sendMessageViaRest(data, restSendMessageEndpoint, "stopGeneration");
+	};
+
 	// biome-ignore lint/correctness/useExhaustiveDependencies: Not Needed
 	useEffect(() => {
 		if (!lastMessage) return;
 		try {
 			const message = JSON.parse(lastMessage.data);
 			const message_temp_cache = [];
-			if (message.type !== "conversation_history") return;
+			const isOlderPage = message.type === "conversation_history_older";
+			if (message.type !== "conversation_history" && !isOlderPage) return;
 
 			const message_session_id = message.session_id;
 			if (message_session_id !== selectedConversation?.session_id) {
@@ -730,15 +823,10 @@ const App = memo(({ signOut, user, awsRum }) => {
 			if (messageChunk.msg_partial) {
 				const allMessages = [...partialMessages, messageChunk];
 				if (messageChunk.msg_partial_last_chunk) {
-					let newMessageChunk;
-					for (const currentPartialMessage of allMessages) {
-						if (!newMessageChunk) {
-							newMessageChunk = currentPartialMessage;
-						} else {
-							newMessageChunk.content = `${currentPartialMessage.content}${newMessageChunk.content}`;
-						}
-					}
-					messageChunk = newMessageChunk;
+					// the parts are consecutive slices of the message's JSON text
+					messageChunk = JSON.parse(
+						allMessages.map((part) => part.msg_partial_data).join(""),
+					);
 				} else {
 					setPartialMessages(allMessages);
 					return;
@@ -752,6 +840,24 @@ const App = memo(({ signOut, user, awsRum }) => {
 				}
 			}
 
+			if (last_message) {
+				setHistoryCursor({
+					session_id: message_session_id,
+					cursor: message.cursor || null,
+				});
+			}
+			if (isOlderPage) {
+				// older pages are collected and prepended once complete
+				olderMessagesRef.current.push(...messageChunk);
+				if (last_message) {
+					const olderMessages = olderMessagesRef.current;
+					olderMessagesRef.current = [];
+					setMessages((prevMessages) => [...olderMessages, ...prevMessages]);
+					setLoadingOlderMessages(false);
+				}
+				return;
+			}
+
 			message_temp_cache.push(...messageChunk);
 			if (last_message) {
 				setMessagesProcessing(false);
@@ -918,6 +1024,7 @@ const App = memo(({ signOut, user, awsRum }) => {
 			.formatToParts(new Date())
 			.find((part) => part.type === "timeZoneName").value;
 
+		answeringMessageIdRef.current = randomMessageId;
 		const data = {
 			type: "chat",
 			message_id: randomMessageId,
@@ -1321,34 +1428,82 @@ const App = memo(({ signOut, user, awsRum }) => {
 				setModelsLoaded(true);
 			} else if (
 				message.type === "conversation_history" ||
-				message.type === "conversation_history_tail"
+				message.type === "conversation_history_older"
 			) {
 				// Do nothing, UseEffect will handle this
 				// to find this code, search for:
 				// if (message.type !== "conversation_history") return;
 			} else if (message.type === "load_conversation_list") {
-				setConversationList(message.conversation_list);
-				// save message.conversation_list in local storage
-				if (message.conversation_list) {
+				if (message.cursor) {
+					setConversationListCursor(message.next_cursor || null);
+					// a later page is appended, skipping sessions already listed
+					setConversationList((prevConversationList) => {
+						const listedSessionIds = new Set(
+							prevConversationList.map((conversation) => conversation.session_id),
+						);
+						return [
+							...prevConversationList,
+							...(message.conversation_list || []).filter(
+								(conversation) => !listedSessionIds.has(conversation.session_id),
+							),
+						];
+					});
+					setConversationListLoadingMore(false);
+					return;
+				}
+				let newConversationList = message.conversation_list;
+				if (message.since) {
+					newConversationList = mergeConversationChanges(
+						conversationList,
+						message.conversation_list || [],
+					);
+				} else {
+					setConversationListCursor(message.next_cursor || null);
+					if (message.next_cursor) {
+						localStorage.setItem(
+							"load_conversation_list_cursor",
+							message.next_cursor,
+						);
+					} else {
+						localStorage.removeItem("load_conversation_list_cursor");
+					}
+				}
+				setConversationList(newConversationList);
+				// save the conversation list in local storage
+				if (newConversationList) {
 					localStorage.setItem(
 						"load_conversation_list",
-						JSON.stringify(message.conversation_list),
+						JSON.stringify(newConversationList),
+					);
+				}
+				if (message.sync_watermark) {
+					localStorage.setItem(
+						"load_conversation_list_watermark",
+						String(message.sync_watermark),
 					);
 				}
 
-				if (message.selected_session_id) {
-					const selectedConversation = message.conversation_list.find(
+				if (message.selected_session_id && newConversationList) {
+					const selectedConversation = newConversationList.find(
 						(conversation) =>
 							conversation.session_id === message.selected_session_id,
 					);
-					setSelectedConversation(selectedConversation);
-					localStorage.setItem(
-						"selectedConversation",
-						JSON.stringify(selectedConversation),
-					);
+					// the selected session may be on a page that is not loaded yet
+					if (selectedConversation) {
+						setSelectedConversation(selectedConversation);
+						localStorage.setItem(
+							"selectedConversation",
+							JSON.stringify(selectedConversation),
+						);
+					}
 				}
 
 				setConversationListLoading(false);
+			} else if (message.type === "search_conversations") {
+				// results of a search that was replaced or cleared meanwhile are dropped
+				if (message.query !== searchQueryRef.current) return;
+				setSearchResults(message.results || []);
+				setSearchLoading(false);
 			} else if (message.type === "modelscan") {
 				triggerModelScanFinished();
 			} else if (
@@ -1791,6 +1946,13 @@ const App = memo(({ signOut, user, awsRum }) => {
 							conversationList={conversationList}
 							handleSelectChat={handleSelectChat}
 							conversationListLoading={conversationListLoading}
+							hasMoreConversations={!!conversationListCursor}
+							conversationListLoadingMore={conversationListLoadingMore}
+							onLoadMoreConversations={loadMoreConversations}
+							searchResults={searchResults}
+							searchLoading={searchLoading}
+							onSearchConversations={searchConversations}
+							onClearSearch={clearConversationSearch}
 							selectedConversation={selectedConversation}
 							isDisabled={isDisabled}
 							reactThemeMode={reactThemeMode}
@@ -1830,6 +1992,12 @@ const App = memo(({ signOut, user, awsRum }) => {
 								conversationList={conversationList}
 								setIsRefreshingMessage={setIsRefreshingMessage}
 								setIsRefreshing={setIsRefreshing}
+								hasOlderMessages={
+									!!historyCursor?.cursor &&
+									historyCursor.session_id === selectedConversation?.session_id
+								}
+								loadingOlderMessages={loadingOlderMessages}
+								onLoadOlderMessages={loadOlderMessages}
 							/>
 						</div>
 						<MessageInput
@@ -1838,6 +2006,13 @@ const App = memo(({ signOut, user, awsRum }) => {
 							onAudioData={handleAudioData}
 							disabled={isDisabled || isLoading}
 							setIsDisabled={setIsDisabled}
+							onStop={
+								isDisabled &&
+								(selectedMode?.category === "Bedrock Models" ||
+									selectedMode?.category === "Imported Models")
+									? stopGeneration
+									: undefined
+							}
 							selectedMode={selectedMode}
 							selectedKbMode={selectedKbMode}
 							sendMessage={sendMessage}
@@ -1900,6 +2075,20 @@ const App = memo(({ signOut, user, awsRum }) => {
 	);
 });
 
+// applies a delta sync: changed conversations replace their entries, tombstones remove them
+function mergeConversationChanges(conversationList, changes) {
+	const changedSessionIds = new Set(changes.map((change) => change.session_id));
+	return [
+		...changes.filter((change) => !change.deleted),
+		...conversationList.filter(
+			(conversation) => !changedSessionIds.has(conversation.session_id),
+		),
+	].sort(
+		(a, b) =>
+			Number(b.last_modified_date || 0) - Number(a.last_modified_date || 0),
+	);
+}
+
 function convertRoleToHuman(input) {
 	// Convert single object to array if needed
 	const jsonArray = Array.isArray(input) ? input : [input];
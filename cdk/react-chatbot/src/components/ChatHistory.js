@@ -1,6 +1,6 @@
 import React, { useEffect, useState, useRef, forwardRef, memo } from "react";
 import ChatMessage from "./ChatMessage";
-import { Box } from "@mui/material";
+import { Box, Button } from "@mui/material";
 
 const ChatHistory = memo(
 	forwardRef(
@@ -21,6 +21,9 @@ const ChatHistory = memo(
 				conversationList,
 				setIsRefreshingMessage,
 				setIsRefreshing,
+				hasOlderMessages,
+				loadingOlderMessages,
+				onLoadOlderMessages,
 			},
 			ref,
 		) => {
@@ -131,6 +134,16 @@ const ChatHistory = memo(
 						flexDirection: "column",
 					}}
 				>
+					{hasOlderMessages && (
+						<Button
+							size="small"
+							onClick={onLoadOlderMessages}
+							disabled={loadingOlderMessages}
+							sx={{ alignSelf: "center", mb: 1 }}
+						>
+							{loadingOlderMessages ? "Loading..." : "Load earlier messages"}
+						</Button>
+					)}
 					{messages?.map((message, index) => (
 						<div
 							key={`${message.timestamp || index}-${index}`}
@@ -8,8 +8,12 @@ import {
 	ListItemText,
 	CircularProgress,
 	Tooltip,
+	TextField,
+	InputAdornment,
 } from "@mui/material";
 import AddIcon from "@mui/icons-material/Add";
+import ClearIcon from "@mui/icons-material/Clear";
+import SearchIcon from "@mui/icons-material/Search";
 import DeleteIcon from "@mui/icons-material/Delete";
 
 const getCategoryIdentifier = (category) => {
@@ -62,6 +66,13 @@ const LeftSideBar = ({
 	conversationList,
 	handleSelectChat,
 	conversationListLoading,
+	hasMoreConversations,
+	conversationListLoadingMore,
+	onLoadMoreConversations,
+	searchResults,
+	searchLoading,
+	onSearchConversations,
+	onClearSearch,
 	selectedConversation,
 	isDisabled,
 	reactThemeMode,
@@ -76,6 +87,28 @@ const LeftSideBar = ({
 		color: reactThemeMode === "light" ? "text.primary" : "text.secondary",
 	};
 
+	const [searchQuery, setSearchQuery] = React.useState("");
+	// search results replace the conversation list until the search is cleared
+	const listedConversations = searchResults ?? conversationList;
+
+	const handleClearSearch = () => {
+		setSearchQuery("");
+		onClearSearch();
+	};
+
+	const handleListScroll = (event) => {
+		const { scrollTop, scrollHeight, clientHeight } = event.currentTarget;
+		// the next page is requested shortly before the end of the list is reached
+		if (
+			!searchResults &&
+			hasMoreConversations &&
+			!conversationListLoadingMore &&
+			scrollTop + clientHeight >= scrollHeight - 100
+		) {
+			onLoadMoreConversations();
+		}
+	};
+
 	return (
 		<Box sx={sidebarStyle}>
 			<Box
@@ -98,8 +131,55 @@ const LeftSideBar = ({
 					<AddIcon />
 				</IconButton>
 			</Box>
-			<List className="left-sidebar" sx={{ flexGrow: 1, overflowY: "auto" }}>
-				{conversationList.map((conversation) => {
+			<Box sx={{ px: 2, pb: 1 }}>
+				<TextField
+					size="small"
+					fullWidth
+					placeholder="Search chats"
+					value={searchQuery}
+					onChange={(e) => setSearchQuery(e.target.value)}
+					onKeyDown={(e) => {
+						if (e.key === "Enter") {
+							onSearchConversations(searchQuery);
+						} else if (e.key === "Escape") {
+							handleClearSearch();
+						}
+					}}
+					InputProps={{
+						startAdornment: (
+							<InputAdornment position="start">
+								{searchLoading ? (
+									<CircularProgress size={16} />
+								) : (
+									<SearchIcon fontSize="small" />
+								)}
+							</InputAdornment>
+						),
+						endAdornment: searchQuery && (
+							<InputAdornment position="end">
+								<IconButton
+									size="small"
+									aria-label="clear search"
+									onClick={handleClearSearch}
+								>
+									<ClearIcon fontSize="small" />
+								</IconButton>
+							</InputAdornment>
+						),
+					}}
+				/>
+			</Box>
+			<List
+				className="left-sidebar"
+				sx={{ flexGrow: 1, overflowY: "auto" }}
+				onScroll={handleListScroll}
+			>
+				{searchResults && searchResults.length === 0 && (
+					<Typography variant="body2" sx={{ px: 2, py: 1 }}>
+						No chats found
+					</Typography>
+				)}
+				{listedConversations.map((conversation) => {
 					return (
 						<ListItem
 							key={conversation.session_id}
@@ -108,7 +188,8 @@ const LeftSideBar = ({
 									!isDisabled &&
 									selectedConversation?.session_id !== conversation.session_id
 								) {
-									handleSelectChat(conversation);
+									const { score, snippet, ...selectedChat } = conversation;
+									handleSelectChat(selectedChat);
 								}
 							}}
 							className={
@@ -161,7 +242,10 @@ const LeftSideBar = ({
 							)}
 							<ListItemText
 								primary={conversation.title}
-								secondary={formatDate(conversation.last_modified_date)}
+								secondary={
+									conversation.snippet ||
+									formatDate(conversation.last_modified_date)
+								}
 								sx={{ flex: 1, minWidth: 0, opacity: isDisabled ? 0.5 : 1 }}
 							/>
 							<IconButton
@@ -180,6 +264,11 @@ const LeftSideBar = ({
 						</ListItem>
 					);
 				})}
+				{conversationListLoadingMore && (
+					<Box sx={{ display: "flex", justifyContent: "center", py: 1 }}>
+						<CircularProgress size={20} />
+					</Box>
+				)}
 			</List>
 			{conversationListLoading && (
 				<Box
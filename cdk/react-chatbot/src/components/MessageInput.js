@@ -6,7 +6,7 @@ import React, {
 	useCallback,
 } from "react";
 import { Box, Chip, TextField, IconButton } from "@mui/material";
-import { FaPaperPlane, FaPaperclip } from "react-icons/fa";
+import { FaPaperPlane, FaPaperclip, FaStop } from "react-icons/fa";
 import axios from "axios";
 import { v4 as uuidv4 } from "uuid";
 import PushToTalkButton from "./PushToTalkButton";
@@ -79,6 +79,7 @@ const MessageInput = forwardRef(
 			onSend,
 			disabled,
 			setIsDisabled,
+			onStop,
 			selectedMode,
 			selectedKbMode,
 			getCurrentSession,
@@ -600,15 +601,21 @@ const MessageInput = forwardRef(
 					>
 						<FaPaperclip />
 					</IconButton>
-					<IconButton
-						onClick={handleSend}
-						disabled={
-							isDisabled() || (!message.trim() && attachments.length === 0)
-						}
-						aria-label="Send message"
-					>
-						<FaPaperPlane />
-					</IconButton>
+					{onStop ? (
+						<IconButton onClick={onStop} aria-label="Stop generating">
+							<FaStop />
+						</IconButton>
+					) : (
+						<IconButton
+							onClick={handleSend}
+							disabled={
+								isDisabled() || (!message.trim() && attachments.length === 0)
+							}
+							aria-label="Send message"
+						>
+							<FaPaperPlane />
+						</IconButton>
+					)}
 				</Box>
 			</Box>
 		);
@@ -0,0 +1,17 @@
+import os
+import sys
+
+LAMBDA_FUNCTIONS_DIR = os.path.join(
+    os.path.dirname(__file__), "..", "..", "lambda_functions"
+)
+
+# the async function reads its websocket endpoint when its modules are imported
+os.environ.setdefault("WEBSOCKET_API_ENDPOINT", "wss://example.com")
+
+# deploy.sh copies the layer modules beside each function, the tests import them the same way
+for path in (
+    "genai_bedrock_async_fn",
+    os.path.join("conversations_layer", "python", "conversations"),
+    os.path.join("commons_layer", "python", "chatbot_commons"),
+):
+    sys.path.insert(0, os.path.abspath(os.path.join(LAMBDA_FUNCTIONS_DIR, path)))
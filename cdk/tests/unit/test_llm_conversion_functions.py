@@ -0,0 +1,91 @@
+import io
+
+from botocore.exceptions import ClientError
+
+from llm_conversion_functions import (
+    download_history_attachments,
+    parse_history_content_types,
+    plan_history_content,
+)
+
+HISTORY = [
+    {
+        "role": "user",
+        "content": [
+            {"text": "What is in these files?"},
+            {
+                "image": {
+                    "format": "png",
+                    "s3source": {"s3bucket": "bucket", "s3key": "chart.png"},
+                }
+            },
+            {
+                "document": {
+                    "format": "pdf",
+                    "name": "report",
+                    "s3source": {"s3bucket": "bucket", "s3key": "missing.pdf"},
+                }
+            },
+            {
+                "video": {
+                    "format": "mp4",
+                    "s3source": {"s3bucket": "bucket", "s3key": "clip.mp4"},
+                }
+            },
+        ],
+    },
+    {"role": "assistant", "content": [{"text": "A chart, a report and a clip."}]},
+]
+
+
+class FakeS3Client:
+    def __init__(self, objects):
+        self.objects = objects
+        self.requested_keys = []
+
+    def get_object(self, Bucket, Key):
+        self.requested_keys.append(Key)
+        if Key not in self.objects:
+            raise ClientError(
+                {"Error": {"Code": "NoSuchKey", "Message": "Not Found"}}, "GetObject"
+            )
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+
+def test_parse_history_content_types_always_keeps_text():
+    assert parse_history_content_types("") == ("text",)
+    assert parse_history_content_types(" Video,image , unknown") == (
+        "text",
+        "image",
+        "video",
+    )
+
+
+def test_text_only_history_plans_no_downloads():
+    messages, pending_downloads = plan_history_content(HISTORY, ("text",))
+
+    assert pending_downloads == []
+    assert messages[0]["content"] == [{"text": "What is in these files?"}]
+    assert messages[1] == HISTORY[1]
+
+
+def test_attachment_history_downloads_only_replayed_types():
+    content_types = parse_history_content_types("image,document,video")
+    messages, pending_downloads = plan_history_content(HISTORY, content_types)
+    s3_client = FakeS3Client({"chart.png": b"png-bytes"})
+
+    download_history_attachments(s3_client, pending_downloads)
+
+    assert sorted(s3_client.requested_keys) == ["chart.png", "missing.pdf"]
+    assert messages[0]["content"] == [
+        {"text": "What is in these files?"},
+        {"image": {"format": "png", "source": {"bytes": b"png-bytes"}}},
+        {
+            "video": {
+                "format": "mp4",
+                "source": {"s3Location": {"uri": "s3://bucket/clip.mp4"}},
+            }
+        },
+    ]
+    # the stored history keeps its S3 pointers
+    assert "s3source" in HISTORY[0]["content"][1]["image"]
@@ -0,0 +1,59 @@
+from context_window import CACHE_POINT, add_cache_points, supports_prompt_caching
+from prompt_assembly import build_system_prompt_blocks, build_timezone_prompt
+
+CACHING_MODEL_ID = "anthropic.claude-3-7-sonnet-20250219-v1:0"
+
+
+def build_request(system_prompt, timestamp, model_id=CACHING_MODEL_ID):
+    history = [
+        {"role": "user", "content": [{"text": "question " * 1000}]},
+        {"role": "assistant", "content": [{"text": "answer " * 1000}]},
+    ]
+    messages = history + [{"role": "user", "content": [{"text": "next question"}]}]
+    timezone_prompt = build_timezone_prompt(timestamp, "Europe/Berlin")
+    system_blocks = build_system_prompt_blocks(
+        system_prompt,
+        timezone_prompt,
+        messages[-1],
+        supports_prompt_caching(model_id),
+    )
+    if supports_prompt_caching(model_id):
+        add_cache_points(system_blocks, messages, len(system_prompt) // 4, 2000)
+    return system_blocks, messages, timezone_prompt
+
+
+def test_caching_model_without_system_prompt_keeps_system_blocks_stable():
+    first_blocks, first_messages, first_timezone = build_request(
+        "", "2026-10-17T10:00:00+00:00"
+    )
+    second_blocks, second_messages, second_timezone = build_request(
+        "", "2026-10-17T10:05:00+00:00"
+    )
+
+    assert first_blocks == second_blocks == []
+    assert first_messages[-1]["content"][0] == {"text": first_timezone}
+    assert second_messages[-1]["content"][0] == {"text": second_timezone}
+    # the cached prefix ends on the last history message and is the same for both requests
+    assert first_messages[-2]["content"][-1] == CACHE_POINT
+    assert first_messages[:-1] == second_messages[:-1]
+
+
+def test_caching_model_with_system_prompt_moves_timestamp_to_user_message():
+    system_prompt = "You are a helpful assistant. " * 200
+    first_blocks, _, _ = build_request(system_prompt, "2026-10-17T10:00:00+00:00")
+    second_blocks, second_messages, second_timezone = build_request(
+        system_prompt, "2026-10-17T10:05:00+00:00"
+    )
+
+    assert first_blocks == second_blocks == [{"text": system_prompt}, CACHE_POINT]
+    assert second_messages[-1]["content"][0] == {"text": second_timezone}
+
+
+def test_model_without_caching_keeps_timestamp_in_system_prompt():
+    model_id = "mistral.mistral-large-2407-v1:0"
+    blocks, messages, timezone_prompt = build_request("Be brief.", "now", model_id)
+    assert blocks == [{"text": "Be brief. " + timezone_prompt}]
+    assert messages[-1]["content"] == [{"text": "next question"}]
+
+    blocks, _, timezone_prompt = build_request("", "now", model_id)
+    assert blocks == [{"text": timezone_prompt}]
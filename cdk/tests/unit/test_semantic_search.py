@@ -0,0 +1,163 @@
+import os
+
+import pytest
+
+import semantic_search
+from conversations import delete_conversation_embeddings
+from semantic_search import HashingEmbedder, SemanticIndex
+
+TABLE_NAME = "embeddings"
+
+
+class FakeDynamoDB:
+    """The embeddings table calls of SemanticIndex, with small query pages"""
+
+    page_size = 2
+
+    def __init__(self):
+        self.items = {}
+        self.queried_items = 0
+
+    def put_item(self, TableName, Item):
+        self.items[(Item["user_id"]["S"], Item["embedding_key"]["S"])] = Item
+
+    def batch_write_item(self, RequestItems):
+        for request in RequestItems[TABLE_NAME]:
+            if "PutRequest" in request:
+                self.put_item(TABLE_NAME, request["PutRequest"]["Item"])
+            else:
+                key = request["DeleteRequest"]["Key"]
+                self.items.pop((key["user_id"]["S"], key["embedding_key"]["S"]), None)
+        return {}
+
+    def query(self, ExpressionAttributeValues, ExclusiveStartKey=None, **kwargs):
+        values = ExpressionAttributeValues
+        if "IndexName" in kwargs:
+            matches = [
+                item
+                for item in self.items.values()
+                if item.get("session_id", {}).get("S") == values[":session_id"]["S"]
+            ]
+        else:
+            matches = [
+                self.items[key]
+                for key in sorted(self.items)
+                if key[0] == values[":user_id"]["S"]
+                and key[1] > values[":after_key"]["S"]
+            ]
+        start = ExclusiveStartKey["position"] if ExclusiveStartKey else 0
+        page = matches[start : start + self.page_size]
+        self.queried_items += len(page)
+        response = {"Items": page}
+        if start + self.page_size < len(matches):
+            response["LastEvaluatedKey"] = {"position": start + self.page_size}
+        return response
+
+
+def turn(session_id, message_id, text):
+    return {
+        "user_id": "user",
+        "session_id": session_id,
+        "message_id": message_id,
+        "text": text,
+    }
+
+
+@pytest.fixture
+def dynamodb():
+    return FakeDynamoDB()
+
+
+@pytest.fixture
+def semantic_index(dynamodb, tmp_path):
+    return SemanticIndex(
+        dynamodb, TABLE_NAME, HashingEmbedder(), cache_dir=str(tmp_path)
+    )
+
+
+def test_hashing_embedder_is_deterministic_unit_length():
+    embedder = HashingEmbedder(dimensions=64)
+    first, second = embedder.embed(["Apples and pears", "apples AND pears"])
+
+    assert first == second
+    assert len(first) == 64
+    assert sum(value * value for value in first) == pytest.approx(1.0)
+    assert embedder.embed([""])[0] == [0.0] * 64
+
+
+def test_sync_appends_only_new_embeddings(dynamodb, semantic_index):
+    semantic_index.add_turns(
+        [
+            turn("orchard", "m1", "apples grow in the orchard"),
+            turn("kitchen", "m2", "apples baked into a pie"),
+        ]
+    )
+    matrix_path, dimensions, rows = semantic_index.sync_matrix("user")
+    assert sorted(row[2] for row in rows) == ["m1", "m2"]
+    assert os.path.getsize(matrix_path) == 2 * dimensions * 4
+
+    semantic_index.add_turns([turn("garden", "m3", "pears grow in the garden")])
+    dynamodb.queried_items = 0
+    matrix_path, dimensions, rows = semantic_index.sync_matrix("user")
+
+    # embeddings of one batch share a write time, later batches are appended after them
+    assert sorted(row[2] for row in rows[:2]) == ["m1", "m2"]
+    assert rows[2][2] == "m3"
+    assert os.path.getsize(matrix_path) == 3 * dimensions * 4
+    # only the embeddings within the sync lag are read again
+    assert dynamodb.queried_items <= 3
+
+
+def test_tombstone_drops_rows_of_deleted_session(dynamodb, semantic_index):
+    semantic_index.add_turns(
+        [
+            turn("orchard", "m1", "apples grow in the orchard"),
+            turn("kitchen", "m2", "apples baked into a pie"),
+            turn("orchard", "m3", "the orchard needs rain"),
+        ]
+    )
+    assert len(semantic_index.sync_matrix("user")[2]) == 3
+
+    delete_conversation_embeddings(dynamodb, TABLE_NAME, "user", "orchard")
+    matrix_path, dimensions, rows = semantic_index.sync_matrix("user")
+
+    assert [row[1] for row in rows] == ["kitchen"]
+    assert os.path.getsize(matrix_path) == dimensions * 4
+    assert [
+        result["message_id"] for result in semantic_index.search("user", "apples")
+    ] == ["m2"]
+
+
+def test_search_leaves_out_unrelated_turns(semantic_index):
+    semantic_index.add_turns(
+        [
+            turn("orchard", "m1", "apples grow in the orchard"),
+            turn("garden", "m2", "pears grow in the garden"),
+        ]
+    )
+
+    results = semantic_index.search("user", "apples orchard")
+    assert [result["message_id"] for result in results] == ["m1"]
+    assert all(result["score"] > 0 for result in results)
+    assert semantic_index.search("user", "zebra") == []
+
+
+def test_numpy_and_pure_python_rank_the_same(semantic_index, monkeypatch):
+    numpy = pytest.importorskip("numpy")
+    semantic_index.add_turns(
+        [
+            turn("s1", "m1", "apples grow in the orchard"),
+            turn("s2", "m2", "apples and pears grow in the garden"),
+            turn("s3", "m3", "apples apples apples"),
+            turn("s4", "m4", "the orchard garden needs rain"),
+        ]
+    )
+
+    monkeypatch.setattr(semantic_search, "np", numpy)
+    numpy_results = semantic_index.search("user", "apples in the orchard", top_k=3)
+    monkeypatch.setattr(semantic_search, "np", None)
+    python_results = semantic_index.search("user", "apples in the orchard", top_k=3)
+
+    assert numpy_results == python_results
+    # m2 and m3 tie, the row synced later ranks first on both paths
+    assert [result["message_id"] for result in numpy_results] == ["m1", "m3", "m2"]